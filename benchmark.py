@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Бенчмарки анализатора логов. Результаты выводятся в формате JSON"""
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import log_analyzer
+
+LOG_ROW = (
+    '{ip} -  - [{time_local}] "{method} {url} HTTP/1.1" {status} {size} "-" '
+    '"{agent}" "-" "{request_id}" "{user}" {time}\n'
+)
+BROKEN_ROW = '{ip} -  - [{time_local}] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n'
+METHODS = ["GET"] * 8 + ["POST"] * 2 + ["PUT", "HEAD", "OPTIONS"]
+STATUSES = ["200"] * 20 + ["301", "304", "404", "500"]
+AGENTS = [
+    "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/58.0 Safari/537.36",
+    "python-requests/2.13.0",
+    "-",
+]
+URL_TEMPLATES = [
+    "/api/v2/banner/{id}",
+    "/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28",
+    "/api/1/photo/{id}/",
+    "/export/appinstall_raw/2017-06-{day:02d}/{id}/",
+    "/api/v2/internal/html5/phantomjs/queue/?wait=1m&id={id}",
+]
+START_TIME = datetime(2017, 6, 29, 3, 50)
+
+
+def make_urls(count, rnd):
+    """Создает count различных URL"""
+    urls = []
+    for i in range(count):
+        template = URL_TEMPLATES[i % len(URL_TEMPLATES)]
+        urls.append(template.format(id=rnd.randrange(10 ** 8) * count + i, day=i % 30 + 1))
+    return urls
+
+
+def generate_rows(rows, urls, zipf, error_rate, seed):
+    """
+    Детерминированно генерирует строки лога в формате ui_short. Популярность URL подчиняется
+    закону Ципфа с показателем zipf, время выполнения - логнормальному распределению
+    """
+    rnd = random.Random(seed)
+    url_list = make_urls(urls, rnd)
+    cum_weights = list(itertools.accumulate(1 / rank ** zipf for rank in range(1, urls + 1)))
+    batch = 10_000
+    for batch_start in range(0, rows, batch):
+        batch_size = min(batch, rows - batch_start)
+        batch_urls = rnd.choices(url_list, cum_weights=cum_weights, k=batch_size)
+        for i, url in enumerate(batch_urls):
+            line = batch_start + i
+            time_local = (START_TIME + timedelta(seconds=line // 100)).strftime(
+                "%d/%b/%Y:%H:%M:%S +0300"
+            )
+            ip = f"{rnd.randrange(1, 255)}.{rnd.randrange(256)}.{rnd.randrange(256)}.{line % 256}"
+            if rnd.random() < error_rate:
+                yield BROKEN_ROW.format(ip=ip, time_local=time_local)
+                continue
+            yield LOG_ROW.format(
+                ip=ip,
+                time_local=time_local,
+                method=rnd.choice(METHODS),
+                url=url,
+                status=rnd.choice(STATUSES),
+                size=rnd.randrange(10, 100_000),
+                agent=rnd.choice(AGENTS),
+                request_id=f"{1498697422 + line // 100}-{rnd.randrange(10 ** 10)}",
+                user=f"{rnd.randrange(16 ** 9):09x}",
+                time=f"{min(rnd.lognormvariate(-1.5, 1.2), 60):.3f}",
+            )
+
+
+def generate_log(path, rows, urls, zipf=1.1, error_rate=0.01, seed=42, members=1):
+    """Записывает сгенерированный лог. Файлы .gz записываются как members членов gzip"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    lines = generate_rows(rows, urls, zipf, error_rate, seed)
+    if not path.endswith(".gz"):
+        with open(path, "w", encoding="utf-8") as log:
+            log.writelines(lines)
+        return
+    member_rows = -(-rows // members)
+    with open(path, "wb") as log:
+        for _ in range(members):
+            content = "".join(itertools.islice(lines, member_rows)).encode("utf-8")
+            if content:
+                log.write(gzip.compress(content, compresslevel=6))
+
+
+def generate_requests(rows, urls, seed):
+    """Генерирует пары (URL, время выполнения)"""
+    rnd = random.Random(seed)
+    for _ in range(rows):
+        yield f"/api/v2/banner/{rnd.randrange(urls)}", round(rnd.uniform(0, 3), 3)
+
+
+def peak_rss():
+    """Пиковый размер резидентной памяти процесса в байтах"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure_stage(name, func, lines=None, size=None):
+    """Выполняет этап и возвращает его результат и метрики"""
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    stage = {"stage": name, "seconds": round(elapsed, 4), "peak_rss_bytes": peak_rss()}
+    # для сжатых логов пропускная способность считается по размеру сжатого файла
+    if lines is not None:
+        stage["lines_per_sec"] = round(lines / elapsed) if elapsed else None
+    if size is not None:
+        stage["mb_per_sec"] = round(size / elapsed / 2 ** 20, 1) if elapsed else None
+    return result, stage
+
+
+def run_suite(args):
+    """Замеряет каждый этап обработки лога отдельно"""
+    ext = ".gz" if args.gz else ""
+    name = (
+        f"nginx-access-ui.log-{args.rows}-{args.urls}-{args.zipf}-{args.error_rate}-"
+        f"{args.seed}{ext}"
+    )
+    path = os.path.join(args.dir, name)
+    if not os.path.exists(path):
+        generate_log(path, args.rows, args.urls, args.zipf, args.error_rate, args.seed)
+    logfile = log_analyzer.LogFile(name=name, path=path, date=None)
+    size = os.path.getsize(path)
+
+    stages = []
+    _, stage = measure_stage(
+        "request_params",
+        lambda: sum(1 for _ in log_analyzer.request_params(logfile)),
+        lines=args.rows,
+        size=size,
+    )
+    stages.append(stage)
+    (table, _, _), stage = measure_stage(
+        "get_statistics",
+        lambda: log_analyzer.get_statistics(logfile, limit=args.report_size),
+        lines=args.rows,
+        size=size,
+    )
+    stages.append(stage)
+    values = [time_ for _, time_ in generate_requests(args.rows, 1, args.seed)]
+    _, stage = measure_stage("get_median", lambda: log_analyzer.get_median(values))
+    stage["values"] = len(values)
+    stages.append(stage)
+    with tempfile.TemporaryDirectory() as report_dir:
+        _, stage = measure_stage(
+            "write_report",
+            lambda: log_analyzer.write_report(table, "report.html", {"REPORT_DIR": report_dir}),
+        )
+    stages.append(stage)
+
+    return {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "params": {
+            "rows": args.rows,
+            "urls": args.urls,
+            "zipf": args.zipf,
+            "error_rate": args.error_rate,
+            "seed": args.seed,
+            "gz": args.gz,
+            "file_bytes": size,
+        },
+        "stages": stages,
+        "peak_rss_bytes": peak_rss(),
+    }
+
+
+def measure_store_memory(store, rows, urls, seed):
+    """Измеряет память, занятую агрегатом после обработки всех запросов"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    aggregate = log_analyzer.AGGREGATE_STORES[store]()
+    for url, time_ in generate_requests(rows, urls, seed):
+        aggregate.add(url, time_)
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "store": store,
+        "rows": rows,
+        "urls": urls,
+        "aggregate_bytes": current,
+        "peak_bytes": peak,
+        "seconds": round(elapsed, 3),
+    }
+
+
+def measure_gzip_reader(path, reader, workers):
+    """Измеряет время чтения и разбора сжатого лога выбранным способом"""
+    config = {"GZIP_READER": reader, "WORKERS": workers}
+    logfile = log_analyzer.LogFile(name=os.path.basename(path), path=path, date=None)
+    started = time.perf_counter()
+    rows = 0
+    size = 0
+    with log_analyzer.get_opener(logfile.name, config)(path) as file:
+        for row in file:
+            log_analyzer.parse_row(row)
+            rows += 1
+            size += len(row)
+    elapsed = time.perf_counter() - started
+    return {
+        "reader": reader,
+        "workers": workers if reader == "parallel" else 1,
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "lines_per_sec": round(rows / elapsed),
+        "mb_per_sec": round(size / elapsed / 2 ** 20, 1),
+    }
+
+
+def measure_startup(command, repeat):
+    """Время запуска command в новом процессе интерпретатора, в миллисекундах"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=cwd, check=True, capture_output=True)
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return {
+        "command": " ".join(command[1:]),
+        "min_ms": round(times[0], 1),
+        "median_ms": round(times[len(times) // 2], 1),
+    }
+
+
+def get_import_times(limit=10):
+    """Модули с наибольшим суммарным временем импорта по данным python -X importtime"""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import log_analyzer"],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        modules.append({"module": parts[2].strip(), "cumulative_us": int(parts[1])})
+    modules.sort(key=lambda module: module["cumulative_us"], reverse=True)
+    return modules[:limit]
+
+
+def run_startup(args):
+    """Замеряет время холодного запуска: импорт модуля и вывод справки командной строки"""
+    results = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "target_ms": args.target_ms,
+        "runs": [
+            measure_startup([sys.executable, "-c", "import log_analyzer"], args.repeat),
+            measure_startup([sys.executable, "log_analyzer.py", "--help"], args.repeat),
+        ],
+        "imports": get_import_times(),
+    }
+    results["passed"] = results["runs"][0]["median_ms"] <= args.target_ms
+    return results
+
+
+def add_generator_arguments(subparser, default_rows):
+    subparser.add_argument("--rows", type=int, default=default_rows, help="Number of log lines")
+    subparser.add_argument("--urls", type=int, default=100_000, help="Number of distinct URLs")
+    subparser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of URLs")
+    subparser.add_argument("--error-rate", type=float, default=0.01, help="Share of broken lines")
+    subparser.add_argument("--seed", type=int, default=42, help="Random seed")
+
+
+def parse_args(argv=None):
+    """Разбирает аргументы командной строки"""
+    parser = argparse.ArgumentParser(description="Log analyzer benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Generate synthetic ui_short log")
+    generate_parser.add_argument("path", help="Output path, gzip if it ends with .gz")
+    generate_parser.add_argument("--members", type=int, default=1, help="Number of gzip members")
+    add_generator_arguments(generate_parser, 1_000_000)
+
+    suite_parser = subparsers.add_parser("suite", help="Per-stage timings on a synthetic log")
+    suite_parser.add_argument("--gz", action="store_true", help="Benchmark gzip compressed log")
+    suite_parser.add_argument("--dir", default="./bench_data", help="Directory for fixtures")
+    suite_parser.add_argument("--report-size", type=int, default=1000, help="Rows in the report")
+    suite_parser.add_argument("--output", help="Also write results to this file")
+    add_generator_arguments(suite_parser, 1_000_000)
+
+    memory_parser = subparsers.add_parser("memory", help="Memory usage of aggregate stores")
+    memory_parser.add_argument("--rows", type=int, default=1_000_000, help="Number of requests")
+    memory_parser.add_argument("--urls", type=int, default=100_000, help="Number of distinct URLs")
+    memory_parser.add_argument("--seed", type=int, default=42, help="Random seed")
+
+    gzip_parser = subparsers.add_parser("gzip", help="Throughput of gzip log readers")
+    gzip_parser.add_argument("--size-mb", type=int, default=2048, help="Uncompressed fixture size")
+    gzip_parser.add_argument("--members", type=int, default=16, help="Number of gzip members")
+    gzip_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Parallel readers")
+    gzip_parser.add_argument("--fixture", default="./bench_data/nginx-access-ui.log-20170630.gz")
+    gzip_parser.add_argument("--seed", type=int, default=42, help="Random seed")
+
+    startup_parser = subparsers.add_parser("startup", help="Cold start time of log_analyzer")
+    startup_parser.add_argument("--repeat", type=int, default=20, help="Number of runs")
+    startup_parser.add_argument(
+        "--target-ms", type=float, default=100, help="Fail if median import time is above it"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "generate":
+        generate_log(
+            args.path, args.rows, args.urls, args.zipf, args.error_rate, args.seed, args.members
+        )
+    elif args.command == "suite":
+        results = run_suite(args)
+        output = json.dumps(results, indent=2)
+        print(output)
+        if args.output:
+            with open(args.output, "w") as file:
+                file.write(output)
+    elif args.command == "memory":
+        results = [
+            measure_store_memory(store, args.rows, args.urls, args.seed)
+            for store in log_analyzer.AGGREGATE_STORES
+        ]
+        print(json.dumps({"memory": results}, indent=2))
+    elif args.command == "gzip":
+        if not os.path.exists(args.fixture):
+            rows = args.size_mb * 2 ** 20 // len(LOG_ROW) // 2
+            generate_log(args.fixture, rows, 100_000, seed=args.seed, members=args.members)
+        results = [
+            measure_gzip_reader(args.fixture, reader, args.workers)
+            for reader in ("default", "pipeline", "parallel")
+        ]
+        print(json.dumps({"gzip": results}, indent=2))
+    elif args.command == "startup":
+        results = run_startup(args)
+        print(json.dumps(results, indent=2))
+        if not results["passed"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
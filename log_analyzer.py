@@ -7,18 +7,40 @@
 #                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
 #                     '$request_time';
 
-import argparse
+import array
+import cProfile
+import csv
+import glob
 import gzip
+import heapq
+import io
 import json
 import logging
+import math
+import mmap
 import os
+import pickle
+import queue
+import random
 import re
+import struct
 import sys
+import threading
 import traceback
-from collections import namedtuple
-from datetime import date, datetime
-from functools import partial
-from string import Template
+import zlib
+from collections import deque, namedtuple
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from functools import lru_cache, partial
+from time import perf_counter, process_time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 config = {
     "REPORT_SIZE": 1000,
@@ -26,138 +48,2825 @@ config = {
     "LOG_DIR": "./log",
     "OUTPUT_LOG_DIR": "./",
     "ERROR_LIMIT_PERC": 5,
+    "WORKERS": 1,
+    "QUANTILE_SKETCH": False,
+    "QUANTILE_ERROR": 0.01,
+    "AGGREGATE_STORE": "auto",
+    "CHECKPOINT_EVERY": 0,
+    "GZIP_READER": "default",
+    "GZIP_QUEUE_SIZE": 16,
+    "MMAP_READER": False,
+    "METRICS_FILE": None,
+    "PROFILE_FILE": None,
+    "BACKFILL": False,
+    "BACKFILL_CONCURRENCY": 2,
+    "CACHE_DIR": None,
+    "CACHE_MAX_AGE_DAYS": 90,
+    "CACHE_MAX_SIZE_MB": 1024,
+    "RANGE_FROM": None,
+    "RANGE_TO": None,
+    "FOLLOW": None,
+    "FOLLOW_INTERVAL": 10,
+    "FOLLOW_EVERY_LINES": 0,
+    "LOG_SOURCES": None,
+    "SOURCE_QUEUE_SIZE": 8,
+    "URL_STRIP_QUERY": False,
+    "URL_RULES": [],
+    "URL_CACHE_SIZE": 65536,
+    "MAX_URLS": 0,
+    "LOG_INDEX_FILE": None,
+    "EXPORT_DIR": None,
+    "EXPORT_FORMATS": ["jsonl"],
+    "EXPORT_GZIP": False,
+    "ERROR_EARLY_ABORT": True,
+    "ERROR_STATISTICAL_ABORT": False,
+    "ERROR_PREFLIGHT_LINES": 2000,
+    "TIME_INDEX_DIR": None,
+    "TIME_FROM": None,
+    "TIME_TO": None,
+    "TIME_LOG": None,
+    "TIMESERIES": False,
+    "TIMESERIES_MINUTES": 1,
+    "TIMESERIES_URLS": 10,
+    "SAMPLE_FRACTION": None,
+    "SAMPLE_BLOCK_SIZE": 65536,
+    "SAMPLE_SEED": None,
+    "FILTER_URL_PREFIX": None,
+    "FILTER_METHODS": None,
+    "FILTER_STATUS": None,
+    "FILTER_MIN_TIME": None,
 }
 
-LOG_FORMAT = "[%(asctime)s] %(levelname).1s %(message)s"
-DATE_FMT = "%Y.%m.%d %H:%M:%S"
+LOG_FORMAT = "[%(asctime)s] %(levelname).1s %(message)s"
+DATE_FMT = "%Y.%m.%d %H:%M:%S"
+
+ERROR_EXIT_STATUS = 1
+LIVE_REPORT_NAME = "report-live.html"
+FOLLOW_IDLE = object()
+FOLLOW_RESET = object()
+SOURCE_BATCH_LINES = 10000
+TEMPLATE_PATH = "report.html"
+TEMPLATE_PLACEHOLDER = "$table_json"
+REPORT_CHUNK_ROWS = 1000
+EXPORT_FIELDS = [
+    "url", "count", "count_perc", "time_sum", "time_perc", "time_avg", "time_max", "time_med",
+]
+EXPORT_EXTENSIONS = {"jsonl": ".jsonl", "csv": ".csv", "columnar": ".col"}
+COLUMNAR_MAGIC = b"LACOL1\n"
+COLUMNAR_GROUP_ROWS = 65536
+# порог z для нижней границы доверительного интервала доли ошибок (около 3e-5 ложных срабатываний)
+ERROR_BUDGET_Z = 4.0
+ERROR_BUDGET_MIN_ROWS = 10000
+ERROR_BUDGET_CHECK_ROWS = 1000
+# запас оценки количества строк лога по его размеру
+ERROR_BUDGET_ROWS_MARGIN = 2
+# длина самой короткой строки, которую разбирает LOG_LINE_RE: 'a b c [] "GET u" 200  0.0'
+ERROR_BUDGET_MIN_ROW_SIZE = 25
+PREFLIGHT_WINDOWS = 8
+# на сколько частей на процесс делится лог, чтобы сохранять контрольную точку после каждой
+CHECKPOINT_CHUNKS_PER_WORKER = 8
+# z для 95% доверительных интервалов отчета по выборке
+SAMPLE_Z = 1.96
+LATENCY_SUB_BITS = 5
+LATENCY_SUB_BUCKETS = 1 << LATENCY_SUB_BITS
+TIME_LOCAL_RE = re.compile(rb"\[(?P<minute>\d{2}/[A-Za-z]{3}/\d{4}:\d{2}:\d{2}):(?P<second>\d{2})")
+LOG_NAME_RE = re.compile(r"^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$")
+REPORT_NAME_RE = re.compile(r"^report-(?P<date>\d{4}\.\d{2}\.\d{2})\.html$")
+CHECKPOINT_NAME_RE = re.compile(r"^\.report-(?P<date>\d{4}\.\d{2}\.\d{2})\.html\.checkpoint$")
+CACHE_NAME_RE = re.compile(r"^aggregate-(?P<date>\d{8})\.bin$")
+# изменения папки моложе этого порога могли не отразиться на времени ее изменения
+INDEX_RACY_SECONDS = 2
+LOG_LINE_RE = re.compile(
+    rb'\S+ +\S+ +\S+ +\[[^\]]*\] +'
+    rb'"(?P<method>GET|POST|PUT|HEAD|OPTIONS) +(?P<url>\S+)[^"]*" +'
+    rb'(?P<status>\d{3}) .*\s(?P<time>\d+\.\d+)\s*$'
+)
+LogFile = namedtuple("LogFile", ["name", "path", "date"])
+Checkpoint = namedtuple("Checkpoint", ["path", "size", "offset", "settings", "aggregate"])
+CacheEntry = namedtuple("CacheEntry", ["date", "path", "size", "mtime", "settings"])
+TimeIndex = namedtuple("TimeIndex", ["path", "size", "mtime", "members", "buckets"])
+
+Analysis = namedtuple("Analysis", ["logfile", "rows", "total_rows", "errors"])
+
+
+@lru_cache(maxsize=None)
+def get_numpy():
+    """
+    Импортирует NumPy при первом обращении, чтобы он не замедлял запуск программы.
+    Возвращает None, если NumPy не установлен
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def get_peak_rss():
+    """Пиковый размер резидентной памяти процесса и его дочерних процессов в байтах"""
+    if resource is None:
+        return None
+    multiplier = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * multiplier
+
+
+class RunMetrics:
+    """
+    Собирает метрики этапов работы: астрономическое и процессорное время, количество
+    обработанных строк и пиковую память
+    """
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Замеряет этап. В словарь этапа можно добавить свои поля, например lines"""
+        record = {"stage": name}
+        wall_started = perf_counter()
+        cpu_started = process_time()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = round(perf_counter() - wall_started, 6)
+            record["cpu_time"] = round(process_time() - cpu_started, 6)
+            record["peak_rss"] = get_peak_rss()
+            self.stages.append(record)
+
+    def summary(self):
+        """Сводка по всем этапам"""
+        return {
+            "stages": self.stages,
+            "wall_time": round(perf_counter() - self.started, 6),
+            "peak_rss": get_peak_rss(),
+        }
+
+
+def write_metrics(metrics, path=None):
+    """Записывает сводку метрик в лог работы программы и, если указан path, в JSON файл"""
+    summary = metrics.summary()
+    logging.info(f"Run metrics: {json.dumps(summary)}")
+    if path is not None:
+        with open(path, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+def scan_log_dir(log_dir):
+    """
+    Генератор. Просматривает папку с логами через os.scandir и возвращает пары
+    (лог, os.DirEntry) для всех логов интерфейса
+    """
+    try:
+        entries = os.scandir(log_dir)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            match = LOG_NAME_RE.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            try:
+                log_date = datetime.strptime(match.group("date"), "%Y%m%d").date()
+            except ValueError:
+                logging.info(f"Incorrect date format in log name: {entry.name}")
+                continue
+            yield LogFile(name=entry.name, path=entry.path, date=log_date), entry
+
+
+class LogIndex:
+    """
+    Сохраняемый между запусками индекс логов в папках (имя, дата, размер, время изменения).
+    Папка просматривается заново, только если изменилось время ее изменения, а при повторном
+    просмотре для уже известных логов stat не выполняется: ротированные логи не меняются.
+    Запросы "самый свежий", "все без отчета" и "диапазон дат" отвечаются по индексу
+    """
+
+    version = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.dirs = {}
+        self.changed = False
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as exc:
+            logging.info(f"Log index {self.path} is ignored: {exc}")
+            return
+        if data.get("version") == self.version:
+            self.dirs = data["dirs"]
+
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        with atomic_write(self.path) as file:
+            json.dump({"version": self.version, "dirs": self.dirs}, file)
+        self.changed = False
+
+    def refresh(self, log_dir):
+        """Обновляет индекс папки log_dir и возвращает ее логи, отсортированные по дате"""
+        key = os.path.abspath(log_dir)
+        try:
+            dir_mtime = os.stat(log_dir).st_mtime_ns
+        except FileNotFoundError:
+            if self.dirs.pop(key, None) is not None:
+                self.changed = True
+            return []
+        known = self.dirs.get(key)
+        if known is None or known["mtime"] != dir_mtime:
+            known_files = {file[0]: file for file in known["files"]} if known else {}
+            files = []
+            for logfile, entry in scan_log_dir(log_dir):
+                file = known_files.get(logfile.name)
+                if file is None:
+                    stat = entry.stat()
+                    file = [logfile.name, logfile.date.isoformat(), stat.st_size, stat.st_mtime]
+                files.append(file)
+            files.sort(key=lambda file: (file[1], file[0]))
+            # если папка менялась только что, следующее изменение может не сдвинуть ее время
+            # изменения, поэтому в следующий раз она будет просмотрена заново
+            if datetime.now().timestamp() - dir_mtime / 1e9 < INDEX_RACY_SECONDS:
+                dir_mtime = None
+            known = {"mtime": dir_mtime, "files": files}
+            self.dirs[key] = known
+            self.changed = True
+        return [
+            LogFile(name=name, path=os.path.join(log_dir, name), date=date.fromisoformat(day))
+            for name, day, _, _ in known["files"]
+        ]
+
+    def log_files(self, log_dir):
+        logfiles = self.refresh(log_dir)
+        self.save()
+        return logfiles
+
+    def latest(self, log_dir):
+        """Самый свежий лог"""
+        logfiles = self.log_files(log_dir)
+        return logfiles[-1] if logfiles else None
+
+    def unreported(self, log_dir, report_dir):
+        """Логи без отчета, от старых к новым"""
+        reported = get_report_dates(report_dir)
+        return [logfile for logfile in self.log_files(log_dir) if logfile.date not in reported]
+
+    def between(self, log_dir, date_from, date_to):
+        """Логи за дни из диапазона [date_from, date_to], от старых к новым"""
+        return [
+            logfile
+            for logfile in self.log_files(log_dir)
+            if date_from <= logfile.date <= date_to
+        ]
+
+
+def get_log_files(log_dir, index_file=None):
+    """
+    Возвращает все логи интерфейса из папки с логами. Если задан index_file, логи
+    берутся из сохраненного индекса LogIndex
+    """
+    if index_file is not None:
+        return LogIndex(index_file).log_files(log_dir)
+    return [logfile for logfile, _ in scan_log_dir(log_dir)]
+
+
+def get_latest_log_file(log_dir, index_file=None):
+    """Просматривает папку с логами и находит самый свежий"""
+    if index_file is not None:
+        return LogIndex(index_file).latest(log_dir)
+    lf = None
+    for logfile in get_log_files(log_dir):
+        if lf is None or logfile.date > lf.date:
+            lf = logfile
+    return lf
+
+
+def get_latest_log_files(sources, index_file=None):
+    """
+    Находит самые свежие логи во всех источниках. Источник - папка с логами или glob-шаблон
+    папок (например, "/mnt/nginx-*/log"). Возвращает все логи за самую свежую дату
+    """
+    index = LogIndex(index_file) if index_file is not None else None
+    latest = []
+    for source in sources:
+        for log_dir in sorted(glob.glob(source)):
+            logfiles = index.refresh(log_dir) if index else get_log_files(log_dir)
+            for logfile in logfiles:
+                if not latest or logfile.date > latest[0].date:
+                    latest = [logfile]
+                elif logfile.date == latest[0].date:
+                    latest.append(logfile)
+    if index is not None:
+        index.save()
+    return latest
+
+
+def get_report_dates(report_dir):
+    """Возвращает множество дат, за которые в папке с отчетами уже есть отчет"""
+    dates = set()
+    try:
+        entries = os.scandir(report_dir)
+    except FileNotFoundError:
+        return dates
+    with entries:
+        for entry in entries:
+            match = REPORT_NAME_RE.match(entry.name)
+            if match is None:
+                continue
+            try:
+                dates.add(datetime.strptime(match.group("date"), "%Y.%m.%d").date())
+            except ValueError:
+                continue
+    return dates
+
+
+def get_unreported_log_files(log_dir, report_dir, index_file=None):
+    """Возвращает логи, для которых еще не построен отчет, от старых к новым"""
+    if index_file is not None:
+        return LogIndex(index_file).unreported(log_dir, report_dir)
+    reported = get_report_dates(report_dir)
+    logfiles = [logfile for logfile in get_log_files(log_dir) if logfile.date not in reported]
+    return sorted(logfiles, key=lambda logfile: logfile.date)
+
+
+GZIP_MAGIC = b"\x1f\x8b\x08"
+GZIP_PROBE_SIZE = 1 << 16
+
+
+def inflate(decompressor, raw, block_size):
+    """
+    Генератор. Распаковывает raw, возвращая блоки не больше block_size байт, чтобы хорошо
+    сжатые данные не разворачивались в память целиком. Останавливается в конце члена gzip
+    """
+    while raw and not decompressor.eof:
+        block = decompressor.decompress(raw, block_size)
+        if block:
+            yield block
+        raw = decompressor.unconsumed_tail
+
+
+def decompress_member(path, offset, emit, block_size=1 << 20):
+    """
+    Распаковывает один член (member) gzip-файла, начинающийся со смещения offset, и передает
+    распакованные блоки не больше block_size в emit. Если emit возвращает False, распаковка
+    прекращается. Возвращает размер члена в сжатом виде или None, если распаковка прервана
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    consumed = 0
+    with open(path, "rb") as file:
+        file.seek(offset)
+        while not decompressor.eof:
+            raw = file.read(block_size)
+            if not raw:
+                raise EOFError(f"Truncated gzip member at offset {offset}")
+            for block in inflate(decompressor, raw, block_size):
+                if not emit(block):
+                    return None
+            consumed += len(raw)
+    return consumed - len(decompressor.unused_data)
+
+
+def is_gzip_member(file, offset):
+    """
+    Проверяет, начинается ли член gzip-файла со смещения offset: флаги заголовка допустимы,
+    а первые GZIP_PROBE_SIZE байт распаковываются без ошибок. Сигнатура GZIP_MAGIC случайно
+    встречается внутри сжатых данных, но такие данные почти сразу оказываются некорректными
+    """
+    file.seek(offset)
+    head = file.read(GZIP_PROBE_SIZE)
+    if len(head) < 18 or head[3] & 0xE0:
+        return False
+    try:
+        zlib.decompressobj(wbits=31).decompress(head, GZIP_PROBE_SIZE)
+    except zlib.error:
+        return False
+    return True
+
+
+def find_gzip_members(path, block_size=1 << 20):
+    """
+    Возвращает смещения, с которых, судя по заголовку и началу данных, начинаются члены
+    gzip-файла. Файл читается блоками по block_size байт
+    """
+    offsets = []
+    with open(path, "rb") as file, open(path, "rb") as probe:
+        tail = b""
+        pos = 0
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            data = tail + block
+            base = pos - len(tail)
+            found = data.find(GZIP_MAGIC)
+            while found != -1:
+                if is_gzip_member(probe, base + found):
+                    offsets.append(base + found)
+                found = data.find(GZIP_MAGIC, found + 1)
+            tail = data[-(len(GZIP_MAGIC) - 1):]
+            pos += len(block)
+    return offsets
+
+
+class GzipMemberTask:
+    """
+    Распаковка одного члена gzip-файла в пуле потоков. Распакованные блоки передаются через
+    собственную ограниченную очередь, поэтому память на член не зависит от его размера:
+    распаковка ждет, пока читатель не заберет блоки. В конце в очередь кладется размер
+    члена в сжатом виде (int) или исключение
+    """
+
+    def __init__(self, path, offset, stopped, queue_size, block_size):
+        self.path = path
+        self.offset = offset
+        self.stopped = stopped
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=queue_size)
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Отменяет распаковку: член не нужен (смещение оказалось не началом члена)"""
+        self.cancelled.set()
+
+    def _put(self, item):
+        while not self.cancelled.is_set() and not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        if self.cancelled.is_set():
+            return
+        try:
+            consumed = decompress_member(self.path, self.offset, self._put, self.block_size)
+        except Exception as exc:
+            self._put(exc)
+            return
+        if consumed is not None:
+            self._put(consumed)
+
+    def get(self):
+        """Следующий блок, размер члена или исключение; None, если чтение остановлено"""
+        while not self.stopped.is_set():
+            try:
+                return self.blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+
+class PipelinedGzipReader:
+    """
+    Читает gzip-файл построчно, распаковывая его в отдельном потоке. Распакованные блоки
+    передаются через ограниченную очередь, поэтому распаковка и разбор строк идут
+    одновременно, а память ограничена размером очереди.
+
+    При workers > 1 члены многочленного gzip-файла распаковываются параллельно
+    в пуле потоков (zlib отпускает GIL), а блоки выдаются в исходном порядке. Каждый член
+    распаковывается в свою очередь из queue_size // workers блоков, поэтому память
+    не зависит от размера членов. Найденные смещения членов - только подсказка: если член
+    начинается там, где его не нашли, он распаковывается без пула
+    """
+
+    _done = object()
+
+    def __init__(self, path, queue_size=16, workers=1, block_size=1 << 20):
+        self.path = path
+        self.workers = workers
+        self.queue_size = queue_size
+        self.block_size = block_size
+        self.offset = 0
+        self.blocks = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def seek(self, offset):
+        """Пропускает offset байтов распакованных данных. Вызывается до начала чтения"""
+        self.offset = offset
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            while self.thread.is_alive():
+                try:
+                    self.blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.thread.join()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decompress_serial(self):
+        started = False
+        decompressor = zlib.decompressobj(wbits=31)
+        with open(self.path, "rb") as file:
+            while True:
+                raw = file.read(self.block_size)
+                if not raw:
+                    if started and not decompressor.eof:
+                        raise EOFError("Compressed file ended before the end-of-stream marker")
+                    break
+                started = True
+                while raw:
+                    for block in inflate(decompressor, raw, self.block_size):
+                        if not self._put(block):
+                            return
+                    raw = b""
+                    if decompressor.eof:
+                        raw = decompressor.unused_data
+                        decompressor = zlib.decompressobj(wbits=31)
+                        started = bool(raw)
+
+    def _decompress_parallel(self):
+        offsets = find_gzip_members(self.path)
+        if len(offsets) < 2:
+            self._decompress_serial()
+            return
+        size = os.path.getsize(self.path)
+        queue_size = max(self.queue_size // self.workers, 1)
+        expected = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            candidates = iter(offsets)
+
+            def submit():
+                offset = next(candidates, None)
+                if offset is None:
+                    return
+                task = GzipMemberTask(
+                    self.path, offset, self.stopped, queue_size, self.block_size
+                )
+                executor.submit(task.run)
+                pending.append(task)
+
+            for _ in range(self.workers * 2):
+                submit()
+            try:
+                while expected < size and not self.stopped.is_set():
+                    while pending and pending[0].offset < expected:
+                        pending.popleft().cancel()
+                        submit()
+                    if not pending or pending[0].offset > expected:
+                        # член, который не нашелся при поиске, распаковывается здесь же
+                        consumed = decompress_member(
+                            self.path, expected, self._put, self.block_size
+                        )
+                        if consumed is None:
+                            return
+                        expected += consumed
+                        continue
+                    task = pending.popleft()
+                    submit()
+                    while True:
+                        item = task.get()
+                        if item is None:
+                            return
+                        if isinstance(item, Exception):
+                            raise item
+                        if isinstance(item, int):
+                            expected += item
+                            break
+                        if not self._put(item):
+                            return
+            finally:
+                for task in pending:
+                    task.cancel()
+
+    def _produce(self):
+        try:
+            if self.workers > 1:
+                self._decompress_parallel()
+            else:
+                self._decompress_serial()
+        except Exception as exc:
+            self._put(exc)
+            return
+        self._put(self._done)
+
+    def _iter_blocks(self):
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+        while True:
+            block = self.blocks.get()
+            if block is self._done:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+    def __iter__(self):
+        skip = self.offset
+        tail = b""
+        for block in self._iter_blocks():
+            if skip:
+                if len(block) <= skip:
+                    skip -= len(block)
+                    continue
+                block = block[skip:]
+                skip = 0
+            data = tail + block if tail else block
+            last_newline = data.rfind(b"\n")
+            if last_newline == -1:
+                tail = data
+                continue
+            tail = data[last_newline + 1:]
+            yield from io.BytesIO(data[:last_newline + 1])
+        if tail:
+            yield tail
+
+
+def get_opener(logname, config=None):
+    """Объект для открытия файла лога в бинарном режиме"""
+    if not logname.endswith(".gz"):
+        return partial(open, mode="rb")
+    config = config or {}
+    reader = config.get("GZIP_READER", "default")
+    if reader == "default":
+        return partial(gzip.open, mode="rb")
+    workers = config.get("WORKERS", 1) if reader == "parallel" else 1
+    return partial(
+        PipelinedGzipReader, queue_size=config.get("GZIP_QUEUE_SIZE", 16), workers=workers
+    )
+
+
+def parse_row(row):
+    """
+    Возвращает URL и время выполнения запроса из строки лога (bytes) в формате ui_short
+    или (None, None), если строка не разобрана
+    """
+    match = LOG_LINE_RE.match(row)
+    if match is not None:
+        try:
+            return match.group("url").decode("utf-8"), float(match.group("time"))
+        except UnicodeDecodeError:
+            pass
+    logging.info(f"Can not find url in request: {row.rstrip().decode('utf-8', 'replace')}")
+    return None, None
+
+
+def parse_row_at(buffer, start, end):
+    """
+    То же, что parse_row, но разбирает строку buffer[start:end] на месте, не копируя ее.
+    buffer - любой объект с буферным протоколом (bytes, mmap)
+    """
+    match = LOG_LINE_RE.match(buffer, start, end)
+    if match is not None:
+        try:
+            return match.group("url").decode("utf-8"), float(match.group("time"))
+        except UnicodeDecodeError:
+            pass
+    row = bytes(buffer[start:end]).rstrip().decode("utf-8", "replace")
+    logging.info(f"Can not find url in request: {row}")
+    return None, None
+
+
+def mmap_params(path, start=0, end=None):
+    """
+    Генератор. Возвращает URL и время выполнения для строк несжатого лога из диапазона байтов
+    [start, end), разбирая их прямо в отображенном в память файле без построчного чтения
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            end = len(buffer) if end is None else end
+            find = buffer.find
+            match = LOG_LINE_RE.match
+            pos = start
+            while pos < end:
+                newline = find(b"\n", pos, end)
+                line_end = end if newline == -1 else newline + 1
+                row = match(buffer, pos, line_end)
+                if row is None:
+                    yield parse_row_at(buffer, pos, line_end)
+                else:
+                    url, time = row.group("url", "time")
+                    if url.isascii():
+                        yield url.decode("ascii"), float(time)
+                    else:
+                        yield parse_row_at(buffer, pos, line_end)
+                pos = line_end
+
+
+def request_params(logfile, config=None, timeseries=None, row_filter=None):
+    """
+    Генератор. На каждой итерации возвращает URL и время выполнения для каждой записи из файла лога.
+    Если задан timeseries, записи учитываются во временном ряду, если задан row_filter -
+    разбираются только прошедшие фильтр строки (в обоих случаях строки читаются построчно)
+    """
+    mmap_reader = (config or {}).get("MMAP_READER") and timeseries is None and row_filter is None
+    if mmap_reader and not logfile.name.endswith(".gz"):
+        yield from mmap_params(logfile.path)
+        return
+    opener = get_opener(logfile.name, config)
+    with opener(logfile.path) as file:
+        yield from parse_rows(file, timeseries, row_filter)
+
+
+def get_chunks(path, chunks_count, start=0, end=None):
+    """
+    Разбивает файл (или его диапазон байтов [start, end)) на диапазоны байтов,
+    границы которых выровнены по концам строк
+    """
+    size = os.path.getsize(path) if end is None else end
+    step = max((size - start) // chunks_count, 1)
+    bounds = [start]
+    with open(path, "rb") as file:
+        for i in range(1, chunks_count):
+            pos = start + i * step
+            if pos <= bounds[-1]:
+                continue
+            file.seek(pos - 1)
+            file.readline()
+            pos = file.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def get_complete_size(path, block_size=65536):
+    """Возвращает размер файла без последней незаконченной строки (если лог еще пишется)"""
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        end = size
+        while end > 0:
+            start = max(end - block_size, 0)
+            file.seek(start)
+            block = file.read(end - start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def read_rows(logfile, offset=0, config=None):
+    """
+    Генератор. Возвращает строки лога (bytes), начиная с offset, и смещение конца каждой строки.
+    Для сжатых логов смещения считаются в распакованных данных
+    """
+    opener = get_opener(logfile.name, config)
+    with opener(logfile.path) as file:
+        if offset:
+            file.seek(offset)
+        for row in file:
+            offset += len(row)
+            yield row, offset
+
+
+def read_chunk(path, start, end):
+    """Генератор. Возвращает строки файла из диапазона байтов [start, end)"""
+    with open(path, "rb") as file:
+        file.seek(start)
+        pos = start
+        while pos < end:
+            line = file.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def follow_rows(path, stop, poll_interval=0.5):
+    """
+    Генератор. Следит за дописываемым логом (как tail -F) и возвращает его законченные строки.
+    Если новых строк нет, раз в poll_interval секунд возвращает FOLLOW_IDLE. Если лог
+    переименован при ротации или усечен, дочитывает старый файл, открывает лог заново
+    и возвращает FOLLOW_RESET. Останавливается, когда установлено событие stop
+    """
+    file = None
+    tail = b""
+    try:
+        while not stop.is_set():
+            if file is None:
+                try:
+                    file = open(path, "rb")
+                except FileNotFoundError:
+                    yield FOLLOW_IDLE
+                    stop.wait(poll_interval)
+                    continue
+            row = file.readline()
+            if row:
+                if not row.endswith(b"\n"):
+                    tail += row
+                    continue
+                yield tail + row if tail else row
+                tail = b""
+                continue
+
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            rotated = stat is None or stat.st_ino != os.fstat(file.fileno()).st_ino
+            truncated = stat is not None and not rotated and stat.st_size < file.tell()
+            if rotated or truncated:
+                file.close()
+                file = None
+                tail = b""
+                yield FOLLOW_RESET
+                continue
+            yield FOLLOW_IDLE
+            stop.wait(poll_interval)
+    finally:
+        if file is not None:
+            file.close()
+
+
+def get_errors_limit(log_size, errors_limit_perc):
+    """
+    Возвращает максимально возможное количество ошибок.
+    При превышении этого значения парсер остановит работу.
+    """
+    return int((log_size * errors_limit_perc) // 100)
+
+
+class ErrorBudgetExceeded(Exception):
+    """Ошибок разбора больше, чем допускает ERROR_LIMIT_PERC"""
+
+    def __init__(self, errors, rows, reason):
+        super().__init__(errors, rows, reason)
+        self.errors = errors
+        self.rows = rows
+        self.reason = reason
+
+    def __str__(self):
+        return f"{self.errors} of {self.rows} rows are broken ({self.reason})"
+
+
+def get_errors_lower_bound(errors, rows, z=ERROR_BUDGET_Z):
+    """Нижняя граница доверительного интервала Уилсона для доли ошибок errors / rows"""
+    if rows == 0:
+        return 0
+    share = errors / rows
+    z2 = z * z
+    center = share + z2 / (2 * rows)
+    margin = z * math.sqrt(share * (1 - share) / rows + z2 / (4 * rows * rows))
+    return (center - margin) / (1 + z2 / rows)
+
+
+class ErrorBudget:
+    """
+    Проверка бюджета ошибок во время разбора лога. Если известен размер size несжатого лога
+    в байтах, разбор прерывается, когда ошибок больше, чем допустимо для всего лога даже при
+    наибольшем возможном количестве его строк: прочитанные строки занимают не меньше
+    ERROR_BUDGET_MIN_ROW_SIZE байт каждая (ошибочные - не меньше байта), и столько же
+    занимает каждая из оставшихся. Такая проверка не отвергает ни одного лога, который
+    прошел бы проверку после полного разбора.
+
+    Статистические проверки включаются отдельно, потому что ошибочные строки обычно идут
+    группами, а не вразброс: разбор прерывается, если ошибок больше, чем допустимо для лога
+    с запасом ERROR_BUDGET_ROWS_MARGIN к оценке expected_rows количества его строк, или
+    (если rate_check) если нижняя граница доверительного интервала доли ошибок
+    выше ERROR_LIMIT_PERC
+    """
+
+    def __init__(
+        self,
+        errors_limit_perc,
+        size=None,
+        expected_rows=None,
+        rate_check=False,
+        min_rows=ERROR_BUDGET_MIN_ROWS,
+    ):
+        self.errors_limit_perc = errors_limit_perc
+        self.size = size
+        self.rate_check = rate_check
+        self.min_rows = min_rows
+        self.errors_limit = None
+        if expected_rows is not None:
+            max_rows = expected_rows * ERROR_BUDGET_ROWS_MARGIN
+            self.errors_limit = get_errors_limit(max_rows, errors_limit_perc)
+
+    def get_max_rows(self, rows, errors):
+        """Наибольшее возможное количество строк лога размером size после rows прочитанных"""
+        read_size = (rows - errors) * ERROR_BUDGET_MIN_ROW_SIZE + errors
+        return rows + max(self.size - read_size, 0) // ERROR_BUDGET_MIN_ROW_SIZE
+
+    def check(self, rows, errors):
+        """Бросает ErrorBudgetExceeded, если бюджет ошибок превышен"""
+        if self.size is not None:
+            max_rows = self.get_max_rows(rows, errors)
+            if errors > get_errors_limit(max_rows, self.errors_limit_perc):
+                raise ErrorBudgetExceeded(errors, rows, "log size")
+        if self.errors_limit is not None and errors > self.errors_limit:
+            raise ErrorBudgetExceeded(errors, rows, "estimated log size")
+        if not self.rate_check:
+            return
+        if rows < self.min_rows or errors * 100 <= rows * self.errors_limit_perc:
+            return
+        if get_errors_lower_bound(errors, rows) * 100 > self.errors_limit_perc:
+            raise ErrorBudgetExceeded(errors, rows, "error rate")
+
+
+def sample_rows(logfile, lines, config=None):
+    """
+    Генератор. Возвращает до lines строк лога для предварительной проверки: для несжатого
+    лога - из начала и из PREFLIGHT_WINDOWS - 1 случайных мест файла, для сжатого - из начала
+    """
+    if logfile.name.endswith(".gz"):
+        with get_opener(logfile.name, config)(logfile.path) as file:
+            yield from islice(file, lines)
+        return
+    size = os.path.getsize(logfile.path)
+    rnd = random.Random(size)
+    offsets = [0] + sorted(rnd.randrange(size) for _ in range(PREFLIGHT_WINDOWS - 1) if size)
+    window_lines = max(lines // PREFLIGHT_WINDOWS, 1)
+    end = 0
+    with open(logfile.path, "rb") as file:
+        for offset in offsets:
+            if offset < end:
+                offset = end
+            file.seek(offset)
+            if offset:
+                file.readline()
+            for row in islice(file, window_lines):
+                yield row
+            end = file.tell()
+
+
+def preflight_check(logfile, config):
+    """
+    Предварительная проверка выборки из ERROR_PREFLIGHT_LINES строк лога до полного разбора.
+    Бросает ErrorBudgetExceeded, если доля ошибок в выборке заведомо выше ERROR_LIMIT_PERC.
+    Возвращает средний размер строки в байтах или None, если выборка пуста
+    """
+    rows = errors = size = 0
+    for row in sample_rows(logfile, config["ERROR_PREFLIGHT_LINES"], config):
+        rows += 1
+        size += len(row)
+        if LOG_LINE_RE.match(row) is None:
+            errors += 1
+    if rows == 0:
+        return None
+    ErrorBudget(config["ERROR_LIMIT_PERC"], rate_check=True, min_rows=1).check(rows, errors)
+    return size / rows
+
+
+def get_error_budget(logfile, config, line_size=None, start=0, end=None):
+    """
+    Создает ErrorBudget для разбора лога (или его диапазона байтов [start, end)) либо
+    возвращает None, если проверять нечего: ERROR_EARLY_ABORT выключен или лог сжат, а
+    статистические проверки ERROR_STATISTICAL_ABORT выключены. Для несжатого лога с
+    включенными статистическими проверками количество строк оценивается по размеру и
+    среднему размеру строки line_size
+    """
+    config = config or {}
+    if not config.get("ERROR_EARLY_ABORT") or "ERROR_LIMIT_PERC" not in config:
+        return None
+    statistical = bool(config.get("ERROR_STATISTICAL_ABORT"))
+    size = expected_rows = None
+    if not logfile.name.endswith(".gz"):
+        end = os.path.getsize(logfile.path) if end is None else end
+        size = end - start
+        if line_size and statistical:
+            expected_rows = size / line_size
+    if size is None and not statistical:
+        return None
+    return ErrorBudget(config["ERROR_LIMIT_PERC"], size, expected_rows, statistical)
+
+
+def get_median(values):
+    """Возвращает медиану для списка значений"""
+    values.sort(reverse=True)
+    len_ = len(values)
+    if len_ % 2 == 0:
+        mid_index_1 = len_ // 2
+        mid_index_2 = mid_index_1 - 1
+        return (values[mid_index_1] + values[mid_index_2]) / 2
+    else:
+        mid_index = len_ // 2
+        return values[mid_index]
+
+
+def select_top(items, limit, key):
+    """
+    Возвращает limit элементов с наибольшим (с точностью до округления в отчете) значением key
+    в порядке убывания без полной сортировки. Если limit не задан, возвращает все элементы
+    """
+    if limit is None:
+        return items
+    return heapq.nlargest(limit, items, key=lambda item: round(key(item), ndigits=3))
+
+
+class QuantileSketch:
+    """
+    Объединяемый скетч квантилей с ограниченной относительной ошибкой (в духе DDSketch).
+    Значения раскладываются по логарифмическим корзинам, поэтому память зависит
+    от разброса значений, а не от их количества.
+    """
+
+    def __init__(self, relative_error=0.01):
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        """Добавляет значение в скетч"""
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        """Добавляет к скетчу другой скетч с той же точностью"""
+        if other.relative_error != self.relative_error:
+            raise ValueError("Can not merge sketches with different relative error")
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def quantile(self, q):
+        """Возвращает оценку квантиля q (0 <= q <= 1)"""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        cumulative = self.zero_count
+        if cumulative > rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            cumulative += self.buckets[index]
+            if cumulative > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class LatencyHistogram:
+    """
+    Гистограмма времени выполнения с фиксированными лог-линейными корзинами (в духе
+    HdrHistogram). Время считается в миллисекундах; каждый интервал [2^k, 2^(k+1)) делится
+    на LATENCY_SUB_BUCKETS равных корзин, поэтому относительная ошибка не больше
+    1 / LATENCY_SUB_BUCKETS. Счетчики хранятся в массиве int64, гистограммы объединяются
+    сложением счетчиков
+    """
+
+    def __init__(self):
+        self.counts = array.array("q")
+        self.count = 0
+
+    @staticmethod
+    def bucket(value):
+        """Номер корзины для времени value в секундах"""
+        ms = int(value * 1000 + 0.5)
+        if ms < LATENCY_SUB_BUCKETS:
+            return ms
+        shift = ms.bit_length() - LATENCY_SUB_BITS - 1
+        return (shift + 1) * LATENCY_SUB_BUCKETS + (ms >> shift) - LATENCY_SUB_BUCKETS
+
+    @staticmethod
+    def bounds(index):
+        """Границы корзины [lower, upper] в миллисекундах"""
+        if index < LATENCY_SUB_BUCKETS:
+            return index, index
+        shift = index // LATENCY_SUB_BUCKETS - 1
+        sub = index % LATENCY_SUB_BUCKETS + LATENCY_SUB_BUCKETS
+        return sub << shift, ((sub + 1) << shift) - 1
+
+    def add(self, value, count=1):
+        """Добавляет значение (в секундах) count раз"""
+        index = self.bucket(value)
+        if index >= len(self.counts):
+            self.counts.frombytes(bytes(self.counts.itemsize * (index + 1 - len(self.counts))))
+        self.counts[index] += count
+        self.count += count
+
+    def merge(self, other):
+        """Добавляет к гистограмме другую гистограмму"""
+        if len(other.counts) > len(self.counts):
+            missing = len(other.counts) - len(self.counts)
+            self.counts.frombytes(bytes(self.counts.itemsize * missing))
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """Оценка квантиля q (0 <= q <= 1) в секундах - середина корзины"""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative > rank:
+                lower, upper = self.bounds(index)
+                return (lower + upper) / 2000
+        return None
+
+    def to_json(self):
+        """Непустые корзины: нижняя граница в секундах и количество запросов"""
+        return [
+            [self.bounds(index)[0] / 1000, count]
+            for index, count in enumerate(self.counts)
+            if count
+        ]
+
+    def summary(self):
+        """Количество запросов, квантили и гистограмма для JSON-выгрузки"""
+        return {
+            "count": self.count,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "histogram": self.to_json(),
+        }
+
+
+def histogram_of(values):
+    """Гистограмма по списку значений времени или по скетчу квантилей"""
+    histogram = LatencyHistogram()
+    if isinstance(values, QuantileSketch):
+        if values.zero_count:
+            histogram.add(0, values.zero_count)
+        for index, count in values.buckets.items():
+            histogram.add(2 * values.gamma ** index / (values.gamma + 1), count)
+        return histogram
+    for value in values:
+        histogram.add(value)
+    return histogram
+
+
+class TimeSeries:
+    """
+    Гистограммы времени выполнения по минутам $time_local. Память зависит только
+    от количества минут, а не от количества строк; ряды объединяются по минутам
+    """
+
+    def __init__(self):
+        self.minutes = {}
+
+    def add(self, row, time):
+        """Учитывает запрос из строки лога row со временем выполнения time"""
+        bracket = row.find(b"[")
+        minute = row[bracket + 1:bracket + 18]
+        histogram = self.minutes.get(minute)
+        if histogram is None:
+            histogram = self.minutes[minute] = LatencyHistogram()
+        histogram.add(time)
+
+    def merge(self, other):
+        """Добавляет к ряду другой ряд"""
+        for minute, histogram in other.minutes.items():
+            if minute in self.minutes:
+                self.minutes[minute].merge(histogram)
+            else:
+                self.minutes[minute] = histogram
+        return self
+
+    def buckets(self, width=1):
+        """Гистограммы по интервалам в width минут, отсортированные по времени"""
+        result = {}
+        for minute, histogram in self.minutes.items():
+            try:
+                moment = parse_time_local(minute)
+            except ValueError:
+                continue
+            start = moment - timedelta(minutes=(moment.hour * 60 + moment.minute) % width)
+            if start in result:
+                result[start].merge(histogram)
+            else:
+                result[start] = LatencyHistogram().merge(histogram)
+        return sorted(result.items())
+
+
+def merge_timeseries(aggregate, other):
+    """Объединяет временные ряды двух агрегатов"""
+    if other.timeseries is None:
+        return
+    if aggregate.timeseries is None:
+        aggregate.timeseries = TimeSeries()
+    aggregate.timeseries.merge(other.timeseries)
+
+
+class RowFilter:
+    """
+    Фильтр строк лога, который проверяется по байтам строки до ее разбора: метод и начало URL
+    сравниваются на месте через startswith, класс статуса - по первым цифрам статуса,
+    и только для строк, прошедших остальные проверки, читается время запроса. Отброшенные
+    строки не разбираются и не попадают в агрегат. Строки, в которых не найдены нужные поля,
+    пропускаются дальше, чтобы разбор учел их как ошибки.
+
+    В rejected считается, сколько строк отбросила каждая проверка, в rows - сколько строк
+    проверено всего. Счетчики частичных фильтров складываются методом merge
+    """
+
+    checks = ("method", "url", "status", "time")
+
+    def __init__(self, url_prefixes=(), methods=(), statuses=(), min_time=None):
+        self.url_prefixes = tuple(prefix.encode("utf-8") for prefix in url_prefixes)
+        self.methods = tuple(method.upper().encode("ascii") + b" " for method in methods)
+        self.statuses = tuple(status.rstrip("xX").encode("ascii") for status in statuses)
+        self.min_time = min_time
+        self.rows = 0
+        self.rejected = dict.fromkeys(self.checks, 0)
+
+    def __call__(self, row):
+        """Проходит ли строка (bytes) фильтр"""
+        self.rows += 1
+        request = row.find(b'"') + 1
+        request_end = row.find(b'"', request)
+        url = row.find(b" ", request, request_end) + 1
+        if not request or request_end == -1 or not url:
+            return True
+        if self.methods and not row.startswith(self.methods, request):
+            self.rejected["method"] += 1
+            return False
+        if self.url_prefixes and not row.startswith(self.url_prefixes, url):
+            self.rejected["url"] += 1
+            return False
+        if self.statuses:
+            if not row.startswith(self.statuses, request_end + 2):
+                self.rejected["status"] += 1
+                return False
+        if self.min_time is not None:
+            end = len(row) - 1 if row.endswith(b"\n") else len(row)
+            try:
+                time = float(row[row.rfind(b" ", 0, end) + 1:end])
+            except ValueError:
+                return True
+            if time < self.min_time:
+                self.rejected["time"] += 1
+                return False
+        return True
+
+    def merge(self, other):
+        """Добавляет счетчики фильтра, проверявшего другую часть лога"""
+        self.rows += other.rows
+        for check, rejected in other.rejected.items():
+            self.rejected[check] += rejected
+        return self
+
+    def summary(self):
+        """Сколько строк проверено, пропущено и отброшено каждой включенной проверкой"""
+        enabled = {
+            "method": self.methods,
+            "url": self.url_prefixes,
+            "status": self.statuses,
+            "time": self.min_time is not None,
+        }
+        result = {"rows": self.rows, "passed": self.rows - sum(self.rejected.values())}
+        for check in self.checks:
+            if enabled[check]:
+                result[f"rejected_{check}"] = self.rejected[check]
+        return result
+
+
+def as_list(value):
+    """Значение настройки в виде списка: строка или число - список из одного элемента"""
+    if value is None:
+        return []
+    if isinstance(value, (str, int, float)):
+        return [value]
+    return list(value)
+
+
+def get_row_filter(config):
+    """Создает фильтр строк по настройкам FILTER_* или возвращает None, если фильтров нет"""
+    url_prefixes = as_list(config.get("FILTER_URL_PREFIX"))
+    methods = as_list(config.get("FILTER_METHODS"))
+    statuses = [str(status) for status in as_list(config.get("FILTER_STATUS"))]
+    min_time = config.get("FILTER_MIN_TIME")
+    if not url_prefixes and not methods and not statuses and min_time is None:
+        return None
+    return RowFilter(url_prefixes, methods, statuses, min_time)
+
+
+def merge_row_filter(aggregate, other):
+    """Объединяет счетчики фильтров строк двух агрегатов"""
+    if other.row_filter is None:
+        return
+    if aggregate.row_filter is None:
+        aggregate.row_filter = other.row_filter
+    else:
+        aggregate.row_filter.merge(other.row_filter)
+
+
+def parse_rows(rows, timeseries=None, row_filter=None):
+    """
+    Генератор. Разбирает строки лога; если задан timeseries, учитывает их во временном ряду.
+    Если задан row_filter, разбираются только прошедшие его строки
+    """
+    if row_filter is not None:
+        rows = filter(row_filter, rows)
+    if timeseries is None:
+        for row in rows:
+            yield parse_row(row)
+        return
+    add = timeseries.add
+    for row in rows:
+        url, time = parse_row(row)
+        if url is not None:
+            add(row, time)
+        yield url, time
+
+
+class UrlNormalizer:
+    """
+    Приводит URL к общему виду, чтобы уменьшить количество различных ключей: отбрасывает
+    строку запроса и применяет правила замены rules - пары (регулярное выражение, замена).
+    Результаты запоминаются в LRU-кэше, так как одни и те же URL встречаются многократно
+    """
+
+    def __init__(self, strip_query=False, rules=(), cache_size=65536):
+        self.strip_query = strip_query
+        self.rules = tuple((pattern, replacement) for pattern, replacement in rules)
+        self.cache_size = cache_size
+        self._compile()
+
+    def _compile(self):
+        self.compiled_rules = [(re.compile(pattern), repl) for pattern, repl in self.rules]
+        self.normalize = lru_cache(maxsize=self.cache_size)(self._normalize)
+
+    def _normalize(self, url):
+        if self.strip_query:
+            url = url.split("?", 1)[0]
+        for pattern, replacement in self.compiled_rules:
+            url = pattern.sub(replacement, url)
+        return url
+
+    def __call__(self, url):
+        return self.normalize(url)
+
+    def __getstate__(self):
+        return self.strip_query, self.rules, self.cache_size
+
+    def __setstate__(self, state):
+        self.strip_query, self.rules, self.cache_size = state
+        self._compile()
+
+
+class Aggregate:
+    """
+    Накопитель статистики по URL. Частичные агрегаты, посчитанные по разным частям лога,
+    объединяются методом merge.
+
+    Если задан sketch_error, вместо списка всех значений времени для каждого URL хранится
+    скетч квантилей с указанной относительной ошибкой, и память зависит только от
+    количества различных URL.
+
+    Если задан max_urls, хранится не больше max_urls URL. Когда места нет, вытесняется URL
+    с наименьшей оценкой суммарного времени, а новый URL наследует эту оценку как
+    погрешность (алгоритм Space-Saving). Так самые тяжелые URL остаются в агрегате и их
+    статистика точна, а общие суммы учитывают все запросы.
+    """
+
+    percentiles = (90, 95, 99)
+    timeseries = None
+    row_filter = None
+
+    def __init__(self, sketch_error=None, normalizer=None, max_urls=0):
+        self.sketch_error = sketch_error
+        self.normalizer = normalizer
+        self.max_urls = max_urls
+        self.ranks = []
+        self.evicted = 0
+        self.data = {}
+        self.count_total_req = 0
+        self.request_time_sum = 0
+        self.total_rows = 0
+        self.errors = 0
+
+    def add(self, url, time):
+        """Учитывает одну запись лога. Запись без URL считается ошибкой разбора"""
+        self.total_rows += 1
+        if url is None:
+            self.errors += 1
+            return
+        self.count_total_req += 1
+        self.request_time_sum += time
+        if self.normalizer is not None:
+            url = self.normalizer(url)
+        data_url = self.data.get(url)
+        if data_url is None:
+            data_url = self.data[url] = {
+                "count": 1, "time_sum": time, "time_max": time, "url": url
+            }
+            if self.max_urls:
+                error = self._evict() if len(self.data) > self.max_urls else 0
+                data_url["time_sum_error"] = error
+                heapq.heappush(self.ranks, (time + error, url))
+            if self.sketch_error is None:
+                data_url["values"] = [time]
+            else:
+                data_url["sketch"] = QuantileSketch(self.sketch_error)
+                data_url["sketch"].add(time)
+            return
+        data_url["count"] += 1
+        data_url["time_sum"] += time
+        if time > data_url["time_max"]:
+            data_url["time_max"] = time
+        if self.sketch_error is None:
+            data_url["values"].append(time)
+        else:
+            data_url["sketch"].add(time)
+
+    def _evict(self):
+        """
+        Вытесняет URL с наименьшей оценкой суммарного времени (с учетом погрешности)
+        и возвращает эту оценку. Оценки в куче могут устареть только в меньшую сторону,
+        поэтому устаревшие записи обновляются при извлечении
+        """
+        while True:
+            rank, url = heapq.heappop(self.ranks)
+            data_url = self.data.get(url)
+            if data_url is None:
+                continue
+            current = data_url["time_sum"] + data_url["time_sum_error"]
+            if current > rank:
+                heapq.heappush(self.ranks, (current, url))
+                continue
+            del self.data[url]
+            self.evicted += 1
+            return current
+
+    def merge(self, other):
+        """Добавляет к текущему агрегату агрегат, посчитанный по следующей части лога"""
+        self.count_total_req += other.count_total_req
+        self.request_time_sum += other.request_time_sum
+        self.total_rows += other.total_rows
+        self.errors += other.errors
+        self.evicted += other.evicted
+        merge_timeseries(self, other)
+        merge_row_filter(self, other)
+        for url, other_url in other.data.items():
+            data_url = self.data.get(url)
+            if data_url is None:
+                self.data[url] = other_url
+                continue
+            data_url["count"] += other_url["count"]
+            data_url["time_sum"] += other_url["time_sum"]
+            if self.max_urls:
+                data_url["time_sum_error"] += other_url["time_sum_error"]
+            if other_url["time_max"] > data_url["time_max"]:
+                data_url["time_max"] = other_url["time_max"]
+            if self.sketch_error is None:
+                data_url["values"].extend(other_url["values"])
+            else:
+                data_url["sketch"].merge(other_url["sketch"])
+        if self.max_urls:
+            self.ranks = [
+                (data_url["time_sum"] + data_url["time_sum_error"], url)
+                for url, data_url in self.data.items()
+            ]
+            heapq.heapify(self.ranks)
+            while len(self.data) > self.max_urls:
+                self._evict()
+        return self
+
+    def url_histogram(self, url):
+        """Гистограмма времени выполнения запросов к url или None, если его нет в агрегате"""
+        data_url = self.data.get(url)
+        if data_url is None:
+            return None
+        return histogram_of(data_url["sketch"] if self.sketch_error else data_url["values"])
+
+    def statistics(self, limit=None):
+        """
+        Возвращает строки отчета по каждому URL. Если задан limit, возвращает только limit
+        строк с наибольшим суммарным временем, отсортированных по его убыванию, и считает
+        производные поля только для них. Сам агрегат не изменяется
+        """
+        return list(self.iter_statistics(limit))
+
+    def iter_statistics(self, limit=None):
+        """
+        Генератор. То же, что statistics, но строки создаются по одной, поэтому полная
+        выгрузка не держит в памяти строки по всем URL сразу
+        """
+        for data_url in select_top(self.data.values(), limit, key=lambda v: v["time_sum"]):
+            val = {
+                "count": data_url["count"],
+                "time_sum": round(data_url["time_sum"], ndigits=3),
+                "time_max": data_url["time_max"],
+                "url": data_url["url"],
+            }
+            count_perc = (val["count"] / self.count_total_req) * 100
+            val["count_perc"] = round(count_perc, ndigits=3)
+            time_perc = (val["time_sum"] / self.request_time_sum) * 100
+            val["time_perc"] = round(time_perc, ndigits=3)
+            time_avg = val["time_sum"] / val["count"]
+            val["time_avg"] = round(time_avg, ndigits=3)
+            if self.sketch_error is None:
+                val["time_med"] = round(get_median(data_url["values"]), ndigits=3)
+            else:
+                sketch = data_url["sketch"]
+                val["time_med"] = round(sketch.quantile(0.5), ndigits=3)
+                for perc in self.percentiles:
+                    val[f"time_p{perc}"] = round(sketch.quantile(perc / 100), ndigits=3)
+            yield val
+
+
+class CompactAggregate:
+    """
+    Накопитель статистики по URL с компактным хранением. URL получают целочисленные
+    идентификаторы, счетчики хранятся в типизированных массивах, а значения времени
+    для каждого URL - в массиве double. Интерфейс совпадает с Aggregate.
+    """
+
+    percentiles = Aggregate.percentiles
+    timeseries = None
+    row_filter = None
+
+    def __init__(self, sketch_error=None, normalizer=None):
+        self.sketch_error = sketch_error
+        self.normalizer = normalizer
+        self.evicted = 0
+        self.ids = {}
+        self.urls = []
+        self.counts = array.array("Q")
+        self.time_sums = array.array("d")
+        self.time_maxes = array.array("d")
+        self.values = []
+        self.count_total_req = 0
+        self.request_time_sum = 0
+        self.total_rows = 0
+        self.errors = 0
+
+    def _new_id(self, url):
+        url_id = len(self.urls)
+        self.ids[url] = url_id
+        self.urls.append(url)
+        self.counts.append(0)
+        self.time_sums.append(0.0)
+        self.time_maxes.append(0.0)
+        if self.sketch_error is None:
+            self.values.append(array.array("d"))
+        else:
+            self.values.append(QuantileSketch(self.sketch_error))
+        return url_id
+
+    def add(self, url, time):
+        """Учитывает одну запись лога. Запись без URL считается ошибкой разбора"""
+        self.total_rows += 1
+        if url is None:
+            self.errors += 1
+            return
+        self.count_total_req += 1
+        self.request_time_sum += time
+        if self.normalizer is not None:
+            url = self.normalizer(url)
+        url_id = self.ids.get(url)
+        if url_id is None:
+            url_id = self._new_id(url)
+        self.counts[url_id] += 1
+        self.time_sums[url_id] += time
+        if time > self.time_maxes[url_id]:
+            self.time_maxes[url_id] = time
+        if self.sketch_error is None:
+            self.values[url_id].append(time)
+        else:
+            self.values[url_id].add(time)
+
+    def merge(self, other):
+        """Добавляет к текущему агрегату агрегат, посчитанный по следующей части лога"""
+        self.count_total_req += other.count_total_req
+        self.request_time_sum += other.request_time_sum
+        self.total_rows += other.total_rows
+        self.errors += other.errors
+        merge_timeseries(self, other)
+        merge_row_filter(self, other)
+        for other_id, url in enumerate(other.urls):
+            url_id = self.ids.get(url)
+            if url_id is None:
+                url_id = self._new_id(url)
+            self.counts[url_id] += other.counts[other_id]
+            self.time_sums[url_id] += other.time_sums[other_id]
+            if other.time_maxes[other_id] > self.time_maxes[url_id]:
+                self.time_maxes[url_id] = other.time_maxes[other_id]
+            if self.sketch_error is None:
+                self.values[url_id].extend(other.values[other_id])
+            else:
+                self.values[url_id].merge(other.values[other_id])
+        return self
+
+    def url_histogram(self, url):
+        """Гистограмма времени выполнения запросов к url или None, если его нет в агрегате"""
+        url_id = self.ids.get(url)
+        return None if url_id is None else histogram_of(self.values[url_id])
+
+    def statistics(self, limit=None):
+        """Возвращает строки отчета по каждому URL в том же виде, что и Aggregate"""
+        return list(self.iter_statistics(limit))
+
+    def iter_statistics(self, limit=None):
+        """Генератор. Строки отчета по одной, как в Aggregate.iter_statistics"""
+        url_ids = select_top(range(len(self.urls)), limit, key=self.time_sums.__getitem__)
+        for url_id in url_ids:
+            url = self.urls[url_id]
+            count = self.counts[url_id]
+            time_sum = round(self.time_sums[url_id], ndigits=3)
+            val = {
+                "count": count,
+                "time_sum": time_sum,
+                "time_max": self.time_maxes[url_id],
+                "url": url,
+                "count_perc": round((count / self.count_total_req) * 100, ndigits=3),
+                "time_perc": round((time_sum / self.request_time_sum) * 100, ndigits=3),
+                "time_avg": round(time_sum / count, ndigits=3),
+            }
+            values = self.values[url_id]
+            if self.sketch_error is None:
+                val["time_med"] = round(get_median(list(values)), ndigits=3)
+            else:
+                val["time_med"] = round(values.quantile(0.5), ndigits=3)
+                for perc in self.percentiles:
+                    val[f"time_p{perc}"] = round(values.quantile(perc / 100), ndigits=3)
+            yield val
+
+
+class NumpyAggregate:
+    """
+    Накопитель статистики по URL для больших логов. URL получают целочисленные идентификаторы,
+    а идентификаторы и значения времени копятся в плоских массивах. Статистика считается
+    векторно средствами NumPy: записи группируются по URL одной сортировкой (lexsort),
+    суммы и максимумы считаются через reduceat, медианы - по индексам в отсортированных
+    группах. Строки отчета совпадают со строками Aggregate
+    """
+
+    percentiles = Aggregate.percentiles
+    timeseries = None
+    row_filter = None
+
+    def __init__(self, sketch_error=None, normalizer=None):
+        if get_numpy() is None:
+            raise ValueError("NumPy is required for 'numpy' aggregate store")
+        if sketch_error is not None:
+            raise ValueError("QUANTILE_SKETCH is not supported by 'numpy' aggregate store")
+        self.sketch_error = None
+        self.normalizer = normalizer
+        self.evicted = 0
+        self.ids = {}
+        self.urls = []
+        self.url_ids = array.array("q")
+        self.times = array.array("d")
+        self.count_total_req = 0
+        self.request_time_sum = 0
+        self.total_rows = 0
+        self.errors = 0
+
+    def _url_id(self, url):
+        url_id = self.ids.get(url)
+        if url_id is None:
+            url_id = self.ids[url] = len(self.urls)
+            self.urls.append(url)
+        return url_id
+
+    def add(self, url, time):
+        """Учитывает одну запись лога. Запись без URL считается ошибкой разбора"""
+        self.total_rows += 1
+        if url is None:
+            self.errors += 1
+            return
+        self.count_total_req += 1
+        self.request_time_sum += time
+        if self.normalizer is not None:
+            url = self.normalizer(url)
+        self.url_ids.append(self._url_id(url))
+        self.times.append(time)
+
+    def merge(self, other):
+        """Добавляет к текущему агрегату агрегат, посчитанный по следующей части лога"""
+        self.count_total_req += other.count_total_req
+        self.request_time_sum += other.request_time_sum
+        self.total_rows += other.total_rows
+        self.errors += other.errors
+        merge_timeseries(self, other)
+        merge_row_filter(self, other)
+        if other.urls:
+            np = get_numpy()
+            mapping = np.array([self._url_id(url) for url in other.urls], dtype=np.int64)
+            other_ids = np.frombuffer(other.url_ids, dtype=np.int64)
+            self.url_ids.frombytes(mapping[other_ids].tobytes())
+            self.times.extend(other.times)
+        return self
+
+    def url_histogram(self, url):
+        """Гистограмма времени выполнения запросов к url или None, если его нет в агрегате"""
+        url_id = self.ids.get(url)
+        if url_id is None:
+            return None
+        np = get_numpy()
+        url_ids = np.frombuffer(self.url_ids, dtype=np.int64)
+        times = np.frombuffer(self.times, dtype=np.float64)
+        return histogram_of(times[url_ids == url_id].tolist())
+
+    def statistics(self, limit=None):
+        """Возвращает строки отчета по каждому URL в том же виде, что и Aggregate"""
+        return list(self.iter_statistics(limit))
+
+    def iter_statistics(self, limit=None):
+        """
+        Генератор. Строки отчета по одной, как в Aggregate.iter_statistics: векторно
+        считаются только числовые колонки, словари строк создаются по мере выдачи
+        """
+        if not self.times:
+            return
+        np = get_numpy()
+        url_ids = np.frombuffer(self.url_ids, dtype=np.int64)
+        times = np.frombuffer(self.times, dtype=np.float64)
+        order = np.lexsort((times, url_ids))
+        url_ids = url_ids[order]
+        times = times[order]
+        starts = np.flatnonzero(np.r_[True, url_ids[1:] != url_ids[:-1]])
+        counts = np.diff(np.r_[starts, len(times)])
+        group_ids = url_ids[starts]
+        time_sums = np.add.reduceat(times, starts)
+        time_maxes = np.maximum.reduceat(times, starts)
+
+        if limit is None:
+            groups = np.argsort(group_ids, kind="stable")
+        else:
+            # порядок как у select_top: по округленному суммарному времени, затем по порядку URL
+            groups = np.lexsort((group_ids, -np.round(time_sums, 3)))[:limit]
+        low = starts[groups] + (counts[groups] - 1) // 2
+        high = starts[groups] + counts[groups] // 2
+        medians = (times[low] + times[high]) / 2
+
+        rows = zip(
+            group_ids[groups].tolist(),
+            counts[groups].tolist(),
+            time_sums[groups].tolist(),
+            time_maxes[groups].tolist(),
+            medians.tolist(),
+        )
+        for url_id, count, time_sum, time_max, median in rows:
+            time_sum = round(time_sum, ndigits=3)
+            yield {
+                "count": count,
+                "time_sum": time_sum,
+                "time_max": time_max,
+                "url": self.urls[url_id],
+                "count_perc": round((count / self.count_total_req) * 100, ndigits=3),
+                "time_perc": round((time_sum / self.request_time_sum) * 100, ndigits=3),
+                "time_avg": round(time_sum / count, ndigits=3),
+                "time_med": round(median, ndigits=3),
+            }
+
+
+AGGREGATE_STORES = {"dict": Aggregate, "compact": CompactAggregate, "numpy": NumpyAggregate}
+
+
+def get_store_name(config):
+    """
+    Возвращает название хранилища агрегата. Для "auto" выбирается "numpy", если NumPy
+    установлен и не включены несовместимые с ним настройки, иначе "dict"
+    """
+    store_name = config.get("AGGREGATE_STORE", "auto")
+    if store_name != "auto":
+        return store_name
+    if config.get("QUANTILE_SKETCH") or config.get("MAX_URLS") or get_numpy() is None:
+        return "dict"
+    return "numpy"
+
+
+def get_url_normalizer(config):
+    """Создает нормализатор URL по настройкам или возвращает None, если нормализация не нужна"""
+    if not config.get("URL_STRIP_QUERY") and not config.get("URL_RULES"):
+        return None
+    return UrlNormalizer(
+        strip_query=config.get("URL_STRIP_QUERY", False),
+        rules=config.get("URL_RULES", ()),
+        cache_size=config.get("URL_CACHE_SIZE", 65536),
+    )
+
+
+def new_aggregate(config=None):
+    """Создает пустой агрегат с настройками из конфигурации"""
+    config = config or {}
+    sketch_error = config.get("QUANTILE_ERROR", 0.01) if config.get("QUANTILE_SKETCH") else None
+    store_name = get_store_name(config)
+    store = AGGREGATE_STORES[store_name]
+    kwargs = {"sketch_error": sketch_error, "normalizer": get_url_normalizer(config)}
+    if config.get("MAX_URLS"):
+        if store is not Aggregate:
+            raise ValueError(f"MAX_URLS is not supported by '{store_name}' aggregate store")
+        kwargs["max_urls"] = config["MAX_URLS"]
+    aggregate = store(**kwargs)
+    if config.get("TIMESERIES"):
+        aggregate.timeseries = TimeSeries()
+    aggregate.row_filter = get_row_filter(config)
+    return aggregate
+
+
+def aggregate_rows(aggregate, params, budget=None):
+    """Добавляет в агрегат пары (URL, время), проверяя бюджет ошибок budget"""
+    if budget is None:
+        for url, time in params:
+            aggregate.add(url, time)
+        return aggregate
+    for rows, (url, time) in enumerate(params, start=1):
+        aggregate.add(url, time)
+        if rows % ERROR_BUDGET_CHECK_ROWS == 0:
+            budget.check(aggregate.total_rows, aggregate.errors)
+    return aggregate
+
+
+def aggregate_chunk(path, start, end, config=None, budget=None):
+    """Считает частичный агрегат по диапазону байтов файла лога"""
+    aggregate = new_aggregate(config)
+    line_reader = aggregate.timeseries is not None or aggregate.row_filter is not None
+    if (config or {}).get("MMAP_READER") and not line_reader:
+        return aggregate_rows(aggregate, mmap_params(path, start, end), budget)
+    rows = read_chunk(path, start, end)
+    params = parse_rows(rows, aggregate.timeseries, aggregate.row_filter)
+    return aggregate_rows(aggregate, params, budget)
+
+
+def parallel_aggregate(
+    logfile,
+    workers,
+    config=None,
+    start=0,
+    end=None,
+    line_size=None,
+    chunks_count=None,
+    aggregate=None,
+    on_merge=None,
+):
+    """
+    Считает агрегат по несжатому логу, параллельно обрабатывая его части в пуле процессов.
+    Лог делится на chunks_count частей (по умолчанию - по числу процессов), которые
+    добавляются по порядку в агрегат aggregate (по умолчанию - новый); после каждой
+    вызывается on_merge(aggregate, offset), где offset - конец уже учтенной части лога.
+    Бюджет ошибок всего диапазона проверяется в каждой части отдельно (ошибок во всем
+    диапазоне не меньше, чем в части); если он превышен, необработанные части отменяются
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunks = get_chunks(logfile.path, chunks_count or workers, start, end)
+    budget = get_error_budget(logfile, config, line_size, start, end)
+    if aggregate is None:
+        aggregate = new_aggregate(config)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                aggregate_chunk,
+                logfile.path,
+                chunk_start,
+                chunk_end,
+                config,
+                budget,
+            )
+            for chunk_start, chunk_end in chunks
+        ]
+        try:
+            for future, (_, chunk_end) in zip(futures, chunks):
+                aggregate.merge(future.result())
+                if on_merge is not None:
+                    on_merge(aggregate, chunk_end)
+        except ErrorBudgetExceeded:
+            executor.shutdown(cancel_futures=True)
+            raise
+    return aggregate
+
+
+async def read_source(logfile, batches, config=None):
+    """
+    Читает лог пачками по SOURCE_BATCH_LINES строк в потоке исполнителя и кладет их в очередь.
+    Если очередь заполнена, чтение приостанавливается, пока разбор не освободит место
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    opener = get_opener(logfile.name, config)
+    file = await loop.run_in_executor(None, opener, logfile.path)
+    rows = iter(file)
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, list, islice(rows, SOURCE_BATCH_LINES))
+            if not batch:
+                break
+            await batches.put(batch)
+    finally:
+        await loop.run_in_executor(None, file.close)
+
+
+async def aggregate_batches(batches, aggregate, sources_count, budget=None):
+    """
+    Разбирает строки из очереди, пока все источники не закончатся (None от каждого).
+    После каждой пачки проверяется бюджет ошибок budget
+    """
+    finished = 0
+    while finished < sources_count:
+        batch = await batches.get()
+        if batch is None:
+            finished += 1
+            continue
+        for url, time in parse_rows(batch, aggregate.timeseries, aggregate.row_filter):
+            aggregate.add(url, time)
+        if budget is not None:
+            budget.check(aggregate.total_rows, aggregate.errors)
+    return aggregate
+
+
+async def aggregate_sources_async(logfiles, config=None):
+    """Одновременно читает несколько логов и объединяет их в один агрегат"""
+    import asyncio
+
+    config = config or {}
+    batches = asyncio.Queue(maxsize=config.get("SOURCE_QUEUE_SIZE", 8))
+
+    async def read(logfile):
+        # конец источника отмечается только при успешном чтении: отмененный читатель не должен
+        # ждать места в очереди, которую уже никто не разбирает
+        await read_source(logfile, batches, config)
+        await batches.put(None)
+
+    budget = None
+    if config.get("ERROR_EARLY_ABORT") and "ERROR_LIMIT_PERC" in config:
+        statistical = bool(config.get("ERROR_STATISTICAL_ABORT"))
+        size = None
+        if not any(logfile.name.endswith(".gz") for logfile in logfiles):
+            size = sum(os.path.getsize(logfile.path) for logfile in logfiles)
+        if size is not None or statistical:
+            budget = ErrorBudget(config["ERROR_LIMIT_PERC"], size, rate_check=statistical)
+    consumer = asyncio.create_task(
+        aggregate_batches(batches, new_aggregate(config), len(logfiles), budget)
+    )
+    readers = [asyncio.create_task(read(logfile)) for logfile in logfiles]
+    tasks = (consumer, *readers)
+    try:
+        # ошибка разбора останавливает и чтение: иначе читатели ждали бы места в очереди
+        aggregate, *_ = await asyncio.gather(*tasks)
+        return aggregate
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def aggregate_sources(logfiles, config=None):
+    """Агрегат по нескольким логам (например, с разных серверов за один день)"""
+    import asyncio
+
+    return asyncio.run(aggregate_sources_async(logfiles, config))
+
+
+def get_checkpoint_path(logfile, report_dir):
+    """Возвращает путь к файлу контрольной точки для отчета по логу"""
+    report_name = generate_report_name(logfile.date)
+    return os.path.join(report_dir, f".{report_name}.checkpoint")
+
+
+def is_log_rotated(logfile):
+    """Лог больше не растет: он сжат или в его папке уже есть лог за более поздний день"""
+    if logfile.name.endswith(".gz"):
+        return True
+    log_dir = os.path.dirname(logfile.path)
+    return any(other.date > logfile.date for other, _ in scan_log_dir(log_dir))
+
+
+def remove_checkpoints(logfile, report_dir):
+    """
+    Удаляет контрольные точки, которые больше не понадобятся, после записи отчета по логу:
+    его собственную, если лог больше не растет, и точки за более ранние дни, отчеты за
+    которые уже есть
+    """
+    try:
+        entries = list(os.scandir(report_dir))
+    except FileNotFoundError:
+        return
+    report_dates = get_report_dates(report_dir)
+    for entry in entries:
+        match = CHECKPOINT_NAME_RE.match(entry.name)
+        if match is None:
+            continue
+        try:
+            report_date = datetime.strptime(match.group("date"), "%Y.%m.%d").date()
+        except ValueError:
+            continue
+        if report_date == logfile.date:
+            stale = is_log_rotated(logfile)
+        else:
+            stale = report_date < logfile.date and report_date in report_dates
+        if stale:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def get_aggregate_settings(config):
+    """Настройки, от которых зависит формат агрегата в контрольной точке"""
+    return (
+        get_store_name(config),
+        bool(config.get("QUANTILE_SKETCH")),
+        config.get("QUANTILE_ERROR", 0.01),
+        bool(config.get("URL_STRIP_QUERY")),
+        tuple(tuple(rule) for rule in config.get("URL_RULES", ())),
+        config.get("MAX_URLS", 0),
+        bool(config.get("TIMESERIES")),
+        tuple(map(str, as_list(config.get("FILTER_URL_PREFIX")))),
+        tuple(map(str, as_list(config.get("FILTER_METHODS")))),
+        tuple(map(str, as_list(config.get("FILTER_STATUS")))),
+        config.get("FILTER_MIN_TIME"),
+    )
+
+
+def save_checkpoint(path, checkpoint):
+    """Атомарно записывает контрольную точку: сначала заголовок, затем агрегат"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        pickle.dump(checkpoint._replace(aggregate=None), file, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(checkpoint.aggregate, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, logfile, config, with_aggregate=True):
+    """
+    Читает контрольную точку. Возвращает None, если ее нет, она повреждена или не подходит
+    к текущему файлу лога и настройкам
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as file:
+            checkpoint = pickle.load(file)
+            if checkpoint.path != logfile.path:
+                return None
+            if checkpoint.settings != get_aggregate_settings(config):
+                return None
+            size = os.path.getsize(logfile.path)
+            is_gz = logfile.name.endswith(".gz")
+            if size < checkpoint.size or (is_gz and size != checkpoint.size):
+                return None
+            if with_aggregate:
+                checkpoint = checkpoint._replace(aggregate=pickle.load(file))
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, TypeError) as exc:
+        logging.info(f"Can not load checkpoint {path}: {exc}")
+        return None
+    return checkpoint
+
+
+def has_unprocessed_rows(logfile, config):
+    """Проверяет, дописаны ли в лог строки после последней контрольной точки"""
+    if not config.get("CHECKPOINT_EVERY"):
+        return False
+    path = get_checkpoint_path(logfile, config["REPORT_DIR"])
+    checkpoint = load_checkpoint(path, logfile, config, with_aggregate=False)
+    return checkpoint is not None and os.path.getsize(logfile.path) > checkpoint.size
+
+
+def checkpointed_aggregate(logfile, config, line_size=None):
+    """
+    Считает агрегат, периодически сохраняя контрольные точки (каждые CHECKPOINT_EVERY строк).
+    Если есть подходящая контрольная точка, обработка продолжается с сохраненного смещения.
+    Незаконченная последняя строка растущего лога не обрабатывается; у ротированного лога
+    (см. is_log_rotated) последняя строка без перевода строки обрабатывается как обычная.
+    """
+    report_dir = config["REPORT_DIR"]
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    path = get_checkpoint_path(logfile, report_dir)
+    checkpoint = load_checkpoint(path, logfile, config)
+    if checkpoint is None:
+        checkpoint = Checkpoint(
+            path=logfile.path,
+            size=0,
+            offset=0,
+            settings=get_aggregate_settings(config),
+            aggregate=new_aggregate(config),
+        )
+    else:
+        logging.info(f"Resume from checkpoint at offset {checkpoint.offset}")
+
+    aggregate = checkpoint.aggregate
+    growing = not is_log_rotated(logfile)
+    workers = config.get("WORKERS", 1)
+    if workers > 1 and not logfile.name.endswith(".gz"):
+        end = get_complete_size(logfile.path) if growing else os.path.getsize(logfile.path)
+
+        def save_merged(merged, offset):
+            save_checkpoint(path, checkpoint._replace(size=end, offset=offset))
+
+        parallel_aggregate(
+            logfile,
+            workers,
+            config,
+            checkpoint.offset,
+            end,
+            line_size,
+            chunks_count=workers * CHECKPOINT_CHUNKS_PER_WORKER,
+            aggregate=aggregate,
+            on_merge=save_merged,
+        )
+        checkpoint = checkpoint._replace(size=end, offset=end)
+    else:
+        every = config["CHECKPOINT_EVERY"]
+        size = os.path.getsize(logfile.path)
+        offset = checkpoint.offset
+        budget = get_error_budget(logfile, config, line_size)
+        row_filter = aggregate.row_filter
+        for lines, (row, end) in enumerate(read_rows(logfile, offset, config), start=1):
+            if growing and not row.endswith(b"\n"):
+                break
+            if row_filter is None or row_filter(row):
+                url, time = parse_row(row)
+                aggregate.add(url, time)
+                if aggregate.timeseries is not None and url is not None:
+                    aggregate.timeseries.add(row, time)
+            offset = end
+            if lines % every == 0:
+                save_checkpoint(path, checkpoint._replace(size=size, offset=offset))
+            if budget is not None and lines % ERROR_BUDGET_CHECK_ROWS == 0:
+                budget.check(aggregate.total_rows, aggregate.errors)
+        checkpoint = checkpoint._replace(size=os.path.getsize(logfile.path), offset=offset)
+
+    save_checkpoint(path, checkpoint)
+    return aggregate
+
+
+def parse_aggregate(logfile, config=None):
+    """
+    Разбирает лог и возвращает агрегат статистики по URL. Если включен ERROR_EARLY_ABORT,
+    при разборе проверяется бюджет ошибок, а если включен и ERROR_STATISTICAL_ABORT - сначала
+    еще и выборка строк лога; при превышении бюджета бросается ErrorBudgetExceeded,
+    не дожидаясь конца лога
+    """
+    config = config or {}
+    line_size = None
+    statistical = config.get("ERROR_EARLY_ABORT") and config.get("ERROR_STATISTICAL_ABORT")
+    if statistical and config.get("ERROR_PREFLIGHT_LINES"):
+        line_size = preflight_check(logfile, config)
+    workers = config.get("WORKERS", 1)
+    if config.get("CHECKPOINT_EVERY"):
+        return checkpointed_aggregate(logfile, config, line_size)
+    if workers > 1 and not logfile.name.endswith(".gz"):
+        return parallel_aggregate(logfile, workers, config, line_size=line_size)
+    budget = get_error_budget(logfile, config, line_size)
+    index_dir = config.get("TIME_INDEX_DIR")
+    aggregate = new_aggregate(config)
+    if index_dir is None or config.get("MMAP_READER"):
+        params = request_params(logfile, config, aggregate.timeseries, aggregate.row_filter)
+        return aggregate_rows(aggregate, params, budget)
+    # индекс по времени строится попутно, за тот же проход по логу
+    builder = TimeIndexBuilder()
+    rows = indexed_rows(logfile, builder, config)
+    if aggregate.timeseries is None and aggregate.row_filter is None:
+        params = map(parse_row, rows)
+    else:
+        params = parse_rows(rows, aggregate.timeseries, aggregate.row_filter)
+    aggregate = aggregate_rows(aggregate, params, budget)
+    save_time_index(index_dir, logfile, builder.build(logfile))
+    return aggregate
+
+
+def get_cache_path(cache_dir, log_date):
+    """Возвращает путь к файлу кэша агрегата за день"""
+    return os.path.join(cache_dir, f"aggregate-{log_date:%Y%m%d}.bin")
+
+
+def get_sketch_config(config):
+    """
+    Копия настроек с включенным QUANTILE_SKETCH. Хранилище "numpy" скетчи не поддерживает,
+    поэтому вместо него выбирается "dict"
+    """
+    sketch_config = dict(config, QUANTILE_SKETCH=True)
+    if get_store_name(config) == "numpy":
+        sketch_config["AGGREGATE_STORE"] = "dict"
+    return sketch_config
+
+
+def get_cache_config(config):
+    """
+    Настройки для агрегатов, которые сохраняются в кэш или объединяются за диапазон дат:
+    вместо всех значений времени хранятся скетчи квантилей (QUANTILE_SKETCH), поэтому размер
+    агрегата зависит от количества URL, а не строк лога
+    """
+    return get_sketch_config(config)
+
 
-ERROR_EXIT_STATUS = 1
-LogFile = namedtuple("LogFile", ["name", "path", "date"])
+def get_cache_entry(logfile, config):
+    """Заголовок записи кэша: по нему проверяется, что лог не изменился с момента записи"""
+    stat = os.stat(logfile.path)
+    return CacheEntry(
+        date=logfile.date,
+        path=logfile.path,
+        size=stat.st_size,
+        mtime=stat.st_mtime_ns,
+        settings=get_aggregate_settings(config),
+    )
 
-parser = argparse.ArgumentParser(description="Nginx logs analyzer")
-parser.add_argument("--config", default="./config.json", help="Path to json config file")
-args = parser.parse_args()
-config_path = args.config
 
+def save_cached_aggregate(cache_dir, entry, aggregate):
+    """Атомарно записывает агрегат за день в кэш: заголовок и сжатый агрегат"""
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    path = get_cache_path(cache_dir, entry.date)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        pickle.dump(entry, file, pickle.HIGHEST_PROTOCOL)
+        file.write(zlib.compress(pickle.dumps(aggregate, pickle.HIGHEST_PROTOCOL), 1))
+    os.replace(tmp_path, path)
 
-def get_latest_log_file(log_dir):
-    """Просматривает папку с логами и находит самый свежий"""
-    lf = LogFile(name=None, path=None, date=None)
-    if not os.path.exists(log_dir):
+
+def load_cached_aggregate(cache_dir, log_date, config, expected=None):
+    """
+    Читает агрегат за день из кэша. Если передан ожидаемый заголовок expected, запись
+    используется только если лог с тех пор не изменился. Возвращает None, если подходящей
+    записи нет
+    """
+    path = get_cache_path(cache_dir, log_date)
+    if not os.path.exists(path):
         return None
+    try:
+        with open(path, "rb") as file:
+            entry = pickle.load(file)
+            if entry.settings != get_aggregate_settings(config):
+                return None
+            if expected is not None and entry != expected:
+                return None
+            aggregate = pickle.loads(zlib.decompress(file.read()))
+    except (OSError, EOFError, zlib.error, pickle.UnpicklingError, AttributeError) as exc:
+        logging.info(f"Can not load cached aggregate {path}: {exc}")
+        return None
+    os.utime(path)
+    return aggregate
 
-    for name in os.listdir(log_dir):
-        path = os.path.join(log_dir, name)
-        if not os.path.isfile(path):
-            continue
 
-        match = re.match(r"^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$", name)
-        if match is None:
-            continue
+def evict_cache(cache_dir, max_age_days=None, max_size_mb=None):
+    """
+    Удаляет из кэша записи, которые не использовались дольше max_age_days дней, а затем самые
+    давно использованные записи, пока размер кэша больше max_size_mb
+    """
+    if not os.path.exists(cache_dir):
+        return
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if CACHE_NAME_RE.match(entry.name):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    if max_age_days is not None:
+        oldest = datetime.now().timestamp() - max_age_days * 24 * 60 * 60
+        while entries and entries[0][0] < oldest:
+            remove_cache_file(entries.pop(0)[2])
+    if max_size_mb is not None:
+        total_size = sum(size for _, size, _ in entries)
+        while entries and total_size > max_size_mb * 2 ** 20:
+            _, size, path = entries.pop(0)
+            remove_cache_file(path)
+            total_size -= size
 
-        date_str, gz = match.groups()
-        try:
-            date = datetime.strptime(date_str, "%Y%m%d").date()
-        except ValueError:
-            loging.info(f"Incorrect date format in log name: {name}")
-            continue
-        if lf.name is None:
-            lf = LogFile(name=name, path=path, date=date)
-            continue
 
-        if date > lf.date:
-            lf = LogFile(name=name, path=path, date=date)
+def remove_cache_file(path):
+    """Удаляет файл кэша; его уже могла удалить соседняя задача BACKFILL"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
-    if lf.name is None:
-        return None
 
-    return lf
+def build_aggregate(logfile, config=None):
+    """
+    Возвращает агрегат статистики по URL для лога. Если задан CACHE_DIR, агрегат со скетчами
+    квантилей берется из кэша, а при его отсутствии считается и сохраняется в кэш
+    """
+    cache_dir = (config or {}).get("CACHE_DIR")
+    if not cache_dir or logfile.date is None:
+        return parse_aggregate(logfile, config)
+    config = get_cache_config(config)
+    entry = get_cache_entry(logfile, config)
+    aggregate = load_cached_aggregate(cache_dir, logfile.date, config, entry)
+    if aggregate is not None:
+        logging.info(f"Use cached aggregate for {logfile.name}")
+        return aggregate
+    aggregate = parse_aggregate(logfile, config)
+    save_cached_aggregate(cache_dir, entry, aggregate)
+    evict_cache(cache_dir, config.get("CACHE_MAX_AGE_DAYS"), config.get("CACHE_MAX_SIZE_MB"))
+    return aggregate
+
+
+def build_range_aggregate(config, date_from, date_to):
+    """
+    Объединяет агрегаты за дни из диапазона [date_from, date_to]. Агрегаты берутся из кэша;
+    лог разбирается, только если для его дня нет актуальной записи в кэше. Записи кэша
+    за дни, логов которых уже нет, тоже используются. Агрегаты всегда хранят скетчи
+    квантилей, а не все значения времени. Бюджет ошибок проверяется только для всего
+    диапазона, поэтому разбор отдельных дней досрочно не прерывается
+    """
+    config = dict(get_cache_config(config), ERROR_EARLY_ABORT=False)
+    index_file = config.get("LOG_INDEX_FILE")
+    if index_file is not None:
+        logfiles = LogIndex(index_file).between(config["LOG_DIR"], date_from, date_to)
+    else:
+        logfiles = [
+            logfile
+            for logfile in get_log_files(config["LOG_DIR"])
+            if date_from <= logfile.date <= date_to
+        ]
+    logfiles = {logfile.date: logfile for logfile in logfiles}
+    cache_dir = config.get("CACHE_DIR")
+    cached_dates = set()
+    if cache_dir and os.path.exists(cache_dir):
+        for name in os.listdir(cache_dir):
+            match = CACHE_NAME_RE.match(name)
+            if match is None:
+                continue
+            try:
+                log_date = datetime.strptime(match.group("date"), "%Y%m%d").date()
+            except ValueError:
+                continue
+            if date_from <= log_date <= date_to:
+                cached_dates.add(log_date)
+
+    aggregate = new_aggregate(config)
+    for log_date in sorted(set(logfiles) | cached_dates):
+        logfile = logfiles.get(log_date)
+        if logfile is not None:
+            day_aggregate = build_aggregate(logfile, config)
+        else:
+            day_aggregate = load_cached_aggregate(cache_dir, log_date, config)
+            if day_aggregate is None:
+                continue
+        aggregate.merge(day_aggregate)
+    return aggregate
 
 
-def get_opener(logname):
-    """Объект для открытия файла лога"""
-    return partial(gzip.open, mode="rt") if logname.endswith(".gz") else open
+@lru_cache(maxsize=4096)
+def parse_time_local(value):
+    """Разбирает время $time_local (без часового пояса) с точностью до минуты или секунды"""
+    value = value.decode("ascii")
+    fmt = "%d/%b/%Y:%H:%M:%S" if value.count(":") == 3 else "%d/%b/%Y:%H:%M"
+    return datetime.strptime(value, fmt)
 
 
-def request_params(logfile):
+def read_gzip_rows(path, offset=0, uoffset=0, members=None, block_size=1 << 20):
     """
-    Генератор. На каждой итерации возвращает URL и время выполнения для каждой записи из файла лога
+    Генератор. Читает gzip-файл с границы члена offset (uoffset - смещение этого места
+    в распакованных данных) и возвращает строки и смещения их концов в распакованных данных.
+    Если передан список members, в него добавляются точки перезапуска: пары (смещение начала
+    члена в файле, смещение в распакованных данных)
     """
-    opener = get_opener(logfile.name)
-    with opener(logfile.path, encoding="utf-8") as file:
+    with open(path, "rb") as file:
+        file.seek(offset)
+        decompressor = zlib.decompressobj(wbits=31)
+        if members is not None:
+            members.append((offset, uoffset))
+        tail = b""
+        started = False
+        while True:
+            raw = file.read(block_size)
+            if not raw:
+                break
+            while raw:
+                started = True
+                data = tail + decompressor.decompress(raw)
+                lines = data.split(b"\n")
+                tail = lines.pop()
+                for line in lines:
+                    uoffset += len(line) + 1
+                    yield line + b"\n", uoffset
+                offset += len(raw) - len(decompressor.unused_data)
+                raw = decompressor.unused_data
+                if decompressor.eof:
+                    decompressor = zlib.decompressobj(wbits=31)
+                    started = False
+                    if members is not None:
+                        members.append((offset, uoffset + len(tail)))
+        if started:
+            raise EOFError(f"Truncated gzip member in {path}")
+        if members is not None and members[-1][0] == offset:
+            members.pop()
+        if tail:
+            yield tail, uoffset + len(tail)
+
+
+def indexed_rows(logfile, builder, config=None):
+    """Генератор. Возвращает строки лога, попутно добавляя их смещения в индекс по времени"""
+    add = builder.add
+    start = 0
+    if logfile.name.endswith(".gz"):
+        for row, end in read_gzip_rows(logfile.path, members=builder.members):
+            add(row, start, end)
+            start = end
+            yield row
+        return
+    with open(logfile.path, "rb") as file:
         for row in file:
-            url = time = None
-            request_url = re.search(r"\"(GET|POST|PUT|HEAD|OPTIONS)\s\S+", row)
-            if request_url is not None:
-                request_time = re.search(r"\s\d+\.\d+\s", row)
-                time = float(request_time.group())
-                url = request_url.group().split()[-1]
+            end = start + len(row)
+            add(row, start, end)
+            start = end
+            yield row
+
+
+class TimeIndexBuilder:
+    """
+    Строит индекс лога по времени: для каждой минуты $time_local - смещение начала первой
+    и конца последней строки с этим временем. Строки за минуту не обязаны идти подряд
+    """
+
+    def __init__(self):
+        self.members = []
+        self.offsets = {}
+
+    def add(self, row, start, end):
+        # минута $time_local - 17 символов после "[", формат проверяется при построении индекса
+        bracket = row.find(b"[")
+        if bracket == -1:
+            return
+        minute = row[bracket + 1:bracket + 18]
+        offsets = self.offsets.get(minute)
+        if offsets is None:
+            self.offsets[minute] = [start, end]
+        else:
+            offsets[1] = end
+
+    def build(self, logfile):
+        stat = os.stat(logfile.path)
+        buckets = {}
+        for minute, (start, end) in self.offsets.items():
+            try:
+                key = parse_time_local(minute)
+            except ValueError:
+                continue
+            if key in buckets:
+                start = min(start, buckets[key][0])
+                end = max(end, buckets[key][1])
+            buckets[key] = (start, end)
+        return TimeIndex(
+            path=logfile.path,
+            size=stat.st_size,
+            mtime=stat.st_mtime_ns,
+            members=self.members or [(0, 0)],
+            buckets=buckets,
+        )
+
+
+def get_time_index_path(index_dir, logfile):
+    """Возвращает путь к индексу лога по времени"""
+    return os.path.join(index_dir, f"{logfile.name}.tindex")
+
+
+def save_time_index(index_dir, logfile, index):
+    """Атомарно записывает индекс лога по времени"""
+    with atomic_write(get_time_index_path(index_dir, logfile), "wb") as file:
+        pickle.dump(index, file, pickle.HIGHEST_PROTOCOL)
+
+
+def load_time_index(index_dir, logfile):
+    """Читает индекс лога по времени. Возвращает None, если индекса нет или лог изменился"""
+    path = get_time_index_path(index_dir, logfile)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as file:
+            index = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError) as exc:
+        logging.info(f"Time index {path} is ignored: {exc}")
+        return None
+    stat = os.stat(logfile.path)
+    if not isinstance(index, TimeIndex) or (index.size, index.mtime) != (
+        stat.st_size,
+        stat.st_mtime_ns,
+    ):
+        return None
+    return index
+
+
+def build_time_index(logfile, config=None):
+    """Строит индекс лога по времени отдельным проходом по логу"""
+    builder = TimeIndexBuilder()
+    for _ in indexed_rows(logfile, builder, config):
+        pass
+    return builder.build(logfile)
+
+
+def get_time_index(logfile, config):
+    """Возвращает индекс лога по времени из TIME_INDEX_DIR, при необходимости строя его"""
+    index_dir = config.get("TIME_INDEX_DIR")
+    index = load_time_index(index_dir, logfile) if index_dir else None
+    if index is None:
+        logging.info(f"Build time index for {logfile.name}")
+        index = build_time_index(logfile, config)
+        if index_dir:
+            save_time_index(index_dir, logfile, index)
+    return index
+
+
+def get_window_range(index, time_from, time_to):
+    """
+    Диапазон смещений [start, end), в котором лежат все строки со временем из окна
+    [time_from, time_to). Возвращает None, если таких строк нет
+    """
+    minute_from = time_from.replace(second=0, microsecond=0)
+    ranges = [
+        offsets
+        for minute, offsets in index.buckets.items()
+        if minute_from <= minute < time_to
+    ]
+    if not ranges:
+        return None
+    return min(start for start, _ in ranges), max(end for _, end in ranges)
+
+
+def window_rows(logfile, index, start, end, config=None):
+    """
+    Генератор. Возвращает строки лога из диапазона смещений [start, end). Несжатый лог
+    читается с нужного места, сжатый - распаковывается с ближайшей предшествующей точки
+    перезапуска (границы члена gzip)
+    """
+    if not logfile.name.endswith(".gz"):
+        yield from read_chunk(logfile.path, start, end)
+        return
+    offset, uoffset = max(member for member in index.members if member[1] <= start)
+    row_start = uoffset
+    for row, row_end in read_gzip_rows(logfile.path, offset, uoffset):
+        if row_start >= end:
+            break
+        if row_start >= start:
+            yield row
+        row_start = row_end
+
+
+def aggregate_time_window(logfile, time_from, time_to, config=None):
+    """
+    Считает агрегат по запросам лога со временем $time_local из окна [time_from, time_to),
+    читая только ту часть лога, на которую указывает индекс по времени
+    """
+    config = config or {}
+    aggregate = new_aggregate(config)
+    index = get_time_index(logfile, config)
+    window = get_window_range(index, time_from, time_to)
+    if window is None:
+        return aggregate
+    inside = {}
+    for row in window_rows(logfile, index, window[0], window[1], config):
+        bracket = row.find(b"[")
+        minute = row[bracket + 1:bracket + 18]
+        state = inside.get(minute)
+        if state is None:
+            state = inside[minute] = get_minute_state(minute, time_from, time_to)
+        if state is None:
+            # минута на границе окна: время сравнивается с точностью до секунды
+            match = TIME_LOCAL_RE.search(row)
+            if match is None:
+                continue
+            time_local = parse_time_local(match.group("minute") + b":" + match.group("second"))
+            state = time_from <= time_local < time_to
+        if state and (aggregate.row_filter is None or aggregate.row_filter(row)):
+            url, time = parse_row(row)
+            aggregate.add(url, time)
+            if aggregate.timeseries is not None and url is not None:
+                aggregate.timeseries.add(row, time)
+    return aggregate
+
+
+def get_minute_state(minute, time_from, time_to):
+    """
+    Попадает ли минута $time_local в окно [time_from, time_to) целиком (True), не попадает
+    совсем (False) или лежит на его границе (None)
+    """
+    try:
+        start = parse_time_local(minute)
+    except ValueError:
+        return False
+    if start >= time_from and start + timedelta(minutes=1) <= time_to:
+        return True
+    if start + timedelta(minutes=1) <= time_from or start >= time_to:
+        return False
+    return None
+
+
+class SampleEstimator:
+    """
+    Оценки по случайной выборке блоков лога (кластерная выборка без возвращения из
+    total_blocks блоков). Для каждого URL по блокам копятся суммы c, c², c·C, t, t², t·T,
+    где c и t - количество и суммарное время запросов к URL в блоке, а C и T - всех
+    запросов блока. По ним считаются доверительные интервалы отношений count_perc и time_perc
+    """
+
+    def __init__(self, total_blocks, normalizer=None):
+        self.total_blocks = total_blocks
+        self.normalizer = normalizer
+        self.blocks = 0
+        self.count_total = 0
+        self.time_total = 0
+        self.count_squares = 0
+        self.time_squares = 0
+        self.moments = {}
+
+    @property
+    def scale(self):
+        """Во сколько раз весь лог больше выборки"""
+        return self.total_blocks / self.blocks if self.blocks else 1
+
+    def add_block(self, params):
+        """Учитывает пары (URL, время) одного блока выборки"""
+        block = {}
+        count_total = time_total = 0
+        for url, time in params:
+            if url is None:
+                continue
+            if self.normalizer is not None:
+                url = self.normalizer(url)
+            counts = block.get(url)
+            if counts is None:
+                block[url] = [1, time]
             else:
-                logging.info(f"Can not find url in request: {row.rstrip()}")
-            yield url, time
+                counts[0] += 1
+                counts[1] += time
+            count_total += 1
+            time_total += time
+        self.blocks += 1
+        self.count_total += count_total
+        self.time_total += time_total
+        self.count_squares += count_total * count_total
+        self.time_squares += time_total * time_total
+        for url, (count, time) in block.items():
+            moments = self.moments.get(url)
+            if moments is None:
+                moments = self.moments[url] = [0, 0, 0, 0.0, 0.0, 0.0]
+            moments[0] += count
+            moments[1] += count * count
+            moments[2] += count * count_total
+            moments[3] += time
+            moments[4] += time * time
+            moments[5] += time * time_total
 
+    def ratio_interval(self, y, yy, xy, x, xx):
+        """
+        Полуширина доверительного интервала отношения y / x в процентах (оценка дисперсии
+        отношения через линеаризацию, с поправкой на конечность количества блоков)
+        """
+        n = self.blocks
+        if n < 2 or not x:
+            return 0.0
+        ratio = y / x
+        deviation = max(yy - 2 * ratio * xy + ratio * ratio * xx, 0) / (n - 1)
+        variance = (1 - n / self.total_blocks) * deviation * n / (x * x)
+        return SAMPLE_Z * math.sqrt(max(variance, 0)) * 100
 
-def get_errors_limit(log_size, errors_limit_perc):
+    def intervals(self, url):
+        """Полуширины доверительных интервалов count_perc и time_perc для URL"""
+        moments = self.moments.get(url)
+        if moments is None:
+            return 0.0, 0.0
+        count, count_squares, count_cross, time, time_squares, time_cross = moments
+        return (
+            self.ratio_interval(
+                count, count_squares, count_cross, self.count_total, self.count_squares
+            ),
+            self.ratio_interval(
+                time, time_squares, time_cross, self.time_total, self.time_squares
+            ),
+        )
+
+
+class SampledAggregate:
     """
-    Возвращает максимально возможное количество ошибок.
-    При превышении этого значения парсер остановит работу.
+    Агрегат по выборке из лога. Количества и суммарное время запросов в статистике
+    умножаются на scale выборки, а к строкам добавляются полуширины 95% доверительных
+    интервалов count_perc_ci и time_perc_ci. Медиана, среднее и максимум - по выборке
     """
-    return int((log_size * errors_limit_perc) // 100)
 
+    def __init__(self, aggregate, estimator):
+        self.aggregate = aggregate
+        self.estimator = estimator
+        self.scale = estimator.scale
+        self.total_rows = round(aggregate.total_rows * self.scale)
+        self.errors = round(aggregate.errors * self.scale)
+        self.evicted = aggregate.evicted
+        self.timeseries = aggregate.timeseries
+        self.row_filter = aggregate.row_filter
 
-def get_median(values):
-    """Возвращает медиану для списка значений"""
-    values.sort(reverse=True)
-    len_ = len(values)
-    if len_ % 2 == 0:
-        mid_index_1 = len_ // 2
-        mid_index_2 = mid_index_1 - 1
-        return (values[mid_index_1] + values[mid_index_2]) / 2
+    def url_histogram(self, url):
+        """Гистограмма времени выполнения запросов к url по выборке"""
+        return self.aggregate.url_histogram(url)
+
+    def statistics(self, limit=None):
+        """То же, что statistics агрегата, но с оценками для всего лога"""
+        return list(self.iter_statistics(limit))
+
+    def iter_statistics(self, limit=None):
+        """Генератор. То же, что iter_statistics агрегата, но с оценками для всего лога"""
+        for row in self.aggregate.iter_statistics(limit):
+            count_ci, time_ci = self.estimator.intervals(row["url"])
+            row["count"] = round(row["count"] * self.scale)
+            row["time_sum"] = round(row["time_sum"] * self.scale, ndigits=3)
+            row["count_perc_ci"] = round(count_ci, ndigits=3)
+            row["time_perc_ci"] = round(time_ci, ndigits=3)
+            yield row
+
+
+def read_block(file, start, end):
+    """
+    Генератор. Возвращает строки открытого файла, которые начинаются в диапазоне байтов
+    [start, end). Так каждая строка лога относится ровно к одному блоку
+    """
+    if start:
+        file.seek(start - 1)
+        file.readline()
     else:
-        mid_index = len_ // 2
-        return values[mid_index]
+        file.seek(0)
+    pos = file.tell()
+    while pos < end:
+        line = file.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
 
 
-def get_statistics(logfile):
-    """Возвращает статистику по запросам"""
-    data = {}
-    count_total_req = 0
-    request_time_sum = 0
-    total_rows_counter = 0
-    errors_counter = 0
-    for url, time in request_params(logfile):
-        total_rows_counter += 1
-        if url is None:
-            errors_counter += 1
-            continue
-        count_total_req += 1
-        request_time_sum += time
-        if url not in data:
-            data[url] = {
-                "count": 1, "time_sum": time, "time_max": time, "url": url, "values": [time]
-            }
-        else:
-            data_url = data[url]
-            data_url["count"] += 1
-            data_url["time_sum"] += time
-            data_url["values"].append(time)
-            if time > data_url["time_max"]:
-                data_url["time_max"] = time
+def get_sample_skip(rnd, fraction):
+    """Сколько строк пропустить до следующей строки выборки с вероятностью fraction"""
+    if fraction >= 1:
+        return 0
+    return int(math.log(1.0 - rnd.random()) / math.log(1.0 - fraction))
+
+
+def sample_aggregate(logfile, config=None):
+    """
+    Агрегат по случайной выборке из лога размером около SAMPLE_FRACTION. Несжатый лог
+    делится на блоки по SAMPLE_BLOCK_SIZE байт, и разбираются только строки случайно
+    выбранных блоков. Сжатый лог все равно распаковывается целиком, поэтому из него
+    выбираются отдельные строки, а остальные пропускаются без разбора
+    """
+    config = config or {}
+    fraction = config["SAMPLE_FRACTION"]
+    rnd = random.Random(config.get("SAMPLE_SEED"))
+    aggregate = new_aggregate(config)
+    timeseries = aggregate.timeseries
+    if logfile.name.endswith(".gz"):
+        estimator = SampleEstimator(0, aggregate.normalizer)
+        skip = get_sample_skip(rnd, fraction)
+        with get_opener(logfile.name, config)(logfile.path) as file:
+            for row in file:
+                estimator.total_blocks += 1
+                if skip:
+                    skip -= 1
+                    continue
+                params = list(parse_rows((row,), timeseries, aggregate.row_filter))
+                aggregate_rows(aggregate, params)
+                estimator.add_block(params)
+                skip = get_sample_skip(rnd, fraction)
+        return SampledAggregate(aggregate, estimator)
+    size = os.path.getsize(logfile.path)
+    block_size = config.get("SAMPLE_BLOCK_SIZE", 65536)
+    total_blocks = max(math.ceil(size / block_size), 1)
+    estimator = SampleEstimator(total_blocks, aggregate.normalizer)
+    count = min(total_blocks, max(math.ceil(total_blocks * fraction), 2))
+    with open(logfile.path, "rb") as file:
+        for index in sorted(rnd.sample(range(total_blocks), count)):
+            start = index * block_size
+            rows = read_block(file, start, min(start + block_size, size))
+            params = list(parse_rows(rows, timeseries, aggregate.row_filter))
+            aggregate_rows(aggregate, params)
+            estimator.add_block(params)
+    return SampledAggregate(aggregate, estimator)
 
-    result = []
-    for val in data.values():
-        val["time_sum"] = round(val["time_sum"], ndigits=3)
-        count_perc = (val["count"] / count_total_req) * 100
-        val["count_perc"] = round(count_perc, ndigits=3)
-        time_perc = (val["time_sum"] / request_time_sum) * 100
-        val["time_perc"] = round(time_perc, ndigits=3)
-        time_avg = val["time_sum"] / val["count"]
-        val["time_avg"] = round(time_avg, ndigits=3)
-        values = val.pop("values")
-        val["time_med"] = round(get_median(values), ndigits=3)
-        result.append(val)
 
-    return result, total_rows_counter, errors_counter
+def get_statistics(logfile, config=None, limit=None, metrics=None):
+    """
+    Возвращает статистику по запросам. Если задан limit, возвращает только limit самых
+    тяжелых по суммарному времени URL в порядке убывания
+    """
+    metrics = metrics or RunMetrics()
+    with metrics.stage("request_params") as stage:
+        aggregate = build_aggregate(logfile, config)
+        stage["lines"] = aggregate.total_rows
+    if aggregate.evicted:
+        logging.info(f"{aggregate.evicted} URLs were evicted to keep MAX_URLS distinct URLs")
+    with metrics.stage("statistics") as stage:
+        table_json = aggregate.statistics(limit)
+        stage["urls"] = len(table_json)
+    return table_json, aggregate.total_rows, aggregate.errors
 
 
 def is_report_exist(report_date, report_dir):
@@ -166,12 +2875,66 @@ def is_report_exist(report_date, report_dir):
     path = os.path.join(report_dir, expected_name)
     return os.path.exists(path)
 
-def render_template(table_json):
-    """Создает шаблон отчета"""
-    with open("report.html", "r") as report:
-        template = Template(report.read())
-        content = template.safe_substitute(table_json=table_json)
-    return content
+@lru_cache(maxsize=8)
+def load_template(path, mtime):
+    """
+    Читает шаблон отчета и делит его на части до и после места для таблицы. Результат
+    кэшируется по пути и времени изменения файла, поэтому при построении нескольких
+    отчетов шаблон читается один раз
+    """
+    with open(path, "r") as template:
+        head, placeholder, tail = template.read().partition(TEMPLATE_PLACEHOLDER)
+    if not placeholder:
+        raise ValueError(f"Template {path} has no {TEMPLATE_PLACEHOLDER} placeholder")
+    return head, tail
+
+
+def get_template(path=TEMPLATE_PATH):
+    """Возвращает начало и конец шаблона отчета"""
+    return load_template(path, os.stat(path).st_mtime_ns)
+
+
+def render_report(file, table_json, template_path=TEMPLATE_PATH):
+    """
+    Пишет отчет в открытый файл: начало шаблона, затем строки таблицы в JSON частями
+    по REPORT_CHUNK_ROWS строк, затем конец шаблона. Весь отчет в памяти не собирается
+    """
+    head, tail = get_template(template_path)
+    file.write(head)
+    file.write("[")
+    chunk = []
+    separator = ""
+    for row in table_json:
+        # "</" экранируется, чтобы URL не мог закрыть тег <script>
+        chunk.append(json.dumps(row).replace("</", "<\\/"))
+        if len(chunk) >= REPORT_CHUNK_ROWS:
+            file.write(separator + ",".join(chunk))
+            separator = ","
+            chunk = []
+    if chunk:
+        file.write(separator + ",".join(chunk))
+    file.write("]")
+    file.write(tail)
+
+
+@contextmanager
+def atomic_write(path, mode="w", opener=open, **kwargs):
+    """
+    Открывает на запись временный файл рядом с path и после успешной записи атомарно
+    переименовывает его в path. При ошибке временный файл удаляется. Файл открывается
+    функцией opener (например, gzip.open) в режиме mode
+    """
+    directory, name = os.path.split(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with opener(tmp_path, mode, **kwargs) as file:
+            yield file
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def generate_report_name(report_date):
@@ -180,15 +2943,203 @@ def generate_report_name(report_date):
     return f"report-{date_}.html"
 
 
-def create_report(content, logfile, config):
-    """Создает отчет"""
-    report_name = generate_report_name(logfile.date)
-    report_dir = config["REPORT_DIR"]
-    if not os.path.exists(report_dir):
-        os.makedirs(report_dir)
-    path = os.path.join(report_dir, report_name)
-    with open(path, "w") as report:
-        report.write(content)
+def generate_sample_report_name(report_date):
+    """Генерирует имя приближенного отчета по выборке, например report-2017.06.30.sample.html"""
+    return f"report-{report_date:%Y.%m.%d}.sample.html"
+
+
+def generate_range_report_name(date_from, date_to):
+    """Генерирует имя отчета за диапазон дат"""
+    return f"report-{date_from:%Y.%m.%d}-{date_to:%Y.%m.%d}.html"
+
+
+def write_report(table_json, report_name, config):
+    """Потоково записывает отчет во временный файл и атомарно переименовывает его в REPORT_DIR"""
+    with atomic_write(os.path.join(config["REPORT_DIR"], report_name)) as report:
+        render_report(report, table_json)
+
+
+def generate_timeseries_name(report_name):
+    """Имя JSON-файла с временным рядом для отчета, например report-2017.06.30.timeseries.json"""
+    return os.path.splitext(report_name)[0] + ".timeseries.json"
+
+
+def get_timeseries(aggregate, table_json, config):
+    """
+    Гистограммы времени выполнения по интервалам в TIMESERIES_MINUTES минут и по
+    TIMESERIES_URLS самым тяжелым URL отчета
+    """
+    width = config.get("TIMESERIES_MINUTES", 1)
+    buckets = [
+        dict(time=start.isoformat(), **histogram.summary())
+        for start, histogram in aggregate.timeseries.buckets(width)
+    ]
+    urls = []
+    for row in table_json[:config.get("TIMESERIES_URLS", 10)]:
+        histogram = aggregate.url_histogram(row["url"])
+        if histogram is not None:
+            urls.append(dict(url=row["url"], **histogram.summary()))
+    return {"bucket_minutes": width, "buckets": buckets, "urls": urls}
+
+
+def write_timeseries(aggregate, table_json, report_name, config):
+    """Атомарно записывает временной ряд рядом с отчетом в REPORT_DIR"""
+    path = os.path.join(config["REPORT_DIR"], generate_timeseries_name(report_name))
+    with atomic_write(path) as file:
+        json.dump(get_timeseries(aggregate, table_json, config), file)
+
+
+def get_export_fields(rows):
+    """Порядок колонок выгрузки: основные поля, затем процентили скетча, если они есть"""
+    if not rows:
+        return list(EXPORT_FIELDS)
+    extra = sorted(key for key in rows[0] if key not in EXPORT_FIELDS)
+    return EXPORT_FIELDS + extra
+
+
+def iter_chunks(rows, size):
+    """Генератор. Разбивает итерируемые строки на списки не длиннее size"""
+    rows = iter(rows)
+    chunk = list(islice(rows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, size))
+
+
+def export_jsonl(file, rows, fields):
+    """Пишет строки статистики в формате JSON Lines"""
+    for chunk in iter_chunks(rows, REPORT_CHUNK_ROWS):
+        file.write("".join(json.dumps({key: row[key] for key in fields}) + "\n" for row in chunk))
+
+
+def export_csv(file, rows, fields):
+    """Пишет строки статистики в формате CSV с заголовком"""
+    writer = csv.writer(file)
+    writer.writerow(fields)
+    for chunk in iter_chunks(rows, REPORT_CHUNK_ROWS):
+        writer.writerows([row[key] for key in fields] for row in chunk)
+
+
+def pack_column(values, column_type):
+    """Упаковывает значения колонки в байты little-endian"""
+    if column_type == "str":
+        data = [value.encode("utf-8") for value in values]
+        offsets = array.array("q", [0])
+        for item in data:
+            offsets.append(offsets[-1] + len(item))
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        return offsets.tobytes() + b"".join(data)
+    column = array.array(column_type, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tobytes()
+
+
+def unpack_column(data, column_type, rows):
+    """Распаковывает колонку, упакованную pack_column"""
+    if column_type == "str":
+        offsets = array.array("q")
+        offsets.frombytes(data[:(rows + 1) * offsets.itemsize])
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        blob = data[(rows + 1) * offsets.itemsize:]
+        return [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(rows)]
+    column = array.array(column_type)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tolist()
+
+
+def export_columnar(file, rows, fields):
+    """
+    Пишет строки статистики в бинарном колоночном формате. Файл начинается с COLUMNAR_MAGIC,
+    затем идут группы строк: длина заголовка группы (uint32 little-endian), заголовок в JSON
+    с количеством строк и описанием колонок (имя, тип, размер в байтах) и данные колонок.
+    Числа хранятся как массивы int64 ("q") или double ("d"), строки - как смещения int64
+    и UTF-8 байты. Выгрузка заканчивается заголовком нулевой длины. Читается стандартной
+    библиотекой, см. read_columnar
+    """
+    file.write(COLUMNAR_MAGIC)
+    for chunk in iter_chunks(rows, COLUMNAR_GROUP_ROWS):
+        columns = []
+        parts = []
+        for key in fields:
+            values = [row[key] for row in chunk]
+            if key == "url":
+                column_type = "str"
+            elif all(isinstance(value, int) for value in values):
+                column_type = "q"
+            else:
+                column_type = "d"
+            data = pack_column(values, column_type)
+            columns.append({"name": key, "type": column_type, "size": len(data)})
+            parts.append(data)
+        header = json.dumps({"rows": len(chunk), "columns": columns}).encode("utf-8")
+        file.write(struct.pack("<I", len(header)))
+        file.write(header)
+        for data in parts:
+            file.write(data)
+    file.write(struct.pack("<I", 0))
+
+
+def read_columnar(path):
+    """Генератор. Читает выгрузку export_columnar (в том числе сжатую gzip) построчно"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as file:
+        if file.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError(f"{path} is not a columnar export")
+        while True:
+            (header_size,) = struct.unpack("<I", file.read(4))
+            if header_size == 0:
+                return
+            header = json.loads(file.read(header_size))
+            columns = [
+                unpack_column(file.read(column["size"]), column["type"], header["rows"])
+                for column in header["columns"]
+            ]
+            names = [column["name"] for column in header["columns"]]
+            for values in zip(*columns):
+                yield dict(zip(names, values))
+
+
+EXPORTERS = {"jsonl": export_jsonl, "csv": export_csv, "columnar": export_columnar}
+
+
+def generate_export_name(report_name, export_format, compress=False):
+    """Генерирует имя выгрузки по имени отчета, например report-2017.06.30.csv.gz"""
+    name = os.path.splitext(report_name)[0] + EXPORT_EXTENSIONS[export_format]
+    return name + ".gz" if compress else name
+
+
+def export_statistics(rows, report_name, config):
+    """
+    Выгружает полную статистику по URL в EXPORT_DIR во всех форматах EXPORT_FORMATS,
+    при EXPORT_GZIP - со сжатием. Каждый файл пишется атомарно. rows - список строк или
+    функция, возвращающая новый итератор строк для каждого формата (например,
+    aggregate.iter_statistics): тогда строки не собираются в память все сразу.
+    Возвращает пути выгрузок
+    """
+    get_rows = rows if callable(rows) else partial(iter, rows)
+    compress = config.get("EXPORT_GZIP", False)
+    paths = []
+    for export_format in config.get("EXPORT_FORMATS", ["jsonl"]):
+        if export_format not in EXPORTERS:
+            raise ValueError(f"Unknown export format: {export_format}")
+        path = os.path.join(
+            config["EXPORT_DIR"], generate_export_name(report_name, export_format, compress)
+        )
+        binary = export_format == "columnar"
+        kwargs = {} if binary else {"newline": ""}
+        opener = partial(gzip.open, compresslevel=6) if compress else open
+        with atomic_write(path, "wb" if binary else "wt", opener, **kwargs) as file:
+            format_rows = iter(get_rows())
+            first = list(islice(format_rows, 1))
+            fields = get_export_fields(first)
+            EXPORTERS[export_format](file, chain(first, format_rows), fields)
+        paths.append(path)
+    return paths
 
 
 def get_external_config(external_config_path):
@@ -222,28 +3173,420 @@ def main(basic_config, config_file_path):
 
     logging.basicConfig(format=LOG_FORMAT, datefmt=DATE_FMT, filename=filename, level=logging.INFO)
 
-    logfile = get_latest_log_file(cfg["LOG_DIR"])
+    metrics = RunMetrics()
+    profiler = cProfile.Profile() if cfg.get("PROFILE_FILE") else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        analyze(cfg, metrics)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cfg["PROFILE_FILE"])
+        write_metrics(metrics, cfg.get("METRICS_FILE"))
+
+
+def build_report(logfile, cfg, metrics=None):
+    """Строит отчет по логу. Возвращает False, если в логе слишком много ошибок"""
+    metrics = metrics or RunMetrics()
+    try:
+        with metrics.stage("request_params") as stage:
+            aggregate = build_aggregate(logfile, cfg)
+            stage["lines"] = aggregate.total_rows
+    except ErrorBudgetExceeded as exc:
+        logging.error(f"Can not create report for {logfile.name}. Too much errors: {exc}.")
+        return False
+    if aggregate.evicted:
+        logging.info(f"{aggregate.evicted} URLs were evicted to keep MAX_URLS distinct URLs")
+    errors_limit = get_errors_limit(aggregate.total_rows, cfg["ERROR_LIMIT_PERC"])
+    if aggregate.errors > errors_limit:
+        logging.error(f"Can not create report for {logfile.name}. Too much errors.")
+        return False
+    write_outputs(aggregate, generate_report_name(logfile.date), cfg, metrics)
+    remove_checkpoints(logfile, cfg["REPORT_DIR"])
+    return True
+
+
+def write_outputs(aggregate, report_name, cfg, metrics):
+    """Пишет отчет по агрегату и, если задана EXPORT_DIR, полную выгрузку статистики"""
+    with metrics.stage("statistics") as stage:
+        table_json = aggregate.statistics(cfg["REPORT_SIZE"])
+        stage["urls"] = len(table_json)
+    with metrics.stage("write_report"):
+        write_report(table_json, report_name, cfg)
+    if aggregate.row_filter is not None:
+        log_filter_hits(aggregate.row_filter, metrics)
+    if aggregate.timeseries is not None:
+        with metrics.stage("timeseries"):
+            write_timeseries(aggregate, table_json, report_name, cfg)
+    if cfg.get("EXPORT_DIR"):
+        with metrics.stage("export") as stage:
+
+            def rows():
+                stage["urls"] = 0
+                for row in aggregate.iter_statistics():
+                    stage["urls"] += 1
+                    yield row
+
+            export_statistics(rows, report_name, cfg)
+
+
+def log_filter_hits(row_filter, metrics):
+    """Пишет в лог и в метрики, сколько строк отбросил каждый фильтр"""
+    summary = row_filter.summary()
+    with metrics.stage("filters") as stage:
+        stage.update(summary)
+    hits = ", ".join(f"{key}={value}" for key, value in summary.items())
+    logging.info(f"Row filters: {hits}")
+
+
+def backfill_report(logfile, cfg):
+    """
+    Задача BACKFILL для дочернего процесса: строит отчет по логу и возвращает пару
+    (создан ли отчет, этапы метрик), чтобы метрики попали в сводку родительского процесса.
+    В каждый этап добавляется имя лога
+    """
+    metrics = RunMetrics()
+    created = build_report(logfile, cfg, metrics)
+    for record in metrics.stages:
+        record["log"] = logfile.name
+    return created, metrics.stages
+
+
+def backfill(cfg, metrics):
+    """
+    Строит отчеты по всем логам, для которых их еще нет, обрабатывая до BACKFILL_CONCURRENCY
+    логов одновременно. Ошибка при обработке одного лога не прерывает обработку остальных.
+    Возвращает список логов, отчеты по которым построить не удалось
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    with metrics.stage("get_unreported_log_files") as stage:
+        logfiles = get_unreported_log_files(
+            cfg["LOG_DIR"], cfg["REPORT_DIR"], cfg.get("LOG_INDEX_FILE")
+        )
+        stage["logs"] = len(logfiles)
+    if not logfiles:
+        logging.info("All reports are already exist")
+        return []
+
+    concurrency = cfg.get("BACKFILL_CONCURRENCY", 1)
+    # вложенные пулы процессов не создаем: каждый лог обрабатывается в одном процессе
+    job_cfg = dict(cfg, WORKERS=1) if concurrency > 1 else cfg
+    failed = []
+    with metrics.stage("backfill") as stage:
+        with ProcessPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(backfill_report, logfile, job_cfg): logfile
+                for logfile in logfiles
+            }
+            for future, logfile in futures.items():
+                try:
+                    created, stages = future.result()
+                    metrics.stages.extend(stages)
+                except Exception:
+                    logging.exception(f"Can not create report for {logfile.name}")
+                    created = False
+                if created:
+                    logging.info(f"Report for {logfile.name} is created")
+                else:
+                    failed.append(logfile)
+        stage["logs"] = len(logfiles)
+        stage["failed"] = len(failed)
+    return failed
+
+
+def build_aggregate_report(aggregate, report_name, cfg, metrics):
+    """Строит отчет по готовому агрегату. Возвращает False, если в логах слишком много ошибок"""
+    errors_limit = get_errors_limit(aggregate.total_rows, cfg["ERROR_LIMIT_PERC"])
+    if aggregate.errors > errors_limit:
+        logging.error(f"Can not create report {report_name}. Too much errors.")
+        return False
+    write_outputs(aggregate, report_name, cfg, metrics)
+    return True
+
+
+def build_range_report(cfg, metrics):
+    """Строит отчет за диапазон дат RANGE_FROM - RANGE_TO по агрегатам за каждый день"""
+    date_from = datetime.strptime(cfg["RANGE_FROM"], "%Y-%m-%d").date()
+    date_to = datetime.strptime(cfg["RANGE_TO"] or cfg["RANGE_FROM"], "%Y-%m-%d").date()
+    with metrics.stage("build_range_aggregate") as stage:
+        aggregate = build_range_aggregate(cfg, date_from, date_to)
+        stage["lines"] = aggregate.total_rows
+    if aggregate.total_rows == 0:
+        logging.info("Nginx logs for the range not found")
+        return True
+    report_name = generate_range_report_name(date_from, date_to)
+    return build_aggregate_report(aggregate, report_name, cfg, metrics)
+
+
+def generate_time_report_name(time_from, time_to=None):
+    """Генерирует имя отчета за окно времени. Окно без конца обозначается как "end" """
+    end = "end" if time_to is None else f"{time_to:%Y.%m.%d-%H%M%S}"
+    return f"report-{time_from:%Y.%m.%d-%H%M%S}-{end}.html"
+
+
+def build_time_window_report(cfg, metrics):
+    """
+    Строит отчет по запросам со временем из окна TIME_FROM - TIME_TO ("YYYY-MM-DD HH:MM[:SS]")
+    в логе TIME_LOG или, если он не задан, в самом свежем логе
+    """
+    time_from = datetime.fromisoformat(cfg["TIME_FROM"])
+    time_to = datetime.fromisoformat(cfg["TIME_TO"]) if cfg.get("TIME_TO") else None
+    if cfg.get("TIME_LOG"):
+        path = cfg["TIME_LOG"]
+        logfile = LogFile(name=os.path.basename(path), path=path, date=None)
+    else:
+        logfile = get_latest_log_file(cfg["LOG_DIR"], cfg.get("LOG_INDEX_FILE"))
+    if logfile is None:
+        logging.info("Nginx logs not found")
+        return True
+    with metrics.stage("aggregate_time_window") as stage:
+        aggregate = aggregate_time_window(logfile, time_from, time_to or datetime.max, cfg)
+        stage["lines"] = aggregate.total_rows
+    if aggregate.total_rows == 0:
+        logging.info(f"No requests in {logfile.name} from {time_from} to {time_to or 'end'}")
+        return True
+    report_name = generate_time_report_name(time_from, time_to)
+    return build_aggregate_report(aggregate, report_name, cfg, metrics)
+
+
+def build_sample_report(cfg, metrics):
+    """Строит приближенный отчет по случайной выборке из SAMPLE_FRACTION самого свежего лога"""
+    with metrics.stage("get_latest_log_file"):
+        logfile = get_latest_log_file(cfg["LOG_DIR"], cfg.get("LOG_INDEX_FILE"))
+    if logfile is None:
+        logging.info("Nginx logs not found")
+        return True
+    with metrics.stage("sample_aggregate") as stage:
+        aggregate = sample_aggregate(logfile, cfg)
+        stage["lines"] = aggregate.aggregate.total_rows
+        stage["scale"] = aggregate.scale
+    if aggregate.total_rows == 0:
+        logging.info(f"No requests sampled from {logfile.name}")
+        return True
+    report_name = generate_sample_report_name(logfile.date)
+    return build_aggregate_report(aggregate, report_name, cfg, metrics)
+
+
+def build_sources_report(cfg, metrics):
+    """Строит один отчет по самым свежим логам со всех источников LOG_SOURCES"""
+    with metrics.stage("get_latest_log_files") as stage:
+        logfiles = get_latest_log_files(cfg["LOG_SOURCES"], cfg.get("LOG_INDEX_FILE"))
+        stage["logs"] = len(logfiles)
+    if not logfiles:
+        logging.info("Nginx logs not found")
+        return True
+    log_date = logfiles[0].date
+    if is_report_exist(log_date, cfg["REPORT_DIR"]):
+        logging.info(f"Report is already exists")
+        return True
+    try:
+        with metrics.stage("request_params") as stage:
+            aggregate = aggregate_sources(logfiles, cfg)
+            stage["lines"] = aggregate.total_rows
+    except ErrorBudgetExceeded as exc:
+        logging.error(f"Can not create report for {log_date}. Too much errors: {exc}.")
+        return False
+    return build_aggregate_report(aggregate, generate_report_name(log_date), cfg, metrics)
+
+
+def write_live_report(table_json, cfg):
+    """Перестраивает живой отчет режима FOLLOW"""
+    write_report(table_json, LIVE_REPORT_NAME, cfg)
+
+
+def get_follow_config(cfg):
+    """
+    Настройки живого агрегата режима FOLLOW: значения времени хранятся в скетчах квантилей,
+    поэтому статистика для отчета считается за время, зависящее от количества URL, а не
+    от количества прочитанных строк, и надолго не задерживает чтение лога
+    """
+    return get_sketch_config(cfg)
+
+
+def follow(cfg, stop=None, poll_interval=0.5):
+    """
+    Следит за текущим логом FOLLOW и обновляет статистику по мере появления строк. Живой
+    отчет перестраивается раз в FOLLOW_INTERVAL секунд или каждые FOLLOW_EVERY_LINES строк
+    в отдельном потоке; пока предыдущий отчет пишется, новый не начинается, поэтому отрисовка
+    не задерживает чтение лога. Время запросов хранится в скетчах квантилей (см.
+    get_follow_config), поэтому и подсчет статистики не растет с объемом прочитанного.
+    При ротации или усечении лога статистика начинается заново.
+    После остановки отчет перестраивается по последним данным
+    """
+    stop = stop or threading.Event()
+    cfg = get_follow_config(cfg)
+    interval = cfg.get("FOLLOW_INTERVAL", 10)
+    every_lines = cfg.get("FOLLOW_EVERY_LINES", 0)
+    aggregate = new_aggregate(cfg)
+    last_render = perf_counter()
+    new_lines = 0
+    rendering = None
+    with ThreadPoolExecutor(max_workers=1) as renderer:
+        for row in follow_rows(cfg["FOLLOW"], stop, poll_interval):
+            if row is FOLLOW_RESET:
+                logging.info(f"Log {cfg['FOLLOW']} was rotated or truncated")
+                aggregate = new_aggregate(cfg)
+                new_lines = 0
+                continue
+            if row is not FOLLOW_IDLE:
+                if aggregate.row_filter is not None and not aggregate.row_filter(row):
+                    continue
+                url, time = parse_row(row)
+                aggregate.add(url, time)
+                new_lines += 1
+            if not new_lines or rendering is not None and not rendering.done():
+                continue
+            by_lines = every_lines and new_lines >= every_lines
+            if by_lines or perf_counter() - last_render >= interval:
+                table_json = aggregate.statistics(cfg["REPORT_SIZE"])
+                rendering = renderer.submit(write_live_report, table_json, cfg)
+                rendering.add_done_callback(log_render_error)
+                last_render = perf_counter()
+                new_lines = 0
+    if new_lines:
+        write_live_report(aggregate.statistics(cfg["REPORT_SIZE"]), cfg)
+    return aggregate
+
+
+def log_render_error(future):
+    """Пишет в лог ошибку фоновой отрисовки отчета"""
+    if future.exception() is not None:
+        logging.error(f"Can not render live report: {future.exception()}")
+
+
+def analyze(cfg, metrics):
+    """Строит отчет по самому свежему логу (или по всем логам без отчета), замеряя каждый этап"""
+    if cfg.get("FOLLOW"):
+        try:
+            follow(cfg)
+        except KeyboardInterrupt:
+            logging.info("Follow mode is stopped")
+        return
+    if cfg.get("TIME_FROM"):
+        if not build_time_window_report(cfg, metrics):
+            sys.exit(ERROR_EXIT_STATUS)
+        return
+    if cfg.get("RANGE_FROM"):
+        if not build_range_report(cfg, metrics):
+            sys.exit(ERROR_EXIT_STATUS)
+        return
+    if cfg.get("LOG_SOURCES"):
+        if not build_sources_report(cfg, metrics):
+            sys.exit(ERROR_EXIT_STATUS)
+        return
+    if cfg.get("BACKFILL"):
+        if backfill(cfg, metrics):
+            sys.exit(ERROR_EXIT_STATUS)
+        return
+    if cfg.get("SAMPLE_FRACTION"):
+        if not build_sample_report(cfg, metrics):
+            sys.exit(ERROR_EXIT_STATUS)
+        return
+
+    with metrics.stage("get_latest_log_file"):
+        logfile = get_latest_log_file(cfg["LOG_DIR"], cfg.get("LOG_INDEX_FILE"))
     if logfile is None:
         logging.info("Nginx logs not found")
         return
-    if is_report_exist(logfile.date, cfg["REPORT_DIR"]):
+    report_exist = is_report_exist(logfile.date, cfg["REPORT_DIR"])
+    if report_exist and not has_unprocessed_rows(logfile, cfg):
         logging.info(f"Report is already exists")
         return
 
-    table_json, total_rows, errors_count = get_statistics(logfile)
-    errors_limit = get_errors_limit(total_rows, config["ERROR_LIMIT_PERC"])
-    if errors_count > errors_limit:
-        logging.error("Can not create report. Too much errors.")
+    if not build_report(logfile, cfg, metrics):
         sys.exit(ERROR_EXIT_STATUS)
-    table_json.sort(key=lambda v: v["time_sum"], reverse=True)
-    limit = cfg["REPORT_SIZE"]
-    content = render_template(table_json[:limit])
-    create_report(content, logfile, cfg)
 
 
-if __name__ == "__main__":
+class LogAnalyzer:
+    """
+    Программный интерфейс анализатора для использования из других программ. Принимает
+    конфигурацию (недостающие ключи берутся из конфигурации по умолчанию), не разбирает
+    аргументы командной строки и не настраивает логирование. Время этапов копится в metrics
+    """
+
+    def __init__(self, cfg=None, metrics=None):
+        self.config = join_configs(config, cfg or {})
+        self.metrics = metrics or RunMetrics()
+
+    def log_files(self):
+        """Все логи интерфейса в LOG_DIR"""
+        return get_log_files(self.config["LOG_DIR"], self.config.get("LOG_INDEX_FILE"))
+
+    def latest_log_file(self):
+        """Самый свежий лог в LOG_DIR или None"""
+        with self.metrics.stage("get_latest_log_file"):
+            log_dir = self.config["LOG_DIR"]
+            return get_latest_log_file(log_dir, self.config.get("LOG_INDEX_FILE"))
+
+    def aggregate(self, logfile):
+        """
+        Агрегат статистики по логу (если задан SAMPLE_FRACTION - по выборке из него).
+        Бросает ErrorBudgetExceeded, если ошибок разбора больше, чем допускает ERROR_LIMIT_PERC
+        """
+        with self.metrics.stage("request_params") as stage:
+            if self.config.get("SAMPLE_FRACTION"):
+                aggregate = sample_aggregate(logfile, self.config)
+            else:
+                aggregate = build_aggregate(logfile, self.config)
+            stage["lines"] = aggregate.total_rows
+        errors_limit = get_errors_limit(aggregate.total_rows, self.config["ERROR_LIMIT_PERC"])
+        if aggregate.errors > errors_limit:
+            raise ErrorBudgetExceeded(aggregate.errors, aggregate.total_rows, "whole log")
+        return aggregate
+
+    def analyze(self, logfile=None, full=False):
+        """
+        Статистика по логу (по умолчанию - по самому свежему): REPORT_SIZE самых тяжелых URL
+        или, если full, все URL. Возвращает Analysis или None, если логов нет
+        """
+        logfile = logfile or self.latest_log_file()
+        if logfile is None:
+            return None
+        aggregate = self.aggregate(logfile)
+        with self.metrics.stage("statistics") as stage:
+            rows = aggregate.statistics(None if full else self.config["REPORT_SIZE"])
+            stage["urls"] = len(rows)
+        return Analysis(logfile, rows, aggregate.total_rows, aggregate.errors)
+
+    def report(self, logfile=None):
+        """
+        Строит отчет (и выгрузки EXPORT_DIR) по логу, по умолчанию - по самому свежему.
+        Возвращает путь к отчету или None, если логов нет
+        """
+        logfile = logfile or self.latest_log_file()
+        if logfile is None:
+            return None
+        sample = self.config.get("SAMPLE_FRACTION")
+        if sample:
+            report_name = generate_sample_report_name(logfile.date)
+        else:
+            report_name = generate_report_name(logfile.date)
+        write_outputs(self.aggregate(logfile), report_name, self.config, self.metrics)
+        if not sample:
+            remove_checkpoints(logfile, self.config["REPORT_DIR"])
+        return os.path.join(self.config["REPORT_DIR"], report_name)
+
+
+def parse_args(argv=None):
+    """Разбирает аргументы командной строки"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Nginx logs analyzer")
+    parser.add_argument("--config", default="./config.json", help="Path to json config file")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    """Точка входа командной строки"""
+    args = parse_args(argv)
     try:
-        main(config, config_path)
+        main(config, args.config)
     except Exception as exc:
         logging.exception(exc)
 
+
+if __name__ == "__main__":
+    cli()
+
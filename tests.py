@@ -2,11 +2,18 @@
 from collections import defaultdict, namedtuple
 import datetime
 import gzip
+import io
 import shutil
 import os
 import random
+import subprocess
+import sys
+import threading
+import time
 import unittest
+import csv
 import json
+import pickle
 from functools import partial
 from unittest.mock import patch
 
@@ -28,6 +35,50 @@ def get_random_date():
     return start_date + datetime.timedelta(days=random.randrange(delta_days))
 
 
+LOG_ROW = (
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "{method} {url} HTTP/1.1" 200 927 "-" '
+    '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+    '"1498697422-2190034393-4708-9752759" "dc7161be3" {time}\n'
+)
+BROKEN_ROW = (
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n'
+)
+
+
+def generate_log_rows(count, urls_count=20, errors_every=37, seed=42):
+    """Генерирует строки лога в формате ui_short"""
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(count):
+        if errors_every and i % errors_every == errors_every - 1:
+            rows.append(BROKEN_ROW)
+            continue
+        method = rnd.choice(["GET", "POST"])
+        url = f"/api/v2/item/{rnd.randrange(urls_count)}"
+        time = f"{rnd.uniform(0, 3):.3f}"
+        rows.append(LOG_ROW.format(method=method, url=url, time=time))
+    return rows
+
+
+def generate_timed_rows(count, seconds_step=2, seed=3):
+    """Генерирует строки лога с $time_local, начиная с 29/Jun/2017:03:00:00"""
+    rnd = random.Random(seed)
+    start = datetime.datetime(2017, 6, 29, 3, 0)
+    rows = []
+    for i, row in enumerate(generate_log_rows(count)):
+        # запросы пишутся в лог по окончании, поэтому время иногда идет не по порядку
+        offset = seconds_step * i - rnd.choice([0, 0, 0, 70])
+        moment = start + datetime.timedelta(seconds=max(offset, 0))
+        rows.append(row.replace("29/Jun/2017:03:50:22", f"{moment:%d/%b/%Y:%H:%M:%S}"))
+    return rows
+
+
+def write_log(path, rows):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as log:
+        log.writelines(rows)
+
+
 def remove_dirs(*dirs):
     for dir_ in dirs:
         if os.path.exists(dir_):
@@ -49,6 +100,59 @@ class TestDefaultConfig(unittest.TestCase):
         self.assertIn("LOG_DIR", config, msg="'LOG_DIR' not in default config")
         self.assertIn("OUTPUT_LOG_DIR", config, msg="'OUTPUT_LOG_DIR' not in default config")
         self.assertIn("ERROR_LIMIT_PERC", config, msg="'ERROR_LIMIT_PERC' not in default config")
+        self.assertIn("WORKERS", config, msg="'WORKERS' not in default config")
+        self.assertIn("QUANTILE_SKETCH", config, msg="'QUANTILE_SKETCH' not in default config")
+        self.assertIn("QUANTILE_ERROR", config, msg="'QUANTILE_ERROR' not in default config")
+        self.assertIn("AGGREGATE_STORE", config, msg="'AGGREGATE_STORE' not in default config")
+        self.assertIn("CHECKPOINT_EVERY", config, msg="'CHECKPOINT_EVERY' not in default config")
+        self.assertIn("GZIP_READER", config, msg="'GZIP_READER' not in default config")
+        self.assertIn("GZIP_QUEUE_SIZE", config, msg="'GZIP_QUEUE_SIZE' not in default config")
+        self.assertIn("MMAP_READER", config, msg="'MMAP_READER' not in default config")
+        self.assertIn("METRICS_FILE", config, msg="'METRICS_FILE' not in default config")
+        self.assertIn("PROFILE_FILE", config, msg="'PROFILE_FILE' not in default config")
+        self.assertIn("BACKFILL", config, msg="'BACKFILL' not in default config")
+        self.assertIn(
+            "BACKFILL_CONCURRENCY", config, msg="'BACKFILL_CONCURRENCY' not in default config"
+        )
+        keys = [
+            "CACHE_DIR",
+            "CACHE_MAX_AGE_DAYS",
+            "CACHE_MAX_SIZE_MB",
+            "RANGE_FROM",
+            "RANGE_TO",
+            "FOLLOW",
+            "FOLLOW_INTERVAL",
+            "FOLLOW_EVERY_LINES",
+            "LOG_SOURCES",
+            "SOURCE_QUEUE_SIZE",
+            "URL_STRIP_QUERY",
+            "URL_RULES",
+            "URL_CACHE_SIZE",
+            "MAX_URLS",
+            "LOG_INDEX_FILE",
+            "EXPORT_DIR",
+            "EXPORT_FORMATS",
+            "EXPORT_GZIP",
+            "ERROR_EARLY_ABORT",
+            "ERROR_STATISTICAL_ABORT",
+            "ERROR_PREFLIGHT_LINES",
+            "TIME_INDEX_DIR",
+            "TIME_FROM",
+            "TIME_TO",
+            "TIME_LOG",
+            "TIMESERIES",
+            "TIMESERIES_MINUTES",
+            "TIMESERIES_URLS",
+            "SAMPLE_FRACTION",
+            "SAMPLE_BLOCK_SIZE",
+            "SAMPLE_SEED",
+            "FILTER_URL_PREFIX",
+            "FILTER_METHODS",
+            "FILTER_STATUS",
+            "FILTER_MIN_TIME",
+        ]
+        for key in keys:
+            self.assertIn(key, config, msg=f"'{key}' not in default config")
 
 
 class TestExternalConfig(unittest.TestCase):
@@ -60,11 +164,11 @@ class TestExternalConfig(unittest.TestCase):
         os.makedirs(self.config_dir)
 
     def test_config_in_args(self):
-        args = log_analyzer.args
-        self.assertTrue(hasattr(args, "config"))
+        args = log_analyzer.parse_args(["--config", "other.json"])
+        self.assertEqual(args.config, "other.json")
 
     def test_config_default(self):
-        config_file = log_analyzer.args.config
+        config_file = log_analyzer.parse_args([]).config
         self.assertEqual(config_file, self.default_config_file)
 
     def test_conf_not_found(self):
@@ -158,6 +262,109 @@ class TestLatestLogFile(unittest.TestCase):
         self.assertEqual(expected_latest, real_latest, msg="Function return not latest log file")
 
 
+class TestLogIndex(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_log_index"
+    log_dir = os.path.join(dir, "log")
+    report_dir = os.path.join(dir, "reports")
+    index_file = os.path.join(dir, "index.json")
+    dir_mtime = 1500000000
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        os.makedirs(self.log_dir)
+        os.makedirs(self.report_dir)
+        for name in (
+            "nginx-access-ui.log-20170628.gz",
+            "nginx-access-ui.log-20170630",
+            "nginx-access-ui.log-20170629.bz2",
+            "nginx-access-ui.log-20171399",
+        ):
+            self._touch(os.path.join(self.log_dir, name))
+        self._touch(os.path.join(self.report_dir, "report-2017.06.28.html"))
+        # индекс доверяет только времени изменения папки, которое старше порога гонки
+        os.utime(self.log_dir, (self.dir_mtime, self.dir_mtime))
+
+    def _touch(self, path):
+        with open(path, "w") as file:
+            file.write("")
+
+    def _names(self, logfiles):
+        return [logfile.name for logfile in logfiles]
+
+    def test_queries(self):
+        index = log_analyzer.LogIndex(self.index_file)
+        self.assertEqual(
+            index.latest(self.log_dir).name, "nginx-access-ui.log-20170630"
+        )
+        self.assertEqual(
+            self._names(index.unreported(self.log_dir, self.report_dir)),
+            ["nginx-access-ui.log-20170630"],
+        )
+        self.assertEqual(
+            self._names(
+                index.between(
+                    self.log_dir, datetime.date(2017, 6, 27), datetime.date(2017, 6, 29)
+                )
+            ),
+            ["nginx-access-ui.log-20170628.gz"],
+        )
+
+    def test_same_as_scan(self):
+        indexed = log_analyzer.get_log_files(self.log_dir, self.index_file)
+        scanned = log_analyzer.get_log_files(self.log_dir)
+        self.assertEqual(indexed, sorted(scanned, key=lambda logfile: logfile.date))
+        self.assertEqual(
+            log_analyzer.get_latest_log_file(self.log_dir, self.index_file),
+            log_analyzer.get_latest_log_file(self.log_dir),
+        )
+
+    def test_unchanged_dir_is_not_scanned(self):
+        log_analyzer.LogIndex(self.index_file).latest(self.log_dir)
+        with patch.object(log_analyzer.os, "scandir", wraps=os.scandir) as scandir:
+            latest = log_analyzer.LogIndex(self.index_file).latest(self.log_dir)
+        scandir.assert_not_called()
+        self.assertEqual(latest.name, "nginx-access-ui.log-20170630")
+
+    def test_incremental_refresh(self):
+        log_analyzer.LogIndex(self.index_file).latest(self.log_dir)
+        os.remove(os.path.join(self.log_dir, "nginx-access-ui.log-20170628.gz"))
+        self._touch(os.path.join(self.log_dir, "nginx-access-ui.log-20170701.gz"))
+        os.utime(self.log_dir, (self.dir_mtime + 60, self.dir_mtime + 60))
+        with open(os.path.join(self.log_dir, "nginx-access-ui.log-20170630"), "w") as file:
+            file.write("grown")
+        logfiles = log_analyzer.LogIndex(self.index_file).log_files(self.log_dir)
+        self.assertEqual(
+            self._names(logfiles),
+            ["nginx-access-ui.log-20170630", "nginx-access-ui.log-20170701.gz"],
+        )
+        # известный лог не перечитывается через stat, новый получает размер и время изменения
+        with open(self.index_file) as file:
+            files = json.load(file)["dirs"][os.path.abspath(self.log_dir)]["files"]
+        self.assertEqual([size for _, _, size, _ in files], [0, 0])
+        self.assertEqual(files[1][:2], ["nginx-access-ui.log-20170701.gz", "2017-07-01"])
+
+    def test_fresh_dir_is_rescanned(self):
+        self._touch(os.path.join(self.log_dir, "nginx-access-ui.log-20170701.gz"))
+        self.assertEqual(
+            log_analyzer.get_latest_log_file(self.log_dir, self.index_file).name,
+            "nginx-access-ui.log-20170701.gz",
+        )
+        self._touch(os.path.join(self.log_dir, "nginx-access-ui.log-20170702.gz"))
+        self.assertEqual(
+            log_analyzer.get_latest_log_file(self.log_dir, self.index_file).name,
+            "nginx-access-ui.log-20170702.gz",
+        )
+
+    def test_broken_index(self):
+        self._touch(self.index_file)
+        latest = log_analyzer.get_latest_log_file(self.log_dir, self.index_file)
+        self.assertEqual(latest.name, "nginx-access-ui.log-20170630")
+
+    def test_missing_dir(self):
+        missing = os.path.join(self.dir, "missing")
+        self.assertIsNone(log_analyzer.get_latest_log_file(missing, self.index_file))
+
+
 class TestGenerateReportName(unittest.TestCase):
     def test_less_than_ten(self):
         year = 2018
@@ -337,6 +544,15 @@ class TestGetStatistic(unittest.TestCase):
             delta = abs(expected_med - real_med)
             self.assertLess(delta, self.assertion_delta)
 
+    def test_limit(self):
+        with patch(self.request_params, return_value=self.mocked_requests):
+            full, *_ = log_analyzer.get_statistics(tuple())
+        full.sort(key=lambda v: v["time_sum"], reverse=True)
+        for store in log_analyzer.AGGREGATE_STORES:
+            with patch(self.request_params, return_value=self.mocked_requests):
+                top, *_ = log_analyzer.get_statistics(tuple(), {"AGGREGATE_STORE": store}, 3)
+            self.assertEqual(full[:3], top)
+
     def test_total_rows_counter(self):
         with patch(self.request_params, return_value=self.mocked_requests):
             _, total_rows, _ = log_analyzer.get_statistics(tuple())
@@ -348,6 +564,1178 @@ class TestGetStatistic(unittest.TestCase):
         self.assertEqual(self.errors_count, errors)
 
 
+class TestParallelStatistics(unittest.TestCase):
+    log_dir = "/tmp/log_analyzer/test_parallel_statistics"
+
+    def setUp(self):
+        remove_dirs(self.log_dir)
+        os.makedirs(self.log_dir)
+        name = "nginx-access-ui.log-20170630"
+        self.path = os.path.join(self.log_dir, name)
+        write_log(self.path, generate_log_rows(1000))
+        self.logfile = log_analyzer.LogFile(name=name, path=self.path, date=None)
+
+    def test_chunks_aligned_on_newlines(self):
+        with open(self.path, "rb") as log:
+            content = log.read()
+        chunks = log_analyzer.get_chunks(self.path, 7)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], len(content))
+        for (_, end), (start, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(content[end - 1:end], b"\n")
+
+    def test_same_as_serial(self):
+        serial = log_analyzer.get_statistics(self.logfile)
+        parallel = log_analyzer.get_statistics(self.logfile, {"WORKERS": 3})
+        key = lambda row: row["url"]
+        self.assertEqual(sorted(serial[0], key=key), sorted(parallel[0], key=key))
+        self.assertEqual(serial[1:], parallel[1:])
+
+
+class TestErrorBudget(unittest.TestCase):
+    log_dir = "/tmp/log_analyzer/test_error_budget"
+    config = {"ERROR_LIMIT_PERC": 5, "ERROR_EARLY_ABORT": True}
+    statistical_config = dict(config, ERROR_STATISTICAL_ABORT=True, ERROR_PREFLIGHT_LINES=2000)
+
+    def setUp(self):
+        remove_dirs(self.log_dir)
+        os.makedirs(self.log_dir)
+
+    def _logfile(self, rows, name="nginx-access-ui.log-20170630"):
+        path = os.path.join(self.log_dir, name)
+        write_log(path, rows)
+        return log_analyzer.LogFile(name=name, path=path, date=None)
+
+    def test_lower_bound(self):
+        self.assertEqual(log_analyzer.get_errors_lower_bound(0, 1000), 0)
+        self.assertGreater(log_analyzer.get_errors_lower_bound(1000, 1000), 0.98)
+        self.assertLess(log_analyzer.get_errors_lower_bound(60, 1000), 0.05)
+
+    def test_estimated_size(self):
+        budget = log_analyzer.ErrorBudget(5, expected_rows=1000)
+        budget.check(50, 100)
+        with self.assertRaises(log_analyzer.ErrorBudgetExceeded) as exc:
+            budget.check(50, 101)
+        self.assertEqual(exc.exception.reason, "estimated log size")
+
+    def test_size_bound(self):
+        min_row_size = log_analyzer.ERROR_BUDGET_MIN_ROW_SIZE
+        self.assertIsNotNone(log_analyzer.LOG_LINE_RE.match(b'a b c [] "GET u" 200  0.0'))
+        # после 100 ошибочных строк по байту в логе может остаться до 1000 правильных строк,
+        # и 10% от 1100 строк еще не превышены; после 200 - уже превышены
+        budget = log_analyzer.ErrorBudget(10, size=100 + 1000 * min_row_size)
+        budget.check(100, 100)
+        with self.assertRaises(log_analyzer.ErrorBudgetExceeded) as exc:
+            budget.check(200, 200)
+        self.assertEqual(exc.exception.reason, "log size")
+
+    def test_bursts_are_accepted(self):
+        good = LOG_ROW.format(method="GET", url="/api/v2/item/1", time="0.100")
+        logs = [
+            [BROKEN_ROW] * 400 + [good] * 200000,
+            [good] * 10000 + [BROKEN_ROW] * 2500 + [good] * 200000,
+        ]
+        for rows in logs:
+            logfile = self._logfile(rows)
+            aggregate = log_analyzer.parse_aggregate(logfile, dict(log_analyzer.config))
+            self.assertEqual(aggregate.total_rows, len(rows))
+
+    def test_preflight(self):
+        logfile = self._logfile(generate_log_rows(10000, errors_every=2))
+        with patch.object(log_analyzer, "request_params") as params:
+            with self.assertRaises(log_analyzer.ErrorBudgetExceeded) as exc:
+                log_analyzer.parse_aggregate(logfile, self.statistical_config)
+        params.assert_not_called()
+        self.assertLessEqual(exc.exception.rows, 2000)
+
+    def test_preflight_gzip(self):
+        logfile = self._logfile([BROKEN_ROW] * 5000, "nginx-access-ui.log-20170630.gz")
+        with self.assertRaises(log_analyzer.ErrorBudgetExceeded) as exc:
+            log_analyzer.parse_aggregate(logfile, self.statistical_config)
+        self.assertEqual(exc.exception.rows, 2000)
+        # без статистических проверок сжатый лог проверяется только после полного разбора
+        self.assertEqual(log_analyzer.parse_aggregate(logfile, self.config).errors, 5000)
+
+    def test_streaming_abort(self):
+        rows = generate_log_rows(1000) + [BROKEN_ROW] * 100000
+        logfile = self._logfile(rows)
+        with self.assertRaises(log_analyzer.ErrorBudgetExceeded) as exc:
+            log_analyzer.parse_aggregate(logfile, self.config)
+        self.assertLessEqual(exc.exception.rows, 20000)
+        self.assertEqual(exc.exception.reason, "log size")
+
+    def test_parallel_abort(self):
+        logfile = self._logfile(generate_log_rows(1000) + [BROKEN_ROW] * 100000)
+        config = dict(self.config, WORKERS=2)
+        with self.assertRaises(log_analyzer.ErrorBudgetExceeded):
+            log_analyzer.parse_aggregate(logfile, config)
+
+    def test_good_log(self):
+        logfile = self._logfile(generate_log_rows(30000))
+        aggregate = log_analyzer.parse_aggregate(logfile, self.statistical_config)
+        expected = log_analyzer.parse_aggregate(logfile)
+        self.assertEqual(aggregate.total_rows, 30000)
+        self.assertEqual(aggregate.statistics(), expected.statistics())
+
+    def test_build_report_fails(self):
+        logfile = self._logfile([BROKEN_ROW] * 3000)
+        config = dict(self.config, REPORT_DIR=self.log_dir, REPORT_SIZE=10)
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(log_analyzer.build_report(logfile, config))
+
+
+class TestTimeIndex(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_time_index"
+    log_dir = os.path.join(dir, "log")
+    index_dir = os.path.join(dir, "index")
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        os.makedirs(self.log_dir)
+        self.rows = self._rows()
+        self.config = {"TIME_INDEX_DIR": self.index_dir}
+
+    def _rows(self):
+        return generate_timed_rows(3000)
+
+    def _write(self, name, members=1):
+        path = os.path.join(self.log_dir, name)
+        if name.endswith(".gz"):
+            step = len(self.rows) // members + 1
+            with open(path, "wb") as log:
+                for i in range(0, len(self.rows), step):
+                    log.write(gzip.compress("".join(self.rows[i:i + step]).encode()))
+        else:
+            write_log(path, self.rows)
+        return log_analyzer.LogFile(name=name, path=path, date=datetime.date(2017, 6, 30))
+
+    def _expected(self, time_from, time_to):
+        aggregate = log_analyzer.Aggregate()
+        for row in self.rows:
+            match = log_analyzer.TIME_LOCAL_RE.search(row.encode())
+            moment = datetime.datetime.strptime(
+                match.group(0)[1:].decode(), "%d/%b/%Y:%H:%M:%S"
+            )
+            if time_from <= moment < time_to:
+                aggregate.add(*log_analyzer.parse_row(row.encode()))
+        return aggregate
+
+    def _check(self, logfile):
+        windows = [
+            (datetime.datetime(2017, 6, 29, 3, 30), datetime.datetime(2017, 6, 29, 3, 45)),
+            (datetime.datetime(2017, 6, 29, 3, 0, 7), datetime.datetime(2017, 6, 29, 3, 1, 31)),
+            (datetime.datetime(2017, 6, 29, 4, 30), datetime.datetime(2017, 6, 29, 5, 0)),
+            (datetime.datetime(2017, 6, 30), datetime.datetime(2017, 7, 1)),
+        ]
+        for time_from, time_to in windows:
+            expected = self._expected(time_from, time_to)
+            real = log_analyzer.aggregate_time_window(logfile, time_from, time_to, self.config)
+            self.assertEqual(real.total_rows, expected.total_rows)
+            self.assertEqual(real.statistics(), expected.statistics())
+
+    def test_plain(self):
+        self._check(self._write("nginx-access-ui.log-20170630"))
+
+    def test_gzip(self):
+        self._check(self._write("nginx-access-ui.log-20170630.gz"))
+
+    def test_gzip_members(self):
+        logfile = self._write("nginx-access-ui.log-20170630.gz", members=5)
+        index = log_analyzer.build_time_index(logfile)
+        self.assertEqual(len(index.members), 5)
+        self._check(logfile)
+        rows = list(log_analyzer.window_rows(logfile, index, *index.buckets[
+            datetime.datetime(2017, 6, 29, 4, 0)
+        ]))
+        self.assertLess(len(rows), len(self.rows) // 10)
+
+    def test_index_built_during_run(self):
+        logfile = self._write("nginx-access-ui.log-20170630")
+        aggregate = log_analyzer.parse_aggregate(logfile, self.config)
+        self.assertEqual(aggregate.total_rows, len(self.rows))
+        index = log_analyzer.load_time_index(self.index_dir, logfile)
+        self.assertEqual(index, log_analyzer.build_time_index(logfile))
+        start, end = index.buckets[datetime.datetime(2017, 6, 29, 3, 0)]
+        self.assertEqual(start, 0)
+
+    def test_stale_index(self):
+        logfile = self._write("nginx-access-ui.log-20170630")
+        log_analyzer.get_time_index(logfile, self.config)
+        self.rows = self.rows[:100]
+        write_log(logfile.path, self.rows)
+        self.assertIsNone(log_analyzer.load_time_index(self.index_dir, logfile))
+        self._check(logfile)
+
+    def test_report(self):
+        logfile = self._write("nginx-access-ui.log-20170630.gz")
+        config = dict(
+            log_analyzer.config,
+            TIME_LOG=logfile.path,
+            TIME_FROM="2017-06-29 03:30",
+            TIME_TO="2017-06-29 03:45",
+            REPORT_DIR=os.path.join(self.dir, "reports"),
+            TIME_INDEX_DIR=self.index_dir,
+        )
+        metrics = log_analyzer.RunMetrics()
+        self.assertTrue(log_analyzer.build_time_window_report(config, metrics))
+        self.assertEqual(
+            os.listdir(config["REPORT_DIR"]),
+            ["report-2017.06.29-033000-2017.06.29-034500.html"],
+        )
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_buckets(self):
+        histogram = log_analyzer.LatencyHistogram
+        previous = 0
+        for ms in range(100000):
+            index = histogram.bucket(ms / 1000)
+            lower, upper = histogram.bounds(index)
+            self.assertTrue(lower <= ms <= upper)
+            self.assertLessEqual(upper - lower, lower / log_analyzer.LATENCY_SUB_BUCKETS)
+            self.assertIn(index, (previous, previous + 1))
+            previous = index
+
+    def test_quantile(self):
+        rnd = random.Random(1)
+        values = sorted(round(rnd.lognormvariate(-1, 1.5), 3) for _ in range(10000))
+        histogram = log_analyzer.histogram_of(values)
+        self.assertEqual(histogram.count, len(values))
+        for q in (0.5, 0.9, 0.99):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(histogram.quantile(q), exact, delta=exact / 32 + 0.001)
+
+    def test_merge(self):
+        values = [0.0, 0.001, 0.5, 2.0, 30.0, 600.0, 0.5]
+        first = log_analyzer.histogram_of(values[:3])
+        first.merge(log_analyzer.histogram_of(values[3:]))
+        whole = log_analyzer.histogram_of(values)
+        self.assertEqual(first.counts, whole.counts)
+        self.assertEqual(first.to_json(), whole.to_json())
+
+    def test_from_sketch(self):
+        sketch = log_analyzer.QuantileSketch(0.01)
+        for value in (0.0, 0.1, 0.2, 1.5):
+            sketch.add(value)
+        histogram = log_analyzer.histogram_of(sketch)
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.quantile(1), 1.5, delta=0.05)
+
+
+class TestTimeSeries(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_timeseries"
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        os.makedirs(self.dir)
+        self.rows = generate_timed_rows(3000, seconds_step=1)
+        self.config = {"TIMESERIES": True, "REPORT_DIR": self.dir, "AGGREGATE_STORE": "dict"}
+
+    def _logfile(self, name="nginx-access-ui.log-20170630"):
+        path = os.path.join(self.dir, name)
+        write_log(path, self.rows)
+        return log_analyzer.LogFile(name=name, path=path, date=datetime.date(2017, 6, 30))
+
+    def _expected(self):
+        minutes = defaultdict(list)
+        for row in self.rows:
+            url, time = log_analyzer.parse_row(row.encode())
+            if url is not None:
+                minutes[row.split("[")[1][:17].encode()].append(time)
+        return {minute: list(log_analyzer.histogram_of(values).counts)
+                for minute, values in minutes.items()}
+
+    def _minutes(self, aggregate):
+        return {
+            minute: list(histogram.counts)
+            for minute, histogram in aggregate.timeseries.minutes.items()
+        }
+
+    def test_paths(self):
+        expected = self._expected()
+        self.assertEqual(len(expected), 50)
+        configs = [
+            {},
+            {"WORKERS": 3},
+            {"WORKERS": 2, "MMAP_READER": True},
+            {"GZIP_READER": "pipeline"},
+            {"CHECKPOINT_EVERY": 500},
+            {"AGGREGATE_STORE": "compact"},
+        ]
+        for extra in configs:
+            name = "nginx-access-ui.log-20170630.gz" if "GZIP_READER" in extra else None
+            logfile = self._logfile(name) if name else self._logfile()
+            aggregate = log_analyzer.parse_aggregate(logfile, dict(self.config, **extra))
+            self.assertEqual(self._minutes(aggregate), expected, msg=extra)
+
+    def test_sources(self):
+        logfile = self._logfile()
+        aggregate = log_analyzer.aggregate_sources([logfile, logfile], self.config)
+        expected = {
+            minute: [count * 2 for count in counts] for minute, counts in self._expected().items()
+        }
+        self.assertEqual(self._minutes(aggregate), expected)
+
+    def test_pickle(self):
+        aggregate = log_analyzer.parse_aggregate(self._logfile(), self.config)
+        restored = pickle.loads(pickle.dumps(aggregate))
+        self.assertEqual(self._minutes(restored), self._minutes(aggregate))
+
+    def test_report(self):
+        logfile = self._logfile()
+        config = dict(
+            log_analyzer.config, TIMESERIES_MINUTES=15, TIMESERIES_URLS=3, **self.config
+        )
+        self.assertTrue(log_analyzer.build_report(logfile, config))
+        with open(os.path.join(self.dir, "report-2017.06.30.timeseries.json")) as file:
+            timeseries = json.load(file)
+        self.assertEqual(timeseries["bucket_minutes"], 15)
+        self.assertEqual(
+            [bucket["time"] for bucket in timeseries["buckets"]],
+            ["2017-06-29T03:00:00", "2017-06-29T03:15:00", "2017-06-29T03:30:00",
+             "2017-06-29T03:45:00"],
+        )
+        self.assertEqual(
+            sum(bucket["count"] for bucket in timeseries["buckets"]),
+            sum(sum(counts) for counts in self._expected().values()),
+        )
+        self.assertEqual(len(timeseries["urls"]), 3)
+        for url in timeseries["urls"]:
+            self.assertLessEqual(url["p50"], url["p99"])
+
+
+class TestSampling(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_sampling"
+
+    @classmethod
+    def setUpClass(cls):
+        remove_dirs(cls.dir)
+        os.makedirs(cls.dir)
+        rows = generate_log_rows(40000, urls_count=30)
+        for name in ("nginx-access-ui.log-20170630", "nginx-access-ui.log-20170630.gz"):
+            write_log(os.path.join(cls.dir, name), rows)
+        cls.logfile = log_analyzer.LogFile(
+            name="nginx-access-ui.log-20170630",
+            path=os.path.join(cls.dir, "nginx-access-ui.log-20170630"),
+            date=datetime.date(2017, 6, 30),
+        )
+        cls.exact = {row["url"]: row for row in log_analyzer.get_statistics(cls.logfile)[0]}
+
+    def _check_estimates(self, logfile, config):
+        hits = checks = 0
+        for seed in range(5):
+            aggregate = log_analyzer.sample_aggregate(logfile, dict(config, SAMPLE_SEED=seed))
+            self.assertAlmostEqual(aggregate.total_rows, 40000, delta=6000)
+            self.assertLess(aggregate.aggregate.total_rows, 10000)
+            for row in aggregate.statistics():
+                exact = self.exact[row["url"]]
+                for key in ("count_perc", "time_perc"):
+                    checks += 1
+                    hits += abs(row[key] - exact[key]) <= row[f"{key}_ci"] + 0.001
+        # 95% интервалы должны накрывать точные значения примерно в 95% случаев
+        self.assertGreater(hits / checks, 0.85)
+
+    def test_blocks(self):
+        self._check_estimates(
+            self.logfile, {"SAMPLE_FRACTION": 0.1, "SAMPLE_BLOCK_SIZE": 8192}
+        )
+
+    def test_gzip_lines(self):
+        logfile = self.logfile._replace(
+            name=self.logfile.name + ".gz", path=self.logfile.path + ".gz"
+        )
+        self._check_estimates(logfile, {"SAMPLE_FRACTION": 0.1})
+
+    def test_whole_log(self):
+        aggregate = log_analyzer.sample_aggregate(
+            self.logfile, {"SAMPLE_FRACTION": 1, "SAMPLE_BLOCK_SIZE": 8192}
+        )
+        self.assertEqual(aggregate.scale, 1)
+        for row in aggregate.statistics():
+            exact = self.exact[row["url"]]
+            self.assertEqual(row["count"], exact["count"])
+            self.assertEqual(row["time_perc"], exact["time_perc"])
+            self.assertEqual(row["count_perc_ci"], 0)
+
+    def test_read_block(self):
+        with open(self.logfile.path, "rb") as file:
+            expected = file.read().splitlines(keepends=True)
+            size = file.tell()
+            rows = []
+            for start in range(0, size, 1000):
+                rows.extend(log_analyzer.read_block(file, start, min(start + 1000, size)))
+        self.assertEqual(rows, expected)
+
+    def test_report(self):
+        report_dir = os.path.join(self.dir, "reports")
+        cfg = dict(
+            log_analyzer.config, LOG_DIR=self.dir, REPORT_DIR=report_dir, SAMPLE_FRACTION=0.2
+        )
+        metrics = log_analyzer.RunMetrics()
+        self.assertTrue(log_analyzer.build_sample_report(cfg, metrics))
+        self.assertTrue(os.path.exists(os.path.join(report_dir, "report-2017.06.30.sample.html")))
+        self.assertFalse(log_analyzer.is_report_exist(datetime.date(2017, 6, 30), report_dir))
+        path = log_analyzer.LogAnalyzer(cfg).report()
+        self.assertEqual(path, os.path.join(report_dir, "report-2017.06.30.sample.html"))
+
+
+class TestRowFilter(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_row_filter"
+    filters = {
+        "FILTER_URL_PREFIX": ["/api/v2/item/1", "/api/v2/item/2"],
+        "FILTER_METHODS": ["get"],
+        "FILTER_STATUS": ["5xx", 404],
+        "FILTER_MIN_TIME": 0.5,
+    }
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        os.makedirs(self.dir)
+        rnd = random.Random(5)
+        self.rows = [
+            row.replace('" 200 ', f'" {rnd.choice([200, 200, 404, 500, 502])} ')
+            for row in generate_log_rows(3000)
+        ]
+        path = os.path.join(self.dir, "nginx-access-ui.log-20170630")
+        write_log(path, self.rows)
+        self.logfile = log_analyzer.LogFile(
+            name="nginx-access-ui.log-20170630", path=path, date=datetime.date(2017, 6, 30)
+        )
+
+    def _passes(self, row):
+        match = log_analyzer.LOG_LINE_RE.match(row.encode())
+        if match is None:
+            return True
+        return (
+            match.group("method") == b"GET"
+            and match.group("url").startswith((b"/api/v2/item/1", b"/api/v2/item/2"))
+            and (match.group("status")[:1] == b"5" or match.group("status") == b"404")
+            and float(match.group("time")) >= 0.5
+        )
+
+    def test_row_filter(self):
+        row_filter = log_analyzer.get_row_filter(self.filters)
+        row = LOG_ROW.format(method="GET", url="/api/v2/item/15", time="0.7")
+        self.assertFalse(row_filter(row.encode()))
+        failed = row.replace('" 200 ', '" 503 ')
+        self.assertTrue(row_filter(failed.encode()))
+        self.assertTrue(row_filter(row.replace('" 200 ', '" 404 ').encode()))
+        self.assertFalse(row_filter(failed.replace("GET", "POST").encode()))
+        self.assertFalse(row_filter(failed.replace("item/15", "user/1").encode()))
+        self.assertFalse(row_filter(failed.replace("0.7", "0.2").encode()))
+        # строки, в которых не найдены поля, пропускаются, чтобы разбор учел их как ошибки
+        self.assertTrue(row_filter(b"garbage\n"))
+        self.assertEqual(
+            row_filter.summary(),
+            {
+                "rows": 7, "passed": 3, "rejected_method": 1, "rejected_url": 1,
+                "rejected_status": 1, "rejected_time": 1,
+            },
+        )
+        self.assertIsNone(log_analyzer.get_row_filter({}))
+
+    def test_unterminated_request(self):
+        row = b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/1 HTTP/1.1\n'
+        self.assertEqual(log_analyzer.parse_row(row), (None, None))
+        for config in {"FILTER_STATUS": ["2xx"]}, {"FILTER_URL_PREFIX": ["/api/2"]}:
+            row_filter = log_analyzer.get_row_filter(config)
+            # обрезанная строка пропускается, чтобы разбор учел ее как ошибку
+            self.assertTrue(row_filter(row), msg=config)
+            self.assertEqual(row_filter.summary()["passed"], 1)
+
+    def test_paths(self):
+        expected_rows = [row for row in self.rows if self._passes(row)]
+        path = os.path.join(self.dir, "expected")
+        write_log(path, expected_rows)
+        expected = log_analyzer.parse_aggregate(
+            log_analyzer.LogFile(name="expected", path=path, date=None), {}
+        )
+        configs = [
+            {},
+            {"WORKERS": 3},
+            {"WORKERS": 2, "MMAP_READER": True},
+            {"MMAP_READER": True},
+            {"CHECKPOINT_EVERY": 500, "REPORT_DIR": self.dir},
+            {"TIME_INDEX_DIR": self.dir},
+            {"AGGREGATE_STORE": "compact"},
+        ]
+        for extra in configs:
+            config = dict(self.filters, ERROR_LIMIT_PERC=50, **extra)
+            aggregate = log_analyzer.parse_aggregate(self.logfile, config)
+            self.assertEqual(aggregate.statistics(), expected.statistics(), msg=extra)
+            self.assertEqual(aggregate.total_rows, len(expected_rows))
+            self.assertEqual(aggregate.row_filter.rows, len(self.rows))
+            self.assertEqual(aggregate.row_filter.summary()["passed"], len(expected_rows))
+
+    def test_rejected_rows_are_not_parsed(self):
+        config = {"FILTER_URL_PREFIX": "/missing"}
+        with patch("log_analyzer.parse_row", return_value=(None, None)) as parse_row:
+            aggregate = log_analyzer.parse_aggregate(self.logfile, config)
+        # разбираются только строки без запроса: фильтр пропускает их, чтобы учесть как ошибки
+        broken = self.rows.count(BROKEN_ROW)
+        self.assertEqual(parse_row.call_count, broken)
+        self.assertEqual((aggregate.total_rows, aggregate.errors), (broken, broken))
+        self.assertEqual(aggregate.row_filter.rejected["url"], len(self.rows) - broken)
+
+    def test_report(self):
+        cfg = dict(
+            log_analyzer.config, REPORT_DIR=self.dir, FILTER_METHODS=["POST"], ERROR_LIMIT_PERC=50
+        )
+        metrics = log_analyzer.RunMetrics()
+        self.assertTrue(log_analyzer.build_report(self.logfile, cfg, metrics))
+        stage = next(stage for stage in metrics.stages if stage["stage"] == "filters")
+        self.assertEqual(stage["rows"], len(self.rows))
+        self.assertEqual(stage["passed"] + stage["rejected_method"], len(self.rows))
+        self.assertNotIn("rejected_url", stage)
+
+    def test_settings(self):
+        self.assertNotEqual(
+            log_analyzer.get_aggregate_settings({}),
+            log_analyzer.get_aggregate_settings({"FILTER_MIN_TIME": 1}),
+        )
+
+
+class TestCheckpoint(unittest.TestCase):
+    log_dir = "/tmp/log_analyzer/test_checkpoint/log"
+    report_dir = "/tmp/log_analyzer/test_checkpoint/reports"
+
+    def setUp(self):
+        remove_dirs(self.log_dir, self.report_dir)
+        os.makedirs(self.log_dir)
+        self.rows = generate_log_rows(300)
+        self.config = {"CHECKPOINT_EVERY": 50, "REPORT_DIR": self.report_dir}
+
+    def _logfile(self, name):
+        path = os.path.join(self.log_dir, name)
+        return log_analyzer.LogFile(name=name, path=path, date=datetime.date(2017, 6, 30))
+
+    def _expected(self, logfile, rows):
+        name = f"expected-{logfile.name}"
+        expected = logfile._replace(name=name, path=os.path.join(self.log_dir, name))
+        write_log(expected.path, rows)
+        return log_analyzer.get_statistics(expected, limit=10)
+
+    def test_resume_after_crash(self):
+        for name in "nginx-access-ui.log-20170630", "nginx-access-ui.log-20170630.gz":
+            logfile = self._logfile(name)
+            write_log(logfile.path, self.rows)
+            parse_row = log_analyzer.parse_row
+            calls = []
+
+            def crash(row):
+                calls.append(row)
+                if len(calls) > 120:
+                    raise RuntimeError("crash")
+                return parse_row(row)
+
+            with patch("log_analyzer.parse_row", side_effect=crash):
+                with self.assertRaises(RuntimeError):
+                    log_analyzer.get_statistics(logfile, self.config, 10)
+            with patch("log_analyzer.parse_row", wraps=parse_row) as mocked:
+                result = log_analyzer.get_statistics(logfile, self.config, 10)
+            self.assertEqual(mocked.call_count, len(self.rows) - 100)
+            self.assertEqual(result, self._expected(logfile, self.rows))
+
+    def test_growing_log(self):
+        logfile = self._logfile("nginx-access-ui.log-20170630")
+        write_log(logfile.path, self.rows[:200])
+        with open(logfile.path, "a") as log:
+            log.write(self.rows[200][:30])
+        log_analyzer.get_statistics(logfile, self.config, 10)
+        self.assertFalse(log_analyzer.has_unprocessed_rows(logfile, self.config))
+
+        with open(logfile.path, "a") as log:
+            log.write(self.rows[200][30:])
+            log.writelines(self.rows[201:])
+        self.assertTrue(log_analyzer.has_unprocessed_rows(logfile, self.config))
+        with patch("log_analyzer.parse_row", wraps=log_analyzer.parse_row) as mocked:
+            result = log_analyzer.get_statistics(logfile, self.config, 10)
+        self.assertEqual(mocked.call_count, 100)
+        self.assertEqual(result, self._expected(logfile, self.rows))
+
+    def test_rotated_log_last_line(self):
+        logfile = self._logfile("nginx-access-ui.log-20170630")
+        rows = self.rows[:100] + [self.rows[100].rstrip("\n")]
+        write_log(logfile.path, rows)
+        write_log(os.path.join(self.log_dir, "nginx-access-ui.log-20170701"), self.rows[:1])
+        expected = log_analyzer.parse_aggregate(logfile)
+        for workers in 1, 2:
+            remove_dirs(self.report_dir)
+            config = dict(self.config, WORKERS=workers)
+            aggregate = log_analyzer.parse_aggregate(logfile, config)
+            self.assertEqual(aggregate.total_rows, 101, msg=workers)
+            self.assertEqual(aggregate.statistics(), expected.statistics(), msg=workers)
+
+    def test_parallel_growing_log(self):
+        logfile = self._logfile("nginx-access-ui.log-20170630")
+        config = dict(self.config, WORKERS=2)
+        write_log(logfile.path, self.rows[:200])
+        with open(logfile.path, "a") as log:
+            log.write(self.rows[200][:30])
+        log_analyzer.get_statistics(logfile, config, 10)
+        with open(logfile.path, "a") as log:
+            log.write(self.rows[200][30:])
+            log.writelines(self.rows[201:])
+        result = log_analyzer.get_statistics(logfile, config, 10)
+        self.assertEqual(result, self._expected(logfile, self.rows))
+
+    def test_parallel_resume_after_crash(self):
+        logfile = self._logfile("nginx-access-ui.log-20170630")
+        rows = generate_log_rows(3000)
+        write_log(logfile.path, rows)
+        config = dict(self.config, WORKERS=2)
+        save_checkpoint = log_analyzer.save_checkpoint
+        offsets = []
+
+        def crash(path, checkpoint):
+            offsets.append(checkpoint.offset)
+            if len(offsets) > 5:
+                raise RuntimeError("crash")
+            save_checkpoint(path, checkpoint)
+
+        with patch("log_analyzer.save_checkpoint", side_effect=crash):
+            with self.assertRaises(RuntimeError):
+                log_analyzer.get_statistics(logfile, config, 10)
+        self.assertEqual(offsets, sorted(offsets))
+        path = log_analyzer.get_checkpoint_path(logfile, self.report_dir)
+        checkpoint = log_analyzer.load_checkpoint(path, logfile, config)
+        self.assertEqual(checkpoint.offset, offsets[4])
+        self.assertLess(checkpoint.aggregate.total_rows, len(rows))
+        result = log_analyzer.get_statistics(logfile, config, 10)
+        self.assertEqual(result, self._expected(logfile, rows))
+
+    def test_remove_checkpoints(self):
+        config = dict(log_analyzer.config, **self.config)
+        first = self._logfile("nginx-access-ui.log-20170629")._replace(
+            date=datetime.date(2017, 6, 29)
+        )
+        second = self._logfile("nginx-access-ui.log-20170630")
+        compressed = self._logfile("nginx-access-ui.log-20170628.gz")._replace(
+            date=datetime.date(2017, 6, 28)
+        )
+        paths = {}
+        for logfile in compressed, first, second:
+            write_log(logfile.path, self.rows)
+            paths[logfile.date] = log_analyzer.get_checkpoint_path(logfile, self.report_dir)
+        # сжатый лог больше не растет
+        self.assertTrue(log_analyzer.build_report(compressed, config))
+        self.assertFalse(os.path.exists(paths[compressed.date]))
+        # есть лог за следующий день - лог уже ротирован
+        self.assertTrue(log_analyzer.build_report(first, config))
+        self.assertFalse(os.path.exists(paths[first.date]))
+        # самый свежий лог еще может расти
+        self.assertTrue(log_analyzer.build_report(second, config))
+        self.assertTrue(os.path.exists(paths[second.date]))
+
+    def test_remove_earlier_checkpoints(self):
+        config = dict(log_analyzer.config, **self.config)
+        first = self._logfile("nginx-access-ui.log-20170629")._replace(
+            date=datetime.date(2017, 6, 29)
+        )
+        write_log(first.path, self.rows)
+        self.assertTrue(log_analyzer.build_report(first, config))
+        first_checkpoint = log_analyzer.get_checkpoint_path(first, self.report_dir)
+        self.assertTrue(os.path.exists(first_checkpoint))
+        second = self._logfile("nginx-access-ui.log-20170630")
+        write_log(second.path, self.rows)
+        self.assertTrue(log_analyzer.build_report(second, config))
+        self.assertFalse(os.path.exists(first_checkpoint))
+
+    def test_other_settings_ignored(self):
+        logfile = self._logfile("nginx-access-ui.log-20170630")
+        write_log(logfile.path, self.rows)
+        log_analyzer.get_statistics(logfile, self.config, 10)
+        config = dict(self.config, AGGREGATE_STORE="compact")
+        result = log_analyzer.get_statistics(logfile, config, 10)
+        self.assertEqual(result, self._expected(logfile, self.rows))
+
+
+class TestAggregateCache(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_aggregate_cache"
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        self.log_dir = os.path.join(self.dir, "log")
+        self.cache_dir = os.path.join(self.dir, "cache")
+        os.makedirs(self.log_dir)
+        self.config = {
+            "LOG_DIR": self.log_dir,
+            "CACHE_DIR": self.cache_dir,
+            "QUANTILE_SKETCH": True,
+            "AGGREGATE_STORE": "compact",
+        }
+        self.logfiles = []
+        for day in 1, 2, 3:
+            name = f"nginx-access-ui.log-201706{day:02d}"
+            path = os.path.join(self.log_dir, name)
+            write_log(path, generate_log_rows(100 * day, seed=day))
+            log_date = datetime.date(2017, 6, day)
+            self.logfiles.append(log_analyzer.LogFile(name=name, path=path, date=log_date))
+
+    def test_cache_hit(self):
+        logfile = self.logfiles[0]
+        expected = log_analyzer.get_statistics(logfile, self.config, 10)
+        with patch("log_analyzer.request_params") as mocked:
+            cached = log_analyzer.get_statistics(logfile, self.config, 10)
+        mocked.assert_not_called()
+        self.assertEqual(expected, cached)
+
+    def test_changed_log_is_parsed_again(self):
+        logfile = self.logfiles[0]
+        log_analyzer.get_statistics(logfile, self.config, 10)
+        with open(logfile.path, "a") as log:
+            log.writelines(generate_log_rows(10))
+        _, total_rows, _ = log_analyzer.get_statistics(logfile, self.config, 10)
+        self.assertEqual(total_rows, 110)
+
+    def test_other_settings_are_not_used(self):
+        logfile = self.logfiles[0]
+        log_analyzer.get_statistics(logfile, self.config, 10)
+        config = dict(self.config, URL_STRIP_QUERY=True)
+        with patch("log_analyzer.parse_aggregate", wraps=log_analyzer.parse_aggregate) as mocked:
+            log_analyzer.get_statistics(logfile, config, 10)
+        mocked.assert_called_once()
+
+    def test_cache_stores_sketches(self):
+        logfile = self.logfiles[2]
+        config = {"CACHE_DIR": self.cache_dir}
+        result, *_ = log_analyzer.get_statistics(logfile, config, 10)
+        self.assertIn("time_p90", result[0])
+        cached = log_analyzer.load_cached_aggregate(
+            self.cache_dir, logfile.date, log_analyzer.get_cache_config(config)
+        )
+        self.assertIsNotNone(cached.sketch_error)
+
+    def test_numpy_store(self):
+        config = dict(self.config, AGGREGATE_STORE="numpy")
+        del config["QUANTILE_SKETCH"]
+        result, total_rows, _ = log_analyzer.get_statistics(self.logfiles[1], config, 10)
+        self.assertEqual(total_rows, 200)
+        self.assertIn("time_p90", result[0])
+        aggregate = log_analyzer.build_range_aggregate(
+            config, datetime.date(2017, 6, 1), datetime.date(2017, 6, 3)
+        )
+        self.assertEqual(aggregate.total_rows, 600)
+
+    def test_evict_missing_file(self):
+        for logfile in self.logfiles:
+            log_analyzer.get_statistics(logfile, self.config)
+        # файл уже удалила соседняя задача BACKFILL
+        with patch("log_analyzer.os.remove", side_effect=FileNotFoundError) as remove:
+            log_analyzer.evict_cache(self.cache_dir, max_size_mb=0)
+        self.assertEqual(remove.call_count, 3)
+
+    def test_range_aggregate(self):
+        for logfile in self.logfiles:
+            log_analyzer.get_statistics(logfile, self.config, 10)
+        os.remove(self.logfiles[0].path)
+        with patch("log_analyzer.request_params") as mocked:
+            aggregate = log_analyzer.build_range_aggregate(
+                self.config, datetime.date(2017, 6, 1), datetime.date(2017, 6, 2)
+            )
+        mocked.assert_not_called()
+        self.assertEqual(aggregate.total_rows, 300)
+
+    def test_range_skips_invalid_cache_names(self):
+        for logfile in self.logfiles:
+            log_analyzer.get_statistics(logfile, self.config, 10)
+        for name in "aggregate-20171399.bin", "aggregate-2017060.bin":
+            with open(os.path.join(self.cache_dir, name), "wb") as file:
+                file.write(b"stray")
+        aggregate = log_analyzer.build_range_aggregate(
+            self.config, datetime.date(2017, 1, 1), datetime.date(2017, 12, 31)
+        )
+        self.assertEqual(aggregate.total_rows, 600)
+
+    def test_range_report(self):
+        report_dir = os.path.join(self.dir, "reports")
+        config = dict(
+            log_analyzer.config,
+            **self.config,
+            REPORT_DIR=report_dir,
+            OUTPUT_LOG_DIR=self.dir,
+            RANGE_FROM="2017-06-02",
+            RANGE_TO="2017-06-30",
+        )
+        log_analyzer.analyze(config, log_analyzer.RunMetrics())
+        report = os.path.join(report_dir, "report-2017.06.02-2017.06.30.html")
+        self.assertTrue(os.path.exists(report))
+
+    def test_evict_by_size(self):
+        for logfile in self.logfiles:
+            log_analyzer.get_statistics(logfile, self.config)
+        paths = [log_analyzer.get_cache_path(self.cache_dir, lf.date) for lf in self.logfiles]
+        for i, path in enumerate(paths):
+            os.utime(path, (1000 + i, 1000 + i))
+        newest_size = os.path.getsize(paths[-1])
+        log_analyzer.evict_cache(self.cache_dir, max_size_mb=newest_size / 2 ** 20)
+        self.assertEqual([os.path.exists(path) for path in paths], [False, False, True])
+
+    def test_evict_by_age(self):
+        for logfile in self.logfiles:
+            log_analyzer.get_statistics(logfile, self.config)
+        old = log_analyzer.get_cache_path(self.cache_dir, self.logfiles[0].date)
+        os.utime(old, (1000, 1000))
+        log_analyzer.evict_cache(self.cache_dir, max_age_days=30)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+
+class TestLogSources(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_log_sources"
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        self.rows = []
+        names = ["nginx-access-ui.log-20170630", "nginx-access-ui.log-20170630.gz"]
+        for i, name in enumerate(names):
+            log_dir = os.path.join(self.dir, f"nginx-{i}", "log")
+            os.makedirs(log_dir)
+            rows = generate_log_rows(25000 + i, seed=i)
+            self.rows.extend(rows)
+            write_log(os.path.join(log_dir, name), rows)
+            write_log(os.path.join(log_dir, "nginx-access-ui.log-20170629"), rows[:10])
+        self.sources = [os.path.join(self.dir, "nginx-*", "log")]
+
+    def test_latest_log_files(self):
+        logfiles = log_analyzer.get_latest_log_files(self.sources)
+        self.assertEqual(len(logfiles), 2)
+        self.assertEqual({logfile.date for logfile in logfiles}, {datetime.date(2017, 6, 30)})
+
+    def test_aggregate_sources(self):
+        logfiles = log_analyzer.get_latest_log_files(self.sources)
+        path = os.path.join(self.dir, "nginx-access-ui.log-20170630")
+        write_log(path, self.rows)
+        logfile = log_analyzer.LogFile(name=os.path.basename(path), path=path, date=None)
+        expected = log_analyzer.build_aggregate(logfile)
+        for reader in "default", "pipeline":
+            config = {"SOURCE_QUEUE_SIZE": 1, "GZIP_READER": reader}
+            aggregate = log_analyzer.aggregate_sources(logfiles, config)
+            self.assertEqual(aggregate.total_rows, len(self.rows))
+            self.assertEqual(aggregate.errors, expected.errors)
+            key = lambda row: row["url"]
+            self.assertEqual(
+                sorted(aggregate.statistics(), key=key), sorted(expected.statistics(), key=key)
+            )
+
+    def test_consumer_error(self):
+        logfiles = []
+        for i in range(3):
+            path = os.path.join(self.dir, f"broken-{i}.log.gz")
+            write_log(path, [BROKEN_ROW] * 30000)
+            logfiles.append(log_analyzer.LogFile(name=os.path.basename(path), path=path, date=None))
+        config = {
+            "SOURCE_QUEUE_SIZE": 1,
+            "ERROR_LIMIT_PERC": 5,
+            "ERROR_EARLY_ABORT": True,
+            "ERROR_STATISTICAL_ABORT": True,
+        }
+        errors = []
+
+        def run():
+            try:
+                log_analyzer.aggregate_sources(logfiles, config)
+            except log_analyzer.ErrorBudgetExceeded as exc:
+                errors.append(exc)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout=30)
+        self.assertFalse(thread.is_alive(), "aggregate_sources hangs after the consumer failed")
+        self.assertEqual(len(errors), 1)
+
+    def test_report(self):
+        report_dir = os.path.join(self.dir, "reports")
+        cfg = dict(log_analyzer.config, LOG_SOURCES=self.sources, REPORT_DIR=report_dir)
+        log_analyzer.analyze(cfg, log_analyzer.RunMetrics())
+        self.assertTrue(os.path.exists(os.path.join(report_dir, "report-2017.06.30.html")))
+
+
+class TestFollow(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_follow"
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        os.makedirs(self.dir)
+        self.path = os.path.join(self.dir, "nginx-access-ui.log")
+        self.rows = [row.encode() for row in generate_log_rows(50)]
+
+    def _append(self, content):
+        with open(self.path, "ab") as log:
+            log.write(content)
+
+    def test_follow_rows(self):
+        self._append(self.rows[0] + self.rows[1])
+        stop = threading.Event()
+        rows = log_analyzer.follow_rows(self.path, stop, poll_interval=0)
+        self.assertEqual(next(rows), self.rows[0])
+        self.assertEqual(next(rows), self.rows[1])
+        self.assertIs(next(rows), log_analyzer.FOLLOW_IDLE)
+
+        self._append(self.rows[2][:20])
+        self.assertIs(next(rows), log_analyzer.FOLLOW_IDLE)
+        self._append(self.rows[2][20:])
+        self.assertEqual(next(rows), self.rows[2])
+
+        os.rename(self.path, self.path + "-20170630")
+        self._append(self.rows[3])
+        self.assertIs(next(rows), log_analyzer.FOLLOW_RESET)
+        self.assertEqual(next(rows), self.rows[3])
+
+        with open(self.path, "wb") as log:
+            log.write(self.rows[4])
+        self.assertIs(next(rows), log_analyzer.FOLLOW_RESET)
+        self.assertEqual(next(rows), self.rows[4])
+
+        stop.set()
+        self.assertEqual(list(rows), [])
+
+    def test_live_report(self):
+        report_dir = os.path.join(self.dir, "reports")
+        report = os.path.join(report_dir, log_analyzer.LIVE_REPORT_NAME)
+        cfg = dict(
+            log_analyzer.config,
+            FOLLOW=self.path,
+            REPORT_DIR=report_dir,
+            FOLLOW_INTERVAL=3600,
+            FOLLOW_EVERY_LINES=10,
+        )
+        stop = threading.Event()
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(log_analyzer.follow(cfg, stop, poll_interval=0.01))
+        )
+        thread.start()
+        try:
+            self._append(b"".join(self.rows[:25]))
+            deadline = time.monotonic() + 5
+            while not os.path.exists(report) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(report))
+            self._append(b"".join(self.rows[25:]))
+        finally:
+            time.sleep(0.1)
+            stop.set()
+            thread.join()
+        aggregate, = result
+        self.assertEqual(aggregate.total_rows, 50)
+        # статистика живого отчета не должна зависеть от количества прочитанных строк
+        self.assertIsNotNone(aggregate.sketch_error)
+
+    def test_follow_config(self):
+        for store in "auto", "numpy", "compact":
+            follow_cfg = log_analyzer.get_follow_config(dict(AGGREGATE_STORE=store))
+            self.assertIsNotNone(log_analyzer.new_aggregate(follow_cfg).sketch_error)
+
+
+class TestQuantileSketch(unittest.TestCase):
+    relative_error = 0.01
+
+    def assertRelativeClose(self, expected, real):
+        self.assertLessEqual(abs(expected - real), expected * self.relative_error + 1e-9)
+
+    def test_quantiles(self):
+        values = [random.uniform(0.001, 10) for _ in range(5001)]
+        sketch = log_analyzer.QuantileSketch(self.relative_error)
+        for value in values:
+            sketch.add(value)
+        values.sort()
+        for q in 0.5, 0.9, 0.95, 0.99:
+            expected = values[int(q * (len(values) - 1))]
+            self.assertRelativeClose(expected, sketch.quantile(q))
+
+    def test_zero_values(self):
+        sketch = log_analyzer.QuantileSketch(self.relative_error)
+        for value in 0, 0, 0, 1:
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0.5), 0)
+
+    def test_merge(self):
+        values = [random.uniform(0.001, 10) for _ in range(1000)]
+        whole = log_analyzer.QuantileSketch(self.relative_error)
+        first = log_analyzer.QuantileSketch(self.relative_error)
+        second = log_analyzer.QuantileSketch(self.relative_error)
+        for i, value in enumerate(values):
+            whole.add(value)
+            (first if i % 2 else second).add(value)
+        first.merge(second)
+        self.assertEqual(whole.count, first.count)
+        self.assertDictEqual(whole.buckets, first.buckets)
+
+    def test_statistics_with_sketch(self):
+        requests = [("/a", random.uniform(0.001, 5)) for _ in range(301)] + [(None, None)]
+        with patch("log_analyzer.request_params", return_value=requests):
+            result, total_rows, errors = log_analyzer.get_statistics(
+                tuple(), {"QUANTILE_SKETCH": True, "QUANTILE_ERROR": self.relative_error}
+            )
+        self.assertEqual((total_rows, errors), (302, 1))
+        row, = result
+        values = [time for _, time in requests[:-1]]
+        self.assertRelativeClose(log_analyzer.get_median(values), row["time_med"])
+        for perc in 90, 95, 99:
+            self.assertIn(f"time_p{perc}", row)
+
+
+class TestCompactAggregate(unittest.TestCase):
+    def _statistics(self, config=None):
+        requests = [(f"/url/{random.randrange(30)}", random.uniform(0, 3)) for _ in range(500)]
+        requests += [(None, None)] * 3
+        results = []
+        for store in "dict", "compact":
+            aggregate = log_analyzer.AGGREGATE_STORES[store](**(config or {}))
+            for url, time in requests:
+                aggregate.add(url, time)
+            results.append((aggregate.statistics(), aggregate.total_rows, aggregate.errors))
+        return results
+
+    def test_same_rows_as_dict(self):
+        dict_result, compact_result = self._statistics()
+        self.assertEqual(dict_result, compact_result)
+
+    def test_same_rows_with_sketch(self):
+        dict_result, compact_result = self._statistics({"sketch_error": 0.01})
+        self.assertEqual(dict_result, compact_result)
+
+    def test_merge(self):
+        requests = [(f"/url/{random.randrange(30)}", random.uniform(0, 3)) for _ in range(500)]
+        whole = log_analyzer.CompactAggregate()
+        parts = [log_analyzer.CompactAggregate() for _ in range(3)]
+        for i, (url, time) in enumerate(requests):
+            whole.add(url, time)
+            parts[i * 3 // len(requests)].add(url, time)
+        merged = parts[0].merge(parts[1]).merge(parts[2])
+        key = lambda row: row["url"]
+        whole_rows = sorted(whole.statistics(), key=key)
+        merged_rows = sorted(merged.statistics(), key=key)
+        for key in "url", "count", "time_max", "time_med":
+            self.assertEqual(
+                [row[key] for row in whole_rows], [row[key] for row in merged_rows]
+            )
+
+
+@unittest.skipIf(log_analyzer.get_numpy() is None, "NumPy is not installed")
+class TestNumpyAggregate(unittest.TestCase):
+    def _requests(self, count=5000, urls=300):
+        rnd = random.Random(7)
+        requests = [
+            (f"/url/{rnd.randrange(urls)}", round(rnd.lognormvariate(-1, 1), 3))
+            for _ in range(count)
+        ]
+        return requests + [(None, None)] * 10
+
+    def _fill(self, aggregate, requests):
+        for url, time in requests:
+            aggregate.add(url, time)
+        return aggregate
+
+    def test_same_rows_as_dict(self):
+        requests = self._requests()
+        expected = self._fill(log_analyzer.Aggregate(), requests)
+        real = self._fill(log_analyzer.NumpyAggregate(), requests)
+        self.assertEqual((real.total_rows, real.errors), (expected.total_rows, expected.errors))
+        self.assertEqual(json.dumps(real.statistics()), json.dumps(expected.statistics()))
+        self.assertEqual(json.dumps(real.statistics(50)), json.dumps(expected.statistics(50)))
+
+    def test_merge(self):
+        requests = self._requests()
+        expected = self._fill(log_analyzer.Aggregate(), requests)
+        first = self._fill(log_analyzer.NumpyAggregate(), requests[:2000])
+        second = self._fill(log_analyzer.NumpyAggregate(), requests[2000:])
+        first.merge(second)
+        self.assertEqual(first.statistics(50), expected.statistics(50))
+
+    def test_pickle(self):
+        aggregate = self._fill(log_analyzer.NumpyAggregate(), self._requests())
+        restored = pickle.loads(pickle.dumps(aggregate))
+        self.assertEqual(restored.statistics(20), aggregate.statistics(20))
+
+    def test_empty(self):
+        self.assertEqual(log_analyzer.NumpyAggregate().statistics(10), [])
+
+    def test_auto_store(self):
+        self.assertEqual(log_analyzer.get_store_name({}), "numpy")
+        self.assertEqual(log_analyzer.get_store_name({"QUANTILE_SKETCH": True}), "dict")
+        self.assertEqual(log_analyzer.get_store_name({"MAX_URLS": 10}), "dict")
+        with patch("log_analyzer.get_numpy", return_value=None):
+            self.assertEqual(log_analyzer.get_store_name({}), "dict")
+        self.assertEqual(log_analyzer.get_store_name({"AGGREGATE_STORE": "compact"}), "compact")
+
+
+class TestUrlNormalizer(unittest.TestCase):
+    rules = [
+        ["/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(?=/|$)", "/{uuid}"],
+        ["/\\d+(?=/|$)", "/{id}"],
+    ]
+
+    def test_normalize(self):
+        normalizer = log_analyzer.UrlNormalizer(strip_query=True, rules=self.rules)
+        self.assertEqual(normalizer("/api/v2/banner/25019354?x=1"), "/api/v2/banner/{id}")
+        self.assertEqual(
+            normalizer("/api/1/photo/7c3a8e5e-52b4-4c1d-9d1e-3f1d2b3c4d5e/"),
+            "/api/{id}/photo/{uuid}/",
+        )
+        self.assertEqual(normalizer("/api/v2/banner/12ab"), "/api/v2/banner/12ab")
+
+    def test_cache(self):
+        normalizer = log_analyzer.UrlNormalizer(rules=self.rules)
+        for _ in range(10):
+            normalizer("/api/v2/banner/1")
+        self.assertEqual(normalizer.normalize.cache_info().hits, 9)
+
+    def test_pickle(self):
+        normalizer = log_analyzer.UrlNormalizer(strip_query=True, rules=self.rules)
+        restored = pickle.loads(pickle.dumps(normalizer))
+        self.assertEqual(restored("/a/1?b"), "/a/{id}")
+
+    def test_statistics(self):
+        requests = [("/api/v2/banner/1?a", 1.0), ("/api/v2/banner/2", 2.0), (None, None)]
+        config = {"URL_STRIP_QUERY": True, "URL_RULES": self.rules}
+        with patch("log_analyzer.request_params", return_value=requests):
+            result, total_rows, errors = log_analyzer.get_statistics(tuple(), config)
+        rows = [(row["url"], row["count"]) for row in result]
+        self.assertEqual(rows, [("/api/v2/banner/{id}", 2)])
+
+
+class TestSpaceSaving(unittest.TestCase):
+    def _requests(self, count=20000, urls=2000):
+        rnd = random.Random(1)
+        weights = [1 / rank ** 1.2 for rank in range(1, urls + 1)]
+        chosen = rnd.choices(range(urls), weights=weights, k=count)
+        return [(f"/url/{url}", rnd.uniform(0.5, 1.5)) for url in chosen]
+
+    def test_top_urls_are_accurate(self):
+        requests = self._requests()
+        exact = log_analyzer.Aggregate()
+        capped = log_analyzer.Aggregate(max_urls=200)
+        for url, time in requests:
+            exact.add(url, time)
+            capped.add(url, time)
+        self.assertEqual(len(capped.data), 200)
+        self.assertGreater(capped.evicted, 0)
+        self.assertEqual(capped.total_rows, exact.total_rows)
+        self.assertEqual(exact.statistics(10), capped.statistics(10))
+
+    def test_merge_keeps_limit(self):
+        requests = self._requests()
+        exact = log_analyzer.Aggregate()
+        parts = [log_analyzer.Aggregate(max_urls=200) for _ in range(4)]
+        for i, (url, time) in enumerate(requests):
+            exact.add(url, time)
+            parts[i % 4].add(url, time)
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+        self.assertLessEqual(len(merged.data), 200)
+        self.assertEqual(
+            [row["url"] for row in exact.statistics(10)],
+            [row["url"] for row in merged.statistics(10)],
+        )
+
+    def test_compact_store_not_supported(self):
+        with self.assertRaises(ValueError):
+            log_analyzer.new_aggregate({"AGGREGATE_STORE": "compact", "MAX_URLS": 10})
+
+
 class TestGetMediane(unittest.TestCase):
     assertion_delta = 1e-5
 
@@ -388,11 +1776,326 @@ class TestOpener(unittest.TestCase):
         opener = log_analyzer.get_opener("file.gz")
         func = opener.func
         self.assertEqual(func, gzip.open)
-        self.assertDictEqual(opener.keywords, {"mode": "rt"})
+        self.assertDictEqual(opener.keywords, {"mode": "rb"})
+
+    def test_pipelined_gz(self):
+        opener = log_analyzer.get_opener("file.gz", {"GZIP_READER": "parallel", "WORKERS": 4})
+        self.assertEqual(opener.func, log_analyzer.PipelinedGzipReader)
+        self.assertEqual(opener.keywords["workers"], 4)
+        opener = log_analyzer.get_opener("file.gz", {"GZIP_READER": "pipeline", "WORKERS": 4})
+        self.assertEqual(opener.keywords["workers"], 1)
 
     def test_open(self):
         opener = log_analyzer.get_opener("file.log")
-        self.assertEqual(opener, open)
+        self.assertEqual(opener.func, open)
+        self.assertDictEqual(opener.keywords, {"mode": "rb"})
+
+
+class TestMmapReader(unittest.TestCase):
+    log_dir = "/tmp/log_analyzer/test_mmap_reader"
+
+    def setUp(self):
+        remove_dirs(self.log_dir)
+        os.makedirs(self.log_dir)
+        self.name = "nginx-access-ui.log-20170630"
+        self.path = os.path.join(self.log_dir, self.name)
+        self.rows = generate_log_rows(500)
+        write_log(self.path, self.rows)
+
+    def test_same_as_parse_row(self):
+        expected = [log_analyzer.parse_row(row.encode()) for row in self.rows]
+        self.assertEqual(list(log_analyzer.mmap_params(self.path)), expected)
+
+    def test_range(self):
+        chunks = log_analyzer.get_chunks(self.path, 4)
+        params = []
+        for start, end in chunks:
+            params.extend(log_analyzer.mmap_params(self.path, start, end))
+        self.assertEqual(params, list(log_analyzer.mmap_params(self.path)))
+
+    def test_last_row_without_newline(self):
+        with open(self.path, "a") as log:
+            log.write(LOG_ROW.format(method="GET", url="/last", time="1.5").rstrip())
+        self.assertEqual(list(log_analyzer.mmap_params(self.path))[-1], ("/last", 1.5))
+
+    def test_empty_file(self):
+        write_log(self.path, [])
+        self.assertEqual(list(log_analyzer.mmap_params(self.path)), [])
+
+    def test_statistics(self):
+        logfile = log_analyzer.LogFile(name=self.name, path=self.path, date=None)
+        expected = log_analyzer.get_statistics(logfile, limit=10)
+        for workers in 1, 3:
+            config = {"MMAP_READER": True, "WORKERS": workers}
+            self.assertEqual(log_analyzer.get_statistics(logfile, config, 10), expected)
+
+
+class TestPipelinedGzipReader(unittest.TestCase):
+    log_dir = "/tmp/log_analyzer/test_pipelined_gzip_reader"
+
+    def setUp(self):
+        remove_dirs(self.log_dir)
+        os.makedirs(self.log_dir)
+        self.rows = [row.encode() for row in generate_log_rows(3000)]
+        self.single = os.path.join(self.log_dir, "single.gz")
+        with gzip.open(self.single, "wb") as log:
+            log.writelines(self.rows)
+        self.multi = os.path.join(self.log_dir, "multi.gz")
+        with open(self.multi, "wb") as log:
+            for i in range(0, len(self.rows), 700):
+                log.write(gzip.compress(b"".join(self.rows[i:i + 700])))
+
+    def _read(self, path, workers=1, offset=0, block_size=4096):
+        reader = log_analyzer.PipelinedGzipReader(
+            path, queue_size=2, workers=workers, block_size=block_size
+        )
+        with reader:
+            reader.seek(offset)
+            return list(reader)
+
+    def test_single_member(self):
+        self.assertEqual(self._read(self.single), self.rows)
+
+    def test_multi_member(self):
+        self.assertEqual(self._read(self.multi), self.rows)
+
+    def test_parallel_multi_member(self):
+        self.assertEqual(self._read(self.multi, workers=3), self.rows)
+        self.assertEqual(self._read(self.single, workers=3), self.rows)
+
+    def test_magic_inside_member(self):
+        # несжатый член: сигнатура gzip из данных попадает в файл как есть
+        rows = self.rows[:1000] + [b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03\n"] + self.rows
+        path = os.path.join(self.log_dir, "stored.gz")
+        with open(path, "wb") as log:
+            log.write(gzip.compress(b"".join(rows), compresslevel=0))
+            log.write(gzip.compress(b"".join(self.rows)))
+        with open(path, "rb") as log:
+            self.assertGreater(log.read().count(log_analyzer.GZIP_MAGIC), 2)
+        self.assertEqual(len(log_analyzer.find_gzip_members(path)), 2)
+        self.assertEqual(self._read(path, workers=3), rows + self.rows)
+
+    def test_missed_member(self):
+        offsets = log_analyzer.find_gzip_members(self.multi)
+        self.assertEqual(len(offsets), 5)
+        with patch("log_analyzer.find_gzip_members", return_value=offsets[:2] + offsets[3:]):
+            self.assertEqual(self._read(self.multi, workers=2), self.rows)
+
+    def test_bounded_blocks(self):
+        for path, workers in (self.single, 1), (self.multi, 1), (self.multi, 3):
+            reader = log_analyzer.PipelinedGzipReader(
+                path, queue_size=2, workers=workers, block_size=4096
+            )
+            with reader:
+                sizes = [len(block) for block in reader._iter_blocks()]
+            self.assertLessEqual(max(sizes), 4096)
+            self.assertEqual(sum(sizes), sum(len(row) for row in self.rows))
+
+    def test_seek(self):
+        offset = sum(len(row) for row in self.rows[:1234])
+        self.assertEqual(self._read(self.multi, offset=offset), self.rows[1234:])
+
+    def test_truncated_file(self):
+        with open(self.single, "rb") as log:
+            content = log.read()
+        with open(self.single, "wb") as log:
+            log.write(content[:len(content) // 2])
+        with self.assertRaises(EOFError):
+            self._read(self.single)
+
+    def test_close_before_end(self):
+        reader = log_analyzer.PipelinedGzipReader(self.single, queue_size=1, block_size=1024)
+        with reader:
+            next(iter(reader))
+        self.assertFalse(reader.thread.is_alive())
+
+    def test_statistics(self):
+        logfile = log_analyzer.LogFile(name="multi.gz", path=self.multi, date=None)
+        expected = log_analyzer.get_statistics(logfile, limit=20)
+        for reader in "pipeline", "parallel":
+            config = {"GZIP_READER": reader, "WORKERS": 2}
+            self.assertEqual(log_analyzer.get_statistics(logfile, config, 20), expected)
+
+
+class TestParseRow(unittest.TestCase):
+    def test_valid_row(self):
+        row = LOG_ROW.format(method="GET", url="/api/v2/banner/25019354", time="0.390")
+        url, time = log_analyzer.parse_row(row.encode())
+        self.assertEqual(url, "/api/v2/banner/25019354")
+        self.assertEqual(time, 0.39)
+
+    def test_float_in_user_agent(self):
+        row = (
+            '1.169.137.128 -  - [29/Jun/2017:03:50:23 +0300] "GET /api/1/photo/ HTTP/1.1" 200 '
+            '16 "-" "Mozilla/5.0 (Windows NT 10.0 ; WOW64)" "-" "1498697423-2118016444" "-" 0.138\n'
+        )
+        self.assertEqual(log_analyzer.parse_row(row.encode()), ("/api/1/photo/", 0.138))
+
+    def test_unparseable_row(self):
+        self.assertEqual(log_analyzer.parse_row(BROKEN_ROW.encode()), (None, None))
+        self.assertEqual(log_analyzer.parse_row(b"\n"), (None, None))
+
+    def test_not_utf8_url(self):
+        row = LOG_ROW.format(method="GET", url="/x", time="0.1").encode().replace(b"/x", b"/\xff")
+        self.assertEqual(log_analyzer.parse_row(row), (None, None))
+
+    def test_request_params(self):
+        dir_ = "/tmp/log_analyzer/test_parse_row"
+        remove_dirs(dir_)
+        os.makedirs(dir_)
+        rows = generate_log_rows(100)
+        for name in "nginx-access-ui.log-20170630", "nginx-access-ui.log-20170630.gz":
+            path = os.path.join(dir_, name)
+            write_log(path, rows)
+            logfile = log_analyzer.LogFile(name=name, path=path, date=None)
+            params = list(log_analyzer.request_params(logfile))
+            self.assertEqual(len(params), len(rows))
+            self.assertEqual(params.count((None, None)), 2)
+
+
+class TestReportWriter(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_report_writer"
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        os.makedirs(self.dir)
+        self.rows = [
+            {"url": f"/url/{i}", "count": i, "time_sum": i / 3} for i in range(2500)
+        ]
+        self.rows.append({"url": "/</script><script>alert(1)</script>", "count": 1})
+
+    def _render(self, rows):
+        content = io.StringIO()
+        log_analyzer.render_report(content, rows)
+        return content.getvalue()
+
+    def _table(self, content):
+        start = content.index("var table = ") + len("var table = ")
+        end = content.index(";\n", start)
+        return content[start:end]
+
+    def test_rows_are_json(self):
+        content = self._render(self.rows)
+        self.assertEqual(json.loads(self._table(content)), self.rows)
+        self.assertNotIn("</script><script>", content)
+
+    def test_empty_table(self):
+        content = self._render([])
+        self.assertEqual(self._table(content), "[]")
+
+    def test_write_report(self):
+        config = {"REPORT_DIR": os.path.join(self.dir, "reports")}
+        log_analyzer.write_report(iter(self.rows), "report.html", config)
+        self.assertEqual(os.listdir(config["REPORT_DIR"]), ["report.html"])
+        with open(os.path.join(config["REPORT_DIR"], "report.html")) as report:
+            self.assertEqual(report.read(), self._render(self.rows))
+
+    def test_failed_write_keeps_old_report(self):
+        config = {"REPORT_DIR": self.dir}
+        path = os.path.join(self.dir, "report.html")
+        with open(path, "w") as report:
+            report.write("old")
+
+        def rows():
+            yield {"url": "/"}
+            raise RuntimeError("broken")
+
+        with self.assertRaises(RuntimeError):
+            log_analyzer.write_report(rows(), "report.html", config)
+        self.assertEqual(os.listdir(self.dir), ["report.html"])
+        with open(path) as report:
+            self.assertEqual(report.read(), "old")
+
+    def test_template_is_cached(self):
+        log_analyzer.load_template.cache_clear()
+        for _ in range(3):
+            self._render(self.rows[:1])
+        self.assertEqual(log_analyzer.load_template.cache_info().misses, 1)
+
+
+class TestExport(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_export"
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        self.aggregate = log_analyzer.Aggregate()
+        for row in generate_log_rows(2000, urls_count=300):
+            url, time = log_analyzer.parse_row(row.encode())
+            self.aggregate.add(url, time)
+        self.aggregate.add("/ünicode,\"quoted\"", 0.5)
+        self.rows = self.aggregate.statistics()
+
+    def _export(self, **config):
+        formats = ["jsonl", "csv", "columnar"]
+        config = dict({"EXPORT_DIR": self.dir, "EXPORT_FORMATS": formats}, **config)
+        paths = log_analyzer.export_statistics(self.rows, "report-2017.06.30.html", config)
+        return {os.path.basename(path).split(".")[3]: path for path in paths}
+
+    def _read_csv(self, file):
+        rows = []
+        for row in csv.DictReader(file):
+            row = {key: (value if key == "url" else float(value)) for key, value in row.items()}
+            row["count"] = int(row["count"])
+            rows.append(row)
+        return rows
+
+    def test_formats(self):
+        paths = self._export()
+        self.assertEqual(
+            sorted(os.listdir(self.dir)),
+            ["report-2017.06.30.col", "report-2017.06.30.csv", "report-2017.06.30.jsonl"],
+        )
+        with open(paths["jsonl"]) as file:
+            self.assertEqual([json.loads(line) for line in file], self.rows)
+        with open(paths["csv"], newline="") as file:
+            self.assertEqual(self._read_csv(file), self.rows)
+        self.assertEqual(list(log_analyzer.read_columnar(paths["col"])), self.rows)
+
+    def test_gzip(self):
+        paths = self._export(EXPORT_GZIP=True)
+        self.assertTrue(all(path.endswith(".gz") for path in paths.values()))
+        with gzip.open(paths["jsonl"], "rt") as file:
+            self.assertEqual([json.loads(line) for line in file], self.rows)
+        with gzip.open(paths["csv"], "rt", newline="") as file:
+            self.assertEqual(self._read_csv(file), self.rows)
+        self.assertEqual(list(log_analyzer.read_columnar(paths["col"])), self.rows)
+
+    def test_columnar_row_groups(self):
+        with patch.object(log_analyzer, "COLUMNAR_GROUP_ROWS", 7):
+            paths = self._export()
+        self.assertEqual(list(log_analyzer.read_columnar(paths["col"])), self.rows)
+
+    def test_sketch_percentiles(self):
+        aggregate = log_analyzer.Aggregate(sketch_error=0.01)
+        for row in generate_log_rows(300):
+            aggregate.add(*log_analyzer.parse_row(row.encode()))
+        self.rows = aggregate.statistics()
+        paths = self._export()
+        exported = list(log_analyzer.read_columnar(paths["col"]))
+        self.assertEqual(exported, self.rows)
+        self.assertIn("time_p99", exported[0])
+
+    def test_streamed_rows(self):
+        expected = self.rows
+        self.rows = self.aggregate.iter_statistics
+        with patch.object(log_analyzer, "COLUMNAR_GROUP_ROWS", 7):
+            paths = self._export()
+        with open(paths["jsonl"]) as file:
+            self.assertEqual([json.loads(line) for line in file], expected)
+        with open(paths["csv"], newline="") as file:
+            self.assertEqual(self._read_csv(file), expected)
+        self.assertEqual(list(log_analyzer.read_columnar(paths["col"])), expected)
+
+    def test_empty(self):
+        self.rows = []
+        paths = self._export()
+        self.assertEqual(list(log_analyzer.read_columnar(paths["col"])), [])
+        with open(paths["csv"]) as file:
+            self.assertEqual(file.read().strip(), ",".join(log_analyzer.EXPORT_FIELDS))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self._export(EXPORT_FORMATS=["xml"])
 
 
 class TestGetExternalConfig(unittest.TestCase):
@@ -439,10 +2142,167 @@ class TestGetExternalConfig(unittest.TestCase):
             log_analyzer.get_external_config(path)
 
 
+class TestLogAnalyzer(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_log_analyzer"
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        self.log_dir = os.path.join(self.dir, "log")
+        os.makedirs(self.log_dir)
+        write_log(os.path.join(self.log_dir, "nginx-access-ui.log-20170629"), [BROKEN_ROW] * 10)
+        write_log(
+            os.path.join(self.log_dir, "nginx-access-ui.log-20170630"), generate_log_rows(500)
+        )
+        self.analyzer = log_analyzer.LogAnalyzer(
+            {"LOG_DIR": self.log_dir, "REPORT_DIR": os.path.join(self.dir, "reports")}
+        )
+
+    def test_analyze_latest(self):
+        analysis = self.analyzer.analyze()
+        self.assertEqual(analysis.logfile.name, "nginx-access-ui.log-20170630")
+        self.assertEqual(analysis.total_rows, 500)
+        self.assertEqual(analysis.errors, 13)
+        expected = log_analyzer.get_statistics(analysis.logfile, limit=1000)[0]
+        self.assertEqual(analysis.rows, expected)
+        self.assertEqual(
+            [stage["stage"] for stage in self.analyzer.metrics.stages],
+            ["get_latest_log_file", "request_params", "statistics"],
+        )
+
+    def test_analyze_full(self):
+        analyzer = log_analyzer.LogAnalyzer({"LOG_DIR": self.log_dir, "REPORT_SIZE": 5})
+        self.assertEqual(len(analyzer.analyze().rows), 5)
+        self.assertEqual(len(analyzer.analyze(full=True).rows), 20)
+
+    def test_too_many_errors(self):
+        logfile = min(self.analyzer.log_files(), key=lambda logfile: logfile.date)
+        with self.assertRaises(log_analyzer.ErrorBudgetExceeded):
+            self.analyzer.analyze(logfile)
+
+    def test_report(self):
+        path = self.analyzer.report()
+        self.assertEqual(path, os.path.join(self.dir, "reports", "report-2017.06.30.html"))
+        self.assertTrue(os.path.exists(path))
+
+    def test_no_logs(self):
+        analyzer = log_analyzer.LogAnalyzer({"LOG_DIR": os.path.join(self.dir, "missing")})
+        self.assertIsNone(analyzer.analyze())
+        self.assertIsNone(analyzer.report())
+
+    def test_import_has_no_side_effects(self):
+        code = (
+            "import sys; sys.argv = ['scheduler', '--unknown']; import log_analyzer; "
+            "print('numpy' in sys.modules, 'asyncio' in sys.modules)"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.abspath(log_analyzer.__file__)),
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 0, msg=result.stderr)
+        self.assertEqual(result.stdout.split(), ["False", "False"])
+
+
 class TestMain(unittest.TestCase):
+    dir = "/tmp/log_analyzer/test_main"
+
+    def setUp(self):
+        remove_dirs(self.dir)
+        self.log_dir = os.path.join(self.dir, "log")
+        self.report_dir = os.path.join(self.dir, "reports")
+        os.makedirs(self.log_dir)
+        log_path = os.path.join(self.log_dir, "nginx-access-ui.log-20170630")
+        write_log(log_path, generate_log_rows(500))
+        self.config = dict(
+            log_analyzer.config,
+            LOG_DIR=self.log_dir,
+            REPORT_DIR=self.report_dir,
+            OUTPUT_LOG_DIR=self.dir,
+            METRICS_FILE=os.path.join(self.dir, "metrics.json"),
+        )
+
+    def _run(self, **config):
+        path = os.path.join(self.dir, "config.json")
+        with open(path, "w") as cfg:
+            json.dump(config, cfg)
+        log_analyzer.main(self.config, path)
+
     def test_error_exit_code(self):
         self.assertNotEqual(log_analyzer.ERROR_EXIT_STATUS, OK_EXIT_CODE)
 
+    def test_report_created(self):
+        self._run()
+        report = os.path.join(self.report_dir, "report-2017.06.30.html")
+        self.assertTrue(os.path.exists(report))
+
+    def test_metrics(self):
+        self._run()
+        with open(self.config["METRICS_FILE"]) as file:
+            summary = json.load(file)
+        stages = {stage["stage"]: stage for stage in summary["stages"]}
+        expected = [
+            "get_latest_log_file",
+            "request_params",
+            "statistics",
+            "write_report",
+        ]
+        self.assertEqual(list(stages), expected)
+        self.assertEqual(stages["request_params"]["lines"], 500)
+        for stage in stages.values():
+            self.assertGreaterEqual(stage["wall_time"], 0)
+            self.assertGreaterEqual(stage["cpu_time"], 0)
+            self.assertIn("peak_rss", stage)
+
+    def test_export(self):
+        export_dir = os.path.join(self.dir, "export")
+        self._run(EXPORT_DIR=export_dir, EXPORT_FORMATS=["csv"], REPORT_SIZE=5)
+        with open(os.path.join(export_dir, "report-2017.06.30.csv")) as file:
+            self.assertEqual(len(file.readlines()), 21)
+
+    def test_backfill(self):
+        log_path = os.path.join(self.log_dir, "nginx-access-ui.log-20170628.gz")
+        write_log(log_path, generate_log_rows(50))
+        write_log(os.path.join(self.log_dir, "nginx-access-ui.log-20170629"), [BROKEN_ROW] * 10)
+        os.makedirs(self.report_dir)
+        existing = os.path.join(self.report_dir, "report-2017.06.27.html")
+        with open(existing, "w") as report:
+            report.write("old")
+        write_log(os.path.join(self.log_dir, "nginx-access-ui.log-20170627"), generate_log_rows(5))
+
+        with self.assertRaises(SystemExit) as sys_exit:
+            self._run(BACKFILL=True, BACKFILL_CONCURRENCY=2)
+        self.assertEqual(sys_exit.exception.code, log_analyzer.ERROR_EXIT_STATUS)
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.report_dir) if not name.startswith(".")),
+            ["report-2017.06.27.html", "report-2017.06.28.html", "report-2017.06.30.html"],
+        )
+        with open(existing) as report:
+            self.assertEqual(report.read(), "old")
+        with open(self.config["METRICS_FILE"]) as file:
+            stages = json.load(file)["stages"]
+        logs = {stage["log"] for stage in stages if stage["stage"] == "write_report"}
+        self.assertEqual(logs, {"nginx-access-ui.log-20170628.gz", "nginx-access-ui.log-20170630"})
+        # этапы лога с ошибками тоже попадают в сводку
+        parsed = {
+            stage["log"]: stage["lines"] for stage in stages if stage["stage"] == "request_params"
+        }
+        self.assertEqual(parsed["nginx-access-ui.log-20170629"], 10)
+
+    def test_unreported_log_files(self):
+        write_log(os.path.join(self.log_dir, "nginx-access-ui.log-20170628.gz"), [])
+        os.makedirs(self.report_dir)
+        with open(os.path.join(self.report_dir, "report-2017.06.30.html"), "w") as report:
+            report.write("")
+        logfiles = log_analyzer.get_unreported_log_files(self.log_dir, self.report_dir)
+        names = [logfile.name for logfile in logfiles]
+        self.assertEqual(names, ["nginx-access-ui.log-20170628.gz"])
+
+    def test_profile(self):
+        profile = os.path.join(self.dir, "profile.out")
+        self._run(PROFILE_FILE=profile)
+        self.assertTrue(os.path.exists(profile))
+
 
 if __name__ == "__main__":
     unittest.main()